@@ -11,22 +11,41 @@
 from __future__ import print_function
 
 import argparse
+import asyncio
 import atexit
+import collections
+import concurrent.futures
 import copy
+import functools
+import hashlib
+import heapq
+import http.client
 import logging
+import mmap
 import pipes
 import random
 import string
+import struct
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 import json
 import uuid
+import zlib
 
 from argparse import RawDescriptionHelpFormatter
 from boto.utils import get_instance_metadata
 from datetime import timedelta
 from multiprocessing.pool import ThreadPool
 
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
 import os
 import re
 
@@ -49,6 +68,14 @@ RPC_BIND_ADDRESSES_ARG_PREFIX = RPC_BIND_ADDRESSES_ARG_NAME + '='
 ACTION_COPY = "COPY"
 ACTION_MOVE = "MOVE"
 ACTION_NOOP = "NOOP"
+# Integer codes of the actions, used by FileEntry and the binary manifest.
+ACTION_CODE_NONE = 0
+ACTION_CODE_COPY = 1
+ACTION_CODE_MOVE = 2
+ACTION_CODE_NOOP = 3
+ACTION_TO_CODE = {None: ACTION_CODE_NONE, ACTION_COPY: ACTION_CODE_COPY,
+                  ACTION_MOVE: ACTION_CODE_MOVE, ACTION_NOOP: ACTION_CODE_NOOP}
+CODE_TO_ACTION = {code: action for action, code in ACTION_TO_CODE.items()}
 
 IMPORTED_TABLE_RE = re.compile(r'(?:Colocated t|T)able being imported: ([^\.]*)\.(.*)')
 RESTORATION_RE = re.compile('^Restoration id: (' + UUID_RE_STR + r')\b')
@@ -67,8 +94,11 @@ DIFF_SNAPSHOT_DIR_GLOB = '*' + ROCKSDB_PATH_PREFIX + '/table-*/tablet-*.snapshot
 SNAPSHOT_DIR_SUFFIX_RE = re.compile(
     '^.*/tablet-({})[.]snapshots/({})$'.format(UUID_RE_STR, UUID_RE_STR))
 
-SNAPSHOT_FILES_DIR_MIN_DEPTH = 8
 SNAPSHOT_FILES_DIR_MAX_DEPTH = 9
+# One record per snapshot directory or file found by discover_snapshot(): the kind ('d' or 'f'),
+# the data directory, device, inode, size, modification time and path, separated by tabs.
+SNAPSHOT_DISCOVERY_DIR_FORMAT = 'd\\t%H\\t0\\t0\\t0\\t0\\t%p\\n'
+SNAPSHOT_DISCOVERY_FILE_FORMAT = 'f\\t%H\\t%D\\t%i\\t%s\\t%T@\\t%p\\n'
 
 TABLE_PATH_PREFIX_TEMPLATE = ROCKSDB_PATH_PREFIX + '/table-{}'
 
@@ -85,8 +115,26 @@ CLOUD_CMD_MAX_RETRIES = 10
 NET_ADDR_FILTER_VAL = 'ipv4_external,ipv4_all,ipv6_external,ipv6_non_link_local,ipv6_all'
 
 MANIFEST = 'MANIFEST'
+CHAIN_CATALOG = 'CHAIN_CATALOG'
+DEDUP_INDEX = 'INDEX'
+DATA_DIR_CACHE = 'data_dirs.json'
+CHAIN_CATALOG_VERSION = 1
+MANIFEST_FORMAT_JSON = 'json'
+MANIFEST_FORMAT_BINARY = 'binary'
+MANIFEST_FORMAT_STREAM = 'stream'
+MANIFEST_FORMATS = [MANIFEST_FORMAT_BINARY, MANIFEST_FORMAT_STREAM, MANIFEST_FORMAT_JSON]
+MANIFEST_BINARY_MAGIC = b'YBDIFFMF'
+# Version 2 adds the content key of dedup store objects, version 3 the file size, to every
+# record.
+MANIFEST_BINARY_VERSION = 3
+MANIFEST_STREAM_KEY = 'manifest_stream'
+MANIFEST_STREAM_VERSION = 1
+MANIFEST_SHARDS_DIR = 'MANIFEST.shards'
 CREATE_SNAPSHOT_TIMEOUT_SEC = 60 * 60  # hour
 RESTORE_SNAPSHOT_TIMEOUT_SEC = 24 * 60 * 60  # day
+# Snapshot state is checked right away, then with delays growing from the initial to the max.
+SNAPSHOT_POLL_INITIAL_DELAY_SEC = 0.5
+SNAPSHOT_POLL_MAX_DELAY_SEC = 10
 SHA_TOOL_PATH = '/usr/bin/sha256sum'
 # Try to read home dir from environment variable, else assume it's /home/yugabyte.
 YB_HOME_DIR = os.environ.get("YB_HOME_DIR", "/home/yugabyte")
@@ -96,12 +144,21 @@ DEFAULT_REMOTE_YB_ADMIN_PATH = os.path.join(YB_HOME_DIR, 'master/bin/yb-admin')
 DEFAULT_REMOTE_YSQL_DUMP_PATH = os.path.join(YB_HOME_DIR, 'master/postgres/bin/ysql_dump')
 DEFAULT_REMOTE_YSQL_SHELL_PATH = os.path.join(YB_HOME_DIR, 'master/bin/ysqlsh')
 DEFAULT_YB_USER = 'yugabyte'
+PARALLEL_ENGINE_THREADS = 'threads'
+PARALLEL_ENGINE_ASYNCIO = 'asyncio'
+SSH_EXECUTOR_PROCESS = 'process'
+SSH_EXECUTOR_NATIVE = 'native'
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+STORAGE_ENGINE_CLI = 'cli'
+STORAGE_ENGINE_NATIVE = 'native'
+S3_TRANSFER_SCRIPT = 'yb_s3_transfer.py'
 VERSION = '0.1'
 
 
 
 DEFAULT_TS_WEB_PORT = 9000
+DEFAULT_MASTER_WEB_PORT = 7000
+MASTER_HTTP_TIMEOUT_SEC = 30
 
 class Manifest():
     def __init__(self,manifest_id_in):
@@ -124,8 +181,14 @@ class Manifest():
         self.storage_keyspace = ""
         self.storage_table = ""
         self.storage_table_ids = dict()
+        # References to the manifest fragments of a sharded manifest, see ManifestShardCodec.
+        self.manifest_shards = list()
 
-        self.storage_tablet_ids = dict()
+        self._storage_tablet_ids = dict()
+        # Memory-mapped binary manifest backing storage_tablet_ids until it is first accessed.
+        self.storage_reader = None
+        # Fields changed by update_file() while the manifest is backed by storage_reader.
+        self._file_overrides = dict()
 
         self.storage_files = dict()
         self.storage_table_ids_dict = dict()
@@ -144,7 +207,99 @@ class Manifest():
         self.backup_messages = dict()
         self.backup_errors = dict()
 
-    def to_json_dict(self):
+    @property
+    def storage_tablet_ids(self):
+        if self.storage_reader is not None:
+            # Entries of a memory-mapped manifest are only loaded once something needs all of them.
+            self._storage_tablet_ids = self.storage_reader.to_storage_tablet_ids()
+            for tablet_id, overrides in self._file_overrides.items():
+                files = self._storage_tablet_ids.get(tablet_id, {})
+                for filename, fields in overrides.items():
+                    if filename in files:
+                        files[filename].update(fields)
+            self._file_overrides = dict()
+            self.storage_reader = None
+        return self._storage_tablet_ids
+
+    @storage_tablet_ids.setter
+    def storage_tablet_ids(self, tablet_ids):
+        self.storage_reader = None
+        self._file_overrides = dict()
+        self._storage_tablet_ids = tablet_ids
+
+    def attach_reader(self, reader):
+        """
+        Backs the manifest entries by the given binary or streaming manifest reader without
+        parsing them.
+        """
+        self.storage_tablet_ids = dict()
+        self.storage_reader = reader
+        self.update_metadata(reader.metadata)
+
+    def lookup_file(self, tablet_id, filename):
+        """
+        :return: the manifest entry of the given file, or None if the manifest does not have it.
+        """
+        if self.storage_reader is not None:
+            entry = self.storage_reader.lookup(tablet_id, filename)
+            if entry is not None:
+                entry.update(self._file_overrides.get(tablet_id, {}).get(filename, ()))
+            return entry
+        return self._storage_tablet_ids.get(tablet_id, {}).get(filename)
+
+    def update_file(self, tablet_id, filename, **fields):
+        """
+        Changes fields of a manifest entry, files the manifest does not have are ignored.
+        A manifest backed by a reader keeps the changed fields aside instead of loading all of
+        its entries, so it can be written back without a full copy.
+        """
+        if self.storage_reader is not None:
+            self._file_overrides.setdefault(tablet_id, {}).setdefault(filename, {}).update(fields)
+            return
+        entry = self._storage_tablet_ids.get(tablet_id, {}).get(filename)
+        if entry is not None:
+            entry.update(fields)
+
+    def _apply_overrides(self, tablet_id, files):
+        overrides = self._file_overrides.get(tablet_id)
+        if not overrides:
+            return files
+        return ((filename, dict(entry, **overrides[filename]) if filename in overrides else entry)
+                for filename, entry in files)
+
+    def tablet_files(self, tablet_id):
+        """
+        :return: an iterator over (filename, entry) pairs of the given tablet.
+        """
+        if self.storage_reader is not None:
+            return self._apply_overrides(tablet_id, self.storage_reader.tablet_files(tablet_id))
+        return iter(self._storage_tablet_ids[tablet_id].items())
+
+    def iter_tablets(self):
+        """
+        :return: an iterator over (tablet_id, files) pairs in the form of storage_tablet_ids.
+            A manifest backed by a reader builds the files of one tablet at a time.
+        """
+        if self.storage_reader is not None:
+            return ((tablet_id, dict(self.tablet_files(tablet_id)))
+                    for tablet_id in self.storage_reader.tablet_ids())
+        return iter(self._storage_tablet_ids.items())
+
+    def iter_files(self):
+        """
+        :return: an iterator over (tablet_id, filename, entry) tuples of all manifest entries.
+        """
+        if self.storage_reader is not None:
+            if not self._file_overrides:
+                return self.storage_reader.iter_records()
+            return ((tablet_id, filename,
+                     dict(entry, **self._file_overrides.get(tablet_id, {}).get(filename, {})))
+                    for tablet_id, filename, entry in self.storage_reader.iter_records())
+        return ((tablet_id, filename, entry)
+                for tablet_id, files in self._storage_tablet_ids.items()
+                for filename, entry in files.items())
+
+    def to_json_dict(self, include_tablet_ids=True):
         manifest_json = {"manifest": {
             "metadata": {
             "manifest_version": self.manifest_version,
@@ -167,7 +322,8 @@ class Manifest():
                 "keyspace": self.storage_keyspace,
                 "table": self.storage_table,
                 "table_id": (self.storage_table_ids),
-                "tablet_ids": self.storage_tablet_ids,
+                "tablet_ids": self.storage_tablet_ids if include_tablet_ids else {},
+                "shards": self.manifest_shards,
                 "files": (self.storage_files)
             }
             , "backup": {
@@ -191,12 +347,15 @@ class Manifest():
         json_object = json.dumps(json_dict, indent=4)
         return json_object
 
+    def update_metadata(self, manifest_dict):
+        metadata = manifest_dict['manifest']['metadata']
+        self.manifest_previous = metadata.get('manifest_previous', '')
+        self.manifest_savepoint_number = metadata.get('manifest_savepoint_number', 0)
+        self.manifest_shards = manifest_dict['manifest']['storage'].get('shards', [])
+
     def update_storage_tablet_ids(self, manifest_dict):
         self.storage_tablet_ids = manifest_dict['manifest']['storage']['tablet_ids']
-        if 'manifest_previous' in manifest_dict['manifest']['metadata']:
-            self.manifest_previous = manifest_dict['manifest']['metadata']['manifest_previous']
-        else:
-            self.manifest_previous = ''
+        self.update_metadata(manifest_dict)
 
 
 class BackupException(Exception):
@@ -209,6 +368,1276 @@ class CompatibilityException(BackupException):
     pass
 
 
+class BinaryManifestCodec:
+    """
+    Compact binary encoding of a manifest. Every string is interned in a table sorted in code
+    point order, so comparing two string indices is the same as comparing the strings. Records
+    are sorted by (tablet, filename), which lets a reader binary-search a memory-mapped file
+    instead of parsing it.
+
+    Layout (little-endian):
+        header        HEADER, offsets below are from the start of the file
+        metadata      UTF-8 JSON of the manifest with empty storage.tablet_ids
+        string index  (num_strings + 1) uint64 offsets into the string blob
+        string blob   concatenated UTF-8 strings
+        tablet index  num_tablets TABLET entries sorted by tablet
+        records       num_records RECORD entries sorted by (tablet, filename)
+
+    src_location is split after its last '/' into a directory and a base name, so the directory
+    is interned once per tablet and the base name shares the filename string.
+    Manifests without content keys or file sizes are written in version 1, which has no content
+    key field, and manifests without file sizes in version 2, which has no size field.
+    """
+    HEADER = struct.Struct('<8sHHIIIQQQQQQ')
+    # tablet string, index of the first record, number of records.
+    TABLET = struct.Struct('<III')
+    # tablet, filename, generation, location directory, location base name, action.
+    RECORD = struct.Struct('<IIIIIB3x')
+    # RECORD followed by the content key string, or NO_STRING.
+    RECORD_V2 = struct.Struct('<IIIIIIB3x')
+    # RECORD_V2 with the file size, or NO_SIZE, before the action.
+    RECORD_V3 = struct.Struct('<IIIIIIQB3x')
+    NO_STRING = 0xFFFFFFFF
+    NO_SIZE = 0xFFFFFFFFFFFFFFFF
+
+    @classmethod
+    def record_struct(cls, version):
+        return {1: cls.RECORD, 2: cls.RECORD_V2}.get(version, cls.RECORD_V3)
+
+    ACTION_TO_CODE = ACTION_TO_CODE
+    CODE_TO_ACTION = CODE_TO_ACTION
+
+    @staticmethod
+    def split_location(location):
+        head, sep, tail = location.rpartition('/')
+        return head + sep, tail
+
+    @classmethod
+    def write(cls, fp, manifest):
+        """
+        Writes the given manifest to the binary file object fp.
+        """
+        strings = set()
+        version = 1
+        for tablet_id, files in manifest.iter_tablets():
+            strings.add(tablet_id)
+            for filename, entry in files.items():
+                # The marker for directory uploads never outlives upload planning.
+                if filename == 'DIRECTORY':
+                    continue
+                strings.add(filename)
+                strings.update(cls.split_location(entry.get('src_location', '')))
+                if entry.get('content_key'):
+                    strings.add(entry['content_key'])
+                    version = max(version, 2)
+                if entry.get('size') is not None:
+                    version = 3
+        record_struct = cls.record_struct(version)
+        sorted_strings = sorted(strings)
+        string_to_index = {s: i for i, s in enumerate(sorted_strings)}
+
+        string_offsets = [0]
+        encoded_strings = []
+        for s in sorted_strings:
+            encoded = s.encode('utf-8')
+            encoded_strings.append(encoded)
+            string_offsets.append(string_offsets[-1] + len(encoded))
+
+        # Records only need to be contiguous per tablet, the tablet index is sorted afterwards.
+        tablet_index = []
+        records = []
+        for tablet_id, files in manifest.iter_tablets():
+            tablet_string = string_to_index[tablet_id]
+            first_record = len(records)
+            for filename in sorted(files):
+                if filename == 'DIRECTORY':
+                    continue
+                entry = files[filename]
+                location_dir, location_base = cls.split_location(entry.get('src_location', ''))
+                fields = [tablet_string, string_to_index[filename], entry.get('generation', 0),
+                          string_to_index[location_dir], string_to_index[location_base]]
+                if version > 1:
+                    content_key = entry.get('content_key')
+                    fields.append(string_to_index[content_key] if content_key else cls.NO_STRING)
+                if version > 2:
+                    size = entry.get('size')
+                    fields.append(cls.NO_SIZE if size is None else size)
+                fields.append(cls.ACTION_TO_CODE[entry.get('action')])
+                records.append(record_struct.pack(*fields))
+            tablet_index.append((tablet_string, first_record, len(records) - first_record))
+        tablet_index.sort()
+
+        metadata = json.dumps(manifest.to_json_dict(include_tablet_ids=False)).encode('utf-8')
+        metadata_offset = cls.HEADER.size
+        string_index_offset = metadata_offset + len(metadata)
+        string_blob_offset = string_index_offset + 8 * len(string_offsets)
+        tablet_index_offset = string_blob_offset + string_offsets[-1]
+        record_offset = tablet_index_offset + cls.TABLET.size * len(tablet_index)
+
+        fp.write(cls.HEADER.pack(
+            MANIFEST_BINARY_MAGIC, version, 0, len(sorted_strings),
+            len(tablet_index), len(records), metadata_offset, len(metadata),
+            string_index_offset, string_blob_offset, tablet_index_offset, record_offset))
+        fp.write(metadata)
+        fp.write(struct.pack('<{}Q'.format(len(string_offsets)), *string_offsets))
+        fp.writelines(encoded_strings)
+        fp.writelines(cls.TABLET.pack(*tablet) for tablet in tablet_index)
+        fp.writelines(records)
+
+
+class BinaryManifestReader:
+    """
+    Read-only view of a binary manifest file, see BinaryManifestCodec. The file is memory-mapped
+    and looked up with binary searches, only the metadata section is parsed up front.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size < BinaryManifestCodec.HEADER.size:
+                raise BackupException("Binary manifest {} is truncated".format(path))
+            self._buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, _, self.num_strings, self.num_tablets, self.num_records,
+         metadata_offset, metadata_length, self._string_index_offset, self._string_blob_offset,
+         self._tablet_index_offset, self._record_offset) = \
+            BinaryManifestCodec.HEADER.unpack_from(self._buf, 0)
+        if magic != MANIFEST_BINARY_MAGIC:
+            raise BackupException("{} is not a binary manifest".format(path))
+        if version > MANIFEST_BINARY_VERSION:
+            raise BackupException("Binary manifest {} has unsupported version {}".format(
+                path, version))
+        self._record_struct = BinaryManifestCodec.record_struct(version)
+        expected_size = self._record_offset + self._record_struct.size * self.num_records
+        if len(self._buf) < expected_size:
+            raise BackupException("Binary manifest {} is truncated: {} < {} bytes".format(
+                path, len(self._buf), expected_size))
+
+        self.metadata = json.loads(
+            self._buf[metadata_offset:metadata_offset + metadata_length].decode('utf-8'))
+
+    def __deepcopy__(self, memo):
+        # The reader is immutable, so copies of a manifest can share it.
+        return self
+
+    def close(self):
+        self._buf.close()
+
+    def string(self, index):
+        start, end = struct.unpack_from('<QQ', self._buf, self._string_index_offset + 8 * index)
+        start += self._string_blob_offset
+        end += self._string_blob_offset
+        return self._buf[start:end].decode('utf-8')
+
+    def find_string(self, value):
+        """
+        :return: the index of the given string in the string table, or None.
+        """
+        lo, hi = 0, self.num_strings
+        while lo < hi:
+            mid = (lo + hi) // 2
+            s = self.string(mid)
+            if s < value:
+                lo = mid + 1
+            elif s > value:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _tablet(self, index):
+        return BinaryManifestCodec.TABLET.unpack_from(
+            self._buf, self._tablet_index_offset + BinaryManifestCodec.TABLET.size * index)
+
+    def _record(self, index):
+        return self._record_struct.unpack_from(
+            self._buf, self._record_offset + self._record_struct.size * index)
+
+    def _find_tablet(self, tablet_id):
+        """
+        :return: (index of the first record, number of records) of the tablet, or None.
+        """
+        tablet_string = self.find_string(tablet_id)
+        if tablet_string is None:
+            return None
+        lo, hi = 0, self.num_tablets
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_string, first_record, num_records = self._tablet(mid)
+            if mid_string < tablet_string:
+                lo = mid + 1
+            elif mid_string > tablet_string:
+                hi = mid
+            else:
+                return first_record, num_records
+        return None
+
+    def _entry(self, filename, record):
+        generation, location_dir, location_base = record[2:5]
+        action_code = record[-1]
+        entry = {"filename": filename,
+                 "generation": generation,
+                 "src_location": self.string(location_dir) + self.string(location_base)}
+        if len(record) > 6 and record[5] != BinaryManifestCodec.NO_STRING:
+            entry["content_key"] = self.string(record[5])
+        if len(record) > 7 and record[6] != BinaryManifestCodec.NO_SIZE:
+            entry["size"] = record[6]
+        action = BinaryManifestCodec.CODE_TO_ACTION[action_code]
+        if action is not None:
+            entry["action"] = action
+        return entry
+
+    def has_tablet(self, tablet_id):
+        return self._find_tablet(tablet_id) is not None
+
+    def lookup(self, tablet_id, filename):
+        """
+        :return: the entry of the given file as a new dict, or None if it is not in the manifest.
+        """
+        tablet = self._find_tablet(tablet_id)
+        filename_string = self.find_string(filename)
+        if tablet is None or filename_string is None:
+            return None
+        lo, hi = tablet[0], tablet[0] + tablet[1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self._record(mid)
+            if record[1] < filename_string:
+                lo = mid + 1
+            elif record[1] > filename_string:
+                hi = mid
+            else:
+                return self._entry(filename, record)
+        return None
+
+    def tablet_ids(self):
+        for index in range(self.num_tablets):
+            yield self.string(self._tablet(index)[0])
+
+    def tablet_files(self, tablet_id):
+        """
+        :return: an iterator over (filename, entry) pairs of the given tablet.
+        """
+        tablet = self._find_tablet(tablet_id)
+        if tablet is None:
+            raise KeyError(tablet_id)
+        for index in range(tablet[0], tablet[0] + tablet[1]):
+            record = self._record(index)
+            filename = self.string(record[1])
+            yield filename, self._entry(filename, record)
+
+    def iter_records(self):
+        """
+        :return: an iterator over (tablet_id, filename, entry) tuples in (tablet, filename) order.
+        """
+        for tablet_index in range(self.num_tablets):
+            tablet_string, first_record, num_records = self._tablet(tablet_index)
+            tablet_id = self.string(tablet_string)
+            for index in range(first_record, first_record + num_records):
+                record = self._record(index)
+                filename = self.string(record[1])
+                yield tablet_id, filename, self._entry(filename, record)
+
+    def to_storage_tablet_ids(self):
+        """
+        :return: all entries in the nested dict form of Manifest.storage_tablet_ids.
+        """
+        tablet_ids = {tablet_id: {} for tablet_id in self.tablet_ids()}
+        for tablet_id, filename, entry in self.iter_records():
+            tablet_ids[tablet_id][filename] = entry
+        return tablet_ids
+
+
+class StreamingManifestWriter:
+    """
+    Writes a manifest as newline-delimited JSON, one line per tablet, so entries can be written
+    as soon as a tablet is finalized instead of holding the whole manifest in memory.
+    The first line holds the manifest metadata and the last line the number of tablets and files
+    written, which lets the reader detect truncated files.
+    """
+    def __init__(self, fp, manifest):
+        self.fp = fp
+        self.num_tablets = 0
+        self.num_files = 0
+        header = {MANIFEST_STREAM_KEY: MANIFEST_STREAM_VERSION,
+                  "metadata": manifest.to_json_dict(include_tablet_ids=False)}
+        self.fp.write(json.dumps(header) + '\n')
+
+    def write_tablet(self, tablet_id, files):
+        files = {filename: entry for filename, entry in files.items() if filename != 'DIRECTORY'}
+        self.fp.write(json.dumps({"tablet": tablet_id, "files": files}) + '\n')
+        self.num_tablets += 1
+        self.num_files += len(files)
+
+    def close(self):
+        self.fp.write(json.dumps({"end": {"tablets": self.num_tablets,
+                                          "files": self.num_files}}) + '\n')
+        self.fp.close()
+
+
+class StreamingManifestReader:
+    """
+    Reads a manifest written by StreamingManifestWriter one tablet line at a time. Random access
+    by tablet goes through an index of line offsets, built on first use, so only the offsets and
+    the most recently used tablet are kept in memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'rb')
+        header = json.loads(self._fp.readline())
+        if header.get(MANIFEST_STREAM_KEY, 0) > MANIFEST_STREAM_VERSION:
+            raise BackupException("Streaming manifest {} has unsupported version {}".format(
+                path, header[MANIFEST_STREAM_KEY]))
+        self.metadata = header['metadata']
+        self._data_offset = self._fp.tell()
+        self._tablet_offsets = None
+        self._cached_tablet = (None, None)
+
+    def __deepcopy__(self, memo):
+        # The reader never modifies the file, so copies of a manifest can share it.
+        return self
+
+    def close(self):
+        self._fp.close()
+
+    def _iter_lines(self):
+        """
+        :return: an iterator over (offset, parsed tablet line) pairs.
+        """
+        # Use a separate file object, so that lookups can be done while iterating.
+        with open(self.path, 'rb') as fp:
+            fp.seek(self._data_offset)
+            num_tablets = 0
+            num_files = 0
+            while True:
+                offset = fp.tell()
+                line = fp.readline()
+                if not line:
+                    raise BackupException("Streaming manifest {} is truncated".format(self.path))
+                record = json.loads(line)
+                if 'end' in record:
+                    if record['end'] != {"tablets": num_tablets, "files": num_files}:
+                        raise BackupException(
+                            "Streaming manifest {} is inconsistent: read {} tablets and {} "
+                            "files, expected {}".format(
+                                self.path, num_tablets, num_files, record['end']))
+                    return
+                num_tablets += 1
+                num_files += len(record['files'])
+                yield offset, record
+
+    def _tablet_index(self):
+        if self._tablet_offsets is None:
+            self._tablet_offsets = {record['tablet']: offset
+                                    for offset, record in self._iter_lines()}
+        return self._tablet_offsets
+
+    def _files(self, tablet_id):
+        if self._cached_tablet[0] != tablet_id:
+            offset = self._tablet_index().get(tablet_id)
+            if offset is None:
+                return None
+            self._fp.seek(offset)
+            self._cached_tablet = (tablet_id, json.loads(self._fp.readline())['files'])
+        return self._cached_tablet[1]
+
+    def has_tablet(self, tablet_id):
+        return tablet_id in self._tablet_index()
+
+    def lookup(self, tablet_id, filename):
+        files = self._files(tablet_id)
+        entry = files.get(filename) if files is not None else None
+        return dict(entry) if entry is not None else None
+
+    def tablet_ids(self):
+        return iter(self._tablet_index())
+
+    def tablet_files(self, tablet_id):
+        files = self._files(tablet_id)
+        if files is None:
+            raise KeyError(tablet_id)
+        return ((filename, dict(entry)) for filename, entry in files.items())
+
+    def iter_records(self):
+        """
+        :return: an iterator over (tablet_id, filename, entry) tuples in file order.
+        """
+        for _, record in self._iter_lines():
+            for filename, entry in record['files'].items():
+                yield record['tablet'], filename, entry
+
+    def to_storage_tablet_ids(self):
+        return {record['tablet']: record['files'] for _, record in self._iter_lines()}
+
+
+def is_binary_manifest_file(path):
+    with open(path, 'rb') as fp:
+        return fp.read(len(MANIFEST_BINARY_MAGIC)) == MANIFEST_BINARY_MAGIC
+
+
+def is_streaming_manifest_file(path):
+    prefix = '{{"{}":'.format(MANIFEST_STREAM_KEY).encode('utf-8')
+    with open(path, 'rb') as fp:
+        return fp.read(len(prefix)) == prefix
+
+
+def open_manifest_reader(path):
+    """
+    :return: a reader for the given binary or streaming manifest file, None for a JSON manifest.
+    """
+    if is_binary_manifest_file(path):
+        return BinaryManifestReader(path)
+    if is_streaming_manifest_file(path):
+        return StreamingManifestReader(path)
+    return None
+
+
+def load_manifest_file(path, manifest):
+    """
+    Loads a manifest in any supported format from the given local file into the given manifest.
+    Binary manifests are memory-mapped and streaming manifests are indexed rather than parsed.
+    """
+    reader = open_manifest_reader(path)
+    if reader is not None:
+        manifest.attach_reader(reader)
+    else:
+        with open(path, 'r') as fp:
+            manifest.update_storage_tablet_ids(json.load(fp))
+
+
+def iter_manifest_records(path):
+    """
+    :return: an iterator over (tablet_id, filename, entry) tuples of the given manifest file.
+        Only JSON manifests have to be loaded in full.
+    """
+    reader = open_manifest_reader(path)
+    if reader is None:
+        with open(path, 'r') as fp:
+            tablet_ids = json.load(fp)['manifest']['storage']['tablet_ids']
+        return ((tablet_id, filename, entry)
+                for tablet_id, files in tablet_ids.items()
+                for filename, entry in files.items())
+    return reader.iter_records()
+
+
+def write_manifest_file(path, manifest, manifest_format):
+    """
+    Writes the manifest to the given local file. The file is replaced atomically, so that readers
+    that memory-mapped a previous version of it keep seeing consistent data.
+    """
+    tmp_path = path + '.tmp'
+    if manifest_format == MANIFEST_FORMAT_BINARY:
+        with open(tmp_path, 'wb') as fp:
+            BinaryManifestCodec.write(fp, manifest)
+    elif manifest_format == MANIFEST_FORMAT_STREAM:
+        writer = StreamingManifestWriter(open(tmp_path, 'w'), manifest)
+        for tablet_id, files in manifest.iter_tablets():
+            writer.write_tablet(tablet_id, files)
+        writer.close()
+    elif manifest_format == MANIFEST_FORMAT_JSON:
+        with open(tmp_path, 'w') as fp:
+            json.dump(manifest.to_json_dict(), fp)
+    else:
+        raise BackupException("Unknown manifest format: {}".format(manifest_format))
+    os.replace(tmp_path, path)
+
+
+def is_sst_file(filename):
+    return filename.find(".sst") != -1
+
+
+class ManifestShardCodec:
+    """
+    Sharded manifest layout: a small JSON root manifest plus content-addressed fragments.
+
+    SST entries, which the differential backup carries over from backup to backup, go to one
+    of num_shards fragments by a hash of their tablet id. All other files are copied by every
+    backup, so they go to a single 'other' fragment, which also lists every tablet.
+    Fragments store, instead of the generation, the savepoint number at which the entry was
+    written, so a fragment whose tablets did not change encodes to the same bytes in the next
+    backup. Such a fragment is referenced by its hash instead of being uploaded again.
+    """
+    OTHER_SHARD = 'other'
+    # Fields that are derived when decoding a fragment.
+    DERIVED_FIELDS = ('filename', 'generation', 'action')
+
+    @classmethod
+    def shard_name(cls, tablet_id, filename, num_shards):
+        if not is_sst_file(filename):
+            return cls.OTHER_SHARD
+        return 'sst-{}'.format(zlib.crc32(tablet_id.encode('utf-8')) % num_shards)
+
+    @staticmethod
+    def content_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @classmethod
+    def encode(cls, manifest, num_shards):
+        """
+        :return: a map from shard name to the encoded fragment.
+        """
+        savepoint = manifest.manifest_savepoint_number
+        shards = {cls.OTHER_SHARD: {}}
+        for tablet_id, files in manifest.iter_tablets():
+            shards[cls.OTHER_SHARD].setdefault(tablet_id, {})
+            for filename, entry in files.items():
+                if filename == 'DIRECTORY':
+                    continue
+                shard_entry = {k: v for k, v in entry.items() if k not in cls.DERIVED_FIELDS}
+                shard_entry['written_at'] = savepoint - entry.get('generation', 1) + 1
+                shard = shards.setdefault(cls.shard_name(tablet_id, filename, num_shards), {})
+                shard.setdefault(tablet_id, {})[filename] = shard_entry
+        return {name: json.dumps({"tablets": tablets}, sort_keys=True,
+                                 separators=(',', ':')).encode('utf-8')
+                for name, tablets in shards.items()}
+
+    @staticmethod
+    def decode(data, savepoint):
+        """
+        :return: the entries of the fragment in the nested dict form of
+            Manifest.storage_tablet_ids, with generations relative to the given savepoint number.
+        """
+        tablet_ids = json.loads(data.decode('utf-8'))['tablets']
+        for files in tablet_ids.values():
+            for filename, entry in files.items():
+                entry['filename'] = filename
+                entry['generation'] = savepoint - entry.pop('written_at') + 1
+        return tablet_ids
+
+
+class ManifestCache:
+    """
+    Local directory of previously used manifests, in binary form, so that a differential backup
+    run from the same host finds the manifests it wrote before without downloading and parsing
+    them. Every entry is keyed by the manifest location and only used while the object at that
+    location has the version it had when it was cached.
+    """
+    MANIFEST_SUFFIX = '.manifest'
+    INFO_SUFFIX = '.json'
+
+    def __init__(self, cache_dir, max_age_seconds, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, location):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha256(location.encode('utf-8')).hexdigest())
+
+    def lookup(self, location, version):
+        """
+        :return: the path of the cached binary manifest, or None if the cache does not have
+            the given version of the manifest.
+        """
+        path = self._path(location)
+        try:
+            with open(path + self.INFO_SUFFIX) as fp:
+                info = json.load(fp)
+        except (IOError, OSError, ValueError):
+            info = None
+        if (info is None or info.get('location') != location or
+                info.get('version') != version or
+                not os.path.exists(path + self.MANIFEST_SUFFIX)):
+            self.misses += 1
+            return None
+        # The modification time of the info file is the last use of the entry.
+        os.utime(path + self.INFO_SUFFIX, None)
+        self.hits += 1
+        return path + self.MANIFEST_SUFFIX
+
+    def store(self, location, version, manifest):
+        path = self._path(location)
+        write_manifest_file(path + self.MANIFEST_SUFFIX, manifest, MANIFEST_FORMAT_BINARY)
+        with open(path + self.INFO_SUFFIX + '.tmp', 'w') as fp:
+            json.dump({"location": location, "version": version}, fp)
+        os.replace(path + self.INFO_SUFFIX + '.tmp', path + self.INFO_SUFFIX)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the entries not used for max_age_seconds, then the least recently used entries
+        until the cache fits in max_bytes.
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.INFO_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, name[:-len(self.INFO_SUFFIX)])
+            try:
+                last_used = os.path.getmtime(path + self.INFO_SUFFIX)
+                size = os.path.getsize(path + self.MANIFEST_SUFFIX)
+            except OSError:
+                last_used, size = 0, 0
+            entries.append((last_used, size, path))
+        entries.sort(reverse=True)
+        total_bytes = 0
+        for last_used, size, path in entries:
+            total_bytes += size
+            if now - last_used > self.max_age_seconds or total_bytes > self.max_bytes:
+                logging.info("Evicting cached manifest {}".format(path))
+                for suffix in (self.INFO_SUFFIX, self.MANIFEST_SUFFIX):
+                    if os.path.exists(path + suffix):
+                        # Readers that mapped the file keep their mapping.
+                        os.remove(path + suffix)
+                total_bytes -= size
+
+
+class DataDirCache:
+    """
+    The data directories of the tablet servers, so that /varz is read once per tablet server
+    instead of once per phase. With a state file, entries are kept between runs on this host.
+    Entries older than max_age_seconds are read again, and so are entries a command failed on.
+    Thread-safe.
+    """
+    def __init__(self, path, max_age_seconds):
+        """
+        :param path: the local state file, or None to keep the entries for this run only
+        """
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Tablet server to {"data_dirs": [...], "time": seconds since the epoch}.
+        self.entries = {}
+        if path is not None:
+            try:
+                with open(path) as fp:
+                    self.entries = json.load(fp)["tservers"]
+            except (IOError, OSError, ValueError, KeyError, TypeError) as ex:
+                if os.path.exists(path):
+                    logging.info("Ignoring data dir cache {}: {}".format(path, ex))
+
+    def _fresh_entry(self, tserver):
+        entry = self.entries.get(tserver)
+        if entry is None or time.time() - entry["time"] > self.max_age_seconds:
+            return None
+        return entry
+
+    def __contains__(self, tserver):
+        with self.lock:
+            return self._fresh_entry(tserver) is not None
+
+    def get(self, tserver):
+        """
+        :return: the cached data directories of the tablet server, or None
+        """
+        with self.lock:
+            entry = self._fresh_entry(tserver)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(entry["data_dirs"])
+
+    def put(self, tserver, data_dirs):
+        with self.lock:
+            self.entries[tserver] = {"data_dirs": list(data_dirs), "time": time.time()}
+            self._save()
+
+    def invalidate(self, tserver):
+        with self.lock:
+            if self.entries.pop(tserver, None) is not None:
+                self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w') as fp:
+            json.dump({"tservers": self.entries}, fp)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def master_json_parser(fn):
+    """
+    Raises the errors of a parser of master JSON that does not have the expected schema as
+    BackupException, so its callers fall back to yb-admin.
+    """
+    @functools.wraps(fn)
+    def parse(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except (KeyError, TypeError, AttributeError, ValueError) as ex:
+            raise BackupException("Unexpected master JSON in {}: {!r}".format(fn.__name__, ex))
+    return parse
+
+
+class MasterHttpClient:
+    """
+    Reads the state of the cluster from the JSON endpoints of the master web servers, instead of
+    running yb-admin on the master leader. Connections are kept alive and reused by all threads.
+    Every failure raises a BackupException, so that the caller can fall back to yb-admin.
+    """
+    def __init__(self, web_addresses, timeout_sec=MASTER_HTTP_TIMEOUT_SEC):
+        """
+        :param web_addresses: host:port of the web server of every master
+        """
+        self.web_addresses = web_addresses
+        self.timeout_sec = timeout_sec
+        self.leader_address = None
+        self.lock = threading.Lock()
+        # Web address to the connections not used by any thread.
+        self.idle_connections = {}
+        self.num_connections = 0
+        self.num_requests = 0
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle_connections.values():
+                for connection in connections:
+                    connection.close()
+            self.idle_connections = {}
+
+    def request(self, address, path):
+        """
+        Sends a GET request on an idle connection to the given server, or on a new one.
+        :return: the status and the body of the response
+        """
+        with self.lock:
+            self.num_requests += 1
+            idle = self.idle_connections.get(address)
+            connection = idle.pop() if idle else None
+        if connection is not None:
+            try:
+                return self.send(address, connection, path)
+            except (OSError, http.client.HTTPException):
+                # The server may have closed the idle connection.
+                connection.close()
+
+        with self.lock:
+            self.num_connections += 1
+        connection = http.client.HTTPConnection(address, timeout=self.timeout_sec)
+        try:
+            return self.send(address, connection, path)
+        except (OSError, http.client.HTTPException) as ex:
+            connection.close()
+            raise BackupException("GET http://{}{} failed: {!r}".format(address, path, ex))
+
+    def send(self, address, connection, path):
+        connection.request('GET', path, headers={'Accept': 'application/json'})
+        response = connection.getresponse()
+        body = response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            with self.lock:
+                self.idle_connections.setdefault(address, []).append(connection)
+        return response.status, body
+
+    def find_leader(self):
+        """
+        :return: the web address of the master leader
+        """
+        leader_address = self.leader_address
+        if leader_address is None:
+            for address in self.web_addresses:
+                try:
+                    (status, _) = self.request(address, '/api/v1/is-leader')
+                except BackupException as ex:
+                    logging.warning("Master {} is not reachable: {}".format(address, ex))
+                    continue
+                if status == 200:
+                    leader_address = address
+                    break
+            else:
+                raise BackupException("None of the masters {} is the leader".format(
+                    self.web_addresses))
+            self.leader_address = leader_address
+        return leader_address
+
+    def get_json(self, path):
+        """
+        :return: the parsed JSON response of the master leader to a GET request
+        """
+        address = self.find_leader()
+        (status, body) = self.request(address, path)
+        if status != 200:
+            # The leader may have moved.
+            self.leader_address = None
+            raise BackupException("GET http://{}{} returned HTTP {}".format(address, path, status))
+        try:
+            return json.loads(body.decode('utf-8'))
+        except ValueError as ex:
+            raise BackupException("GET http://{}{} did not return JSON: {!r}".format(
+                address, path, ex))
+
+    @master_json_parser
+    def list_tservers(self):
+        """
+        :return: a list of (web host, web port, state) tuples of all tablet servers
+        """
+        # {"<cluster uuid>": {"<host>:<web port>": {"status": "ALIVE", ...}, ...}}
+        tservers = []
+        for by_address in self.get_json('/api/v1/tablet-servers').values():
+            for address, tserver in by_address.items():
+                (host, port) = address.rsplit(':', 1)
+                tservers.append((host, port, tserver.get('status')))
+        return tservers
+
+    def dump_entities(self):
+        """
+        :return: the keyspaces, tables and tablets with their replicas, see find_table_id(),
+                 tablet_leaders() and tablet_replicas()
+        """
+        return self.get_json('/dump-entities')
+
+    @staticmethod
+    @master_json_parser
+    def find_table_id(entities, keyspace, table_name):
+        """
+        :param keyspace: the keyspace as given to yb-admin, with an optional ysql. prefix
+        :return: the id of the running table with the given name
+        """
+        # {"keyspaces": [{"keyspace_id": ..., "keyspace_name": ..., "keyspace_type": "ysql"}],
+        #  "tables": [{"table_id": ..., "keyspace_id": ..., "table_name": ..., "state": ...}]}
+        keyspace_ids = set(entry['keyspace_id'] for entry in entities['keyspaces']
+                           if entry['keyspace_name'] == keyspace_name(keyspace) and
+                           entry['keyspace_type'] == keyspace_type(keyspace))
+        table_ids = [entry['table_id'] for entry in entities['tables']
+                     if entry['table_name'] == table_name and
+                     entry['keyspace_id'] in keyspace_ids and
+                     entry.get('state', 'RUNNING') == 'RUNNING']
+        if len(table_ids) != 1:
+            raise BackupException("Found {} tables named {}.{} in the master entities".format(
+                len(table_ids), keyspace, table_name))
+        return table_ids[0]
+
+    @staticmethod
+    @master_json_parser
+    def tablet_leaders(entities, table_id):
+        """
+        :return: a list of (tablet id, leader host) tuples of the running tablets of the table
+        """
+        # {"tablets": [{"table_id": ..., "tablet_id": ..., "state": "RUNNING", "leader": <uuid>,
+        #               "replicas": [{"type": "VOTER", "server_uuid": ..., "addr": ...}]}]}
+        tablet_leaders = []
+        for tablet in entities['tablets']:
+            if tablet['table_id'] != table_id or tablet.get('state', 'RUNNING') != 'RUNNING':
+                continue
+            addresses = dict((replica['server_uuid'], replica['addr'])
+                             for replica in tablet.get('replicas', []))
+            leader_address = addresses.get(tablet.get('leader'))
+            if leader_address is None:
+                raise BackupException("Tablet {} has no leader".format(tablet['tablet_id']))
+            tablet_leaders.append((tablet['tablet_id'], leader_address.rsplit(':', 1)[0]))
+        if not tablet_leaders:
+            raise BackupException("Table {} has no running tablets".format(table_id))
+        return tablet_leaders
+
+    @staticmethod
+    @master_json_parser
+    def tablet_replicas(entities, tablet_ids):
+        """
+        :return: a map from each of the given tablets to the hosts of its replicas
+        """
+        replicas = {}
+        for tablet in entities['tablets']:
+            if tablet['tablet_id'] in tablet_ids:
+                replicas[tablet['tablet_id']] = [replica['addr'].rsplit(':', 1)[0]
+                                                 for replica in tablet.get('replicas', [])]
+        missing = [tablet_id for tablet_id in tablet_ids if tablet_id not in replicas]
+        if missing:
+            raise BackupException("Tablets {} are not in the master entities".format(missing))
+        return replicas
+
+
+class BackupChainCatalog:
+    """
+    List of the backups of a differential backup chain, from the full backup to the latest one.
+    Every backup stores the catalog of its chain in CHAIN_CATALOG next to its MANIFEST, so the
+    restore point manifests are found with one read instead of following manifest_previous
+    links one download at a time.
+    Every entry has the location, the manifest id and savepoint number and summary stats of the
+    backup.
+    """
+    def __init__(self, entries=None):
+        self.entries = entries if entries is not None else []
+
+    @classmethod
+    def from_json_dict(cls, catalog_dict):
+        if catalog_dict.get('chain_catalog') != CHAIN_CATALOG_VERSION:
+            raise BackupException("Unsupported chain catalog version: {}".format(
+                catalog_dict.get('chain_catalog')))
+        return cls(catalog_dict['backups'])
+
+    def to_json_dict(self):
+        return {"chain_catalog": CHAIN_CATALOG_VERSION, "backups": self.entries}
+
+    def add(self, manifest, stats=None):
+        self.entries.append({"location": manifest.manifest_location,
+                             "manifest_id": manifest.manifest_id,
+                             "savepoint": manifest.manifest_savepoint_number,
+                             "stats": stats or {}})
+
+    def ancestors(self, location, count):
+        """
+        :return: the entries of the backup at the given location and of up to count - 1 backups
+            before it, latest first, or None if the catalog does not have the location.
+        """
+        for index in range(len(self.entries) - 1, -1, -1):
+            if self.entries[index]['location'].rstrip('/') == location.rstrip('/'):
+                return self.entries[max(0, index - count + 1):index + 1][::-1]
+        return None
+
+
+class DedupIndex:
+    """
+    Index of a content-addressed dedup store: the sorted SHA-256 digests of the stored objects.
+    The file is memory-mapped and binary-searched like the binary manifest.
+
+    Objects are named by their digest, so an index that misses objects uploaded concurrently by
+    another backup only costs uploading the same bytes to the same key again.
+
+    Layout: HEADER (magic, version, reserved, number of digests), then the 32-byte digests.
+    """
+    MAGIC = b'YBDEDUPX'
+    VERSION = 1
+    HEADER = struct.Struct('<8sHHQ')
+    DIGEST_SIZE = 32
+
+    def __init__(self, path=None):
+        self.num_digests = 0
+        self._buf = None
+        # Content keys added in this run.
+        self.added = set()
+        if path is None or not os.path.exists(path) or os.path.getsize(path) == 0:
+            return
+        with open(path, 'rb') as fp:
+            self._buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._buf) < self.HEADER.size:
+            raise BackupException("Dedup index {} is truncated".format(path))
+        magic, version, _, self.num_digests = self.HEADER.unpack_from(self._buf, 0)
+        if magic != self.MAGIC or version > self.VERSION:
+            raise BackupException("{} is not a supported dedup index".format(path))
+        if len(self._buf) < self.HEADER.size + self.DIGEST_SIZE * self.num_digests:
+            raise BackupException("Dedup index {} is truncated".format(path))
+
+    def _digest(self, index):
+        offset = self.HEADER.size + self.DIGEST_SIZE * index
+        return self._buf[offset:offset + self.DIGEST_SIZE]
+
+    def iter_digests(self):
+        for index in range(self.num_digests):
+            yield self._digest(index)
+
+    def __contains__(self, content_key):
+        if content_key in self.added:
+            return True
+        digest = bytes.fromhex(content_key)
+        lo, hi = 0, self.num_digests
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_digest = self._digest(mid)
+            if mid_digest < digest:
+                lo = mid + 1
+            elif mid_digest > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def add(self, content_key):
+        self.added.add(content_key)
+
+    def write(self, path, other=None):
+        """
+        Atomically writes the digests of this index, including the added ones, merged with the
+        digests of another index.
+        """
+        sources = [self.iter_digests(), iter(sorted(bytes.fromhex(key) for key in self.added))]
+        if other is not None:
+            sources.append(other.iter_digests())
+        num_digests = 0
+        last = None
+        with open(path + '.tmp', 'wb') as fp:
+            fp.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0, 0))
+            for digest in heapq.merge(*sources):
+                if digest != last:
+                    fp.write(digest)
+                    num_digests += 1
+                    last = digest
+            fp.seek(0)
+            fp.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0, num_digests))
+        os.replace(path + '.tmp', path)
+
+
+# A file found in a snapshot directory on a tserver.
+SnapshotFile = collections.namedtuple(
+    'SnapshotFile', ['path', 'device', 'inode', 'size', 'mtime'])
+# What discover_snapshot() found on a tserver. snapshot_dirs and files map a data directory to
+# the snapshot directory paths and the SnapshotFile records under it.
+SnapshotDiscovery = collections.namedtuple(
+    'SnapshotDiscovery', ['data_dirs', 'snapshot_dirs', 'files'])
+
+
+class FileEntry(object):
+    """
+    One snapshot file of a tablet as seen by the diff engine. The manifest stores the same
+    fields as a dict, FileEntry.from_dict and to_dict convert between the two.
+    """
+    __slots__ = ('tablet_id', 'filename', 'generation', 'src_location', 'action', 'content_key',
+                 'size', 'inode', 'shared_with')
+
+    def __init__(self, tablet_id, filename, src_location, generation=1,
+                 action=ACTION_CODE_NONE, content_key=None, size=None, inode=None):
+        self.tablet_id = tablet_id
+        self.filename = filename
+        self.src_location = src_location
+        self.generation = generation
+        self.action = action
+        # SHA-256 of the file when it is stored in the dedup store.
+        self.content_key = content_key
+        # Size of the file in bytes, used to schedule transfers.
+        self.size = size
+        # (tserver, device, inode) of the snapshot file, identifying hard links.
+        self.inode = inode
+        # The entry whose object this entry references instead of uploading its own.
+        self.shared_with = None
+
+    @classmethod
+    def from_dict(cls, tablet_id, entry):
+        return cls(tablet_id, entry['filename'], entry.get('src_location'),
+                   entry.get('generation', 1), ACTION_TO_CODE[entry.get('action')],
+                   entry.get('content_key'), entry.get('size'))
+
+    def to_dict(self):
+        entry = {"filename": self.filename, "generation": self.generation,
+                 "src_location": self.src_location}
+        if self.action != ACTION_CODE_NONE:
+            entry["action"] = CODE_TO_ACTION[self.action]
+        if self.content_key is not None:
+            entry["content_key"] = self.content_key
+        if self.size is not None:
+            entry["size"] = self.size
+        return entry
+
+    def __repr__(self):
+        return 'FileEntry({}/{}, generation={}, src_location={}, action={})'.format(
+            self.tablet_id, self.filename, self.generation, self.src_location,
+            CODE_TO_ACTION[self.action])
+
+
+class TabletEntry(object):
+    """
+    The snapshot files of one tablet, keyed by file name.
+    :ivar directory: whether the whole snapshot directory of the tablet is uploaded at once
+    """
+    __slots__ = ('tablet_id', 'files', 'directory')
+
+    def __init__(self, tablet_id):
+        self.tablet_id = tablet_id
+        self.files = {}
+        self.directory = False
+
+    def add_file(self, filename, src_location, inode=None, size=None):
+        self.files[filename] = FileEntry(
+            self.tablet_id, filename, src_location, size=size, inode=inode)
+
+    def to_dict(self):
+        """
+        :return: the files in the form of one tablet of Manifest.storage_tablet_ids
+        """
+        files = {filename: entry.to_dict() for filename, entry in self.files.items()}
+        if self.directory:
+            files['DIRECTORY'] = {}
+        return files
+
+    def __repr__(self):
+        return 'TabletEntry({}, {})'.format(self.tablet_id, list(self.files.values()))
+
+
+def tablet_entries_to_storage_tablet_ids(tablets):
+    """
+    Converts the TabletEntry objects to the form of Manifest.storage_tablet_ids. The tablets are
+    removed from the given map as they are converted, so both forms are not held at once.
+    """
+    storage_tablet_ids = {}
+    for tablet_id in list(tablets):
+        storage_tablet_ids[tablet_id] = tablets.pop(tablet_id).to_dict()
+    return storage_tablet_ids
+
+
+def diff_tablet_entries(tablets, prev_manifest, restore_points):
+    """
+    Decides the action of every current file of a differential backup. SST files found in the
+    previous manifest are kept where they are, or moved into this backup once they are as old as
+    the oldest restore point. Files in the dedup store are never moved. All other files are
+    copied.
+    :param tablets: map from tablet id to TabletEntry of the current snapshot, updated in place
+    :param prev_manifest: the Manifest of the previous backup
+    :param restore_points: the number of restore points to keep
+    :return: the number of new SST files, the number of unchanged SST files and a list of the
+        FileEntry objects to move
+    """
+    num_new = 0
+    num_unchanged = 0
+    moved = []
+    # Sorted tablets are read one after another, which suits the streaming reader.
+    for tablet_id in sorted(tablets):
+        files = tablets[tablet_id].files
+        if not files:
+            continue
+        # One read of the previous tablet is cheaper than a lookup per file.
+        try:
+            prev_files = dict(prev_manifest.tablet_files(tablet_id))
+        except KeyError:
+            prev_files = {}
+        for entry in files.values():
+            if not is_sst_file(entry.filename):
+                entry.action = ACTION_CODE_COPY
+                continue
+            prev_entry = prev_files.get(entry.filename)
+            if prev_entry is None:
+                entry.action = ACTION_CODE_COPY
+                num_new += 1
+                continue
+            num_unchanged += 1
+            entry.src_location = prev_entry['src_location']
+            entry.content_key = prev_entry.get('content_key')
+            if entry.content_key is None and restore_points <= prev_entry['generation']:
+                entry.action = ACTION_CODE_MOVE
+                entry.generation = 1
+                moved.append(entry)
+            else:
+                entry.action = ACTION_CODE_NOOP
+                entry.generation = prev_entry['generation'] + 1
+    return num_new, num_unchanged, moved
+
+
+def tablet_entries_stats(tablets):
+    """
+    :return: the summary stats of the planned backup kept in the chain catalog.
+    """
+    stats = {"tablets": len(tablets), "files": 0, "copied": 0, "moved": 0}
+    for tablet in tablets.values():
+        stats["files"] += len(tablet.files)
+        for entry in tablet.files.values():
+            if entry.action == ACTION_CODE_COPY:
+                stats["copied"] += 1
+            elif entry.action == ACTION_CODE_MOVE:
+                stats["moved"] += 1
+    return stats
+
+
+def share_physical_files(tablets, first_entries=None):
+    """
+    Makes every physical file go to the backup storage once. Snapshot files of different tablets
+    that are the same file on the tserver, like the SST files the children of a split tablet
+    hard link from their parent, are copied only for the first tablet. Entries that would move
+    the same object are moved only for the first tablet. The other entries reference the object
+    of the first one through shared_with, and their tablets are uploaded file by file.
+    :param tablets: a map from tablet id to TabletEntry, updated in place
+    :param first_entries: the entries of the tablets shared with before, updated in place, for
+        tablets planned in several parts
+    :return: the number of entries referencing the object of another entry
+    """
+    if first_entries is None:
+        first_entries = {}
+    num_shared = 0
+    for tablet_id in sorted(tablets):
+        tablet = tablets[tablet_id]
+        for filename in sorted(tablet.files):
+            entry = tablet.files[filename]
+            if not is_sst_file(filename):
+                continue
+            if entry.action == ACTION_CODE_COPY and entry.inode is not None:
+                key = (ACTION_CODE_COPY, entry.inode)
+            elif entry.action == ACTION_CODE_MOVE:
+                key = (ACTION_CODE_MOVE, entry.src_location)
+            else:
+                continue
+            first_entry = first_entries.setdefault(key, entry)
+            if first_entry is not entry:
+                entry.action = ACTION_CODE_NOOP
+                entry.shared_with = first_entry
+                tablet.directory = False
+                num_shared += 1
+    return num_shared
+
+
+def parse_snapshot_discovery(data_dirs, output):
+    """
+    :param data_dirs: the data directories the discovery walked
+    :param output: the output of the find command run by discover_snapshot()
+    :return: a SnapshotDiscovery
+    """
+    snapshot_dirs = dict((data_dir, []) for data_dir in data_dirs)
+    files = dict((data_dir, []) for data_dir in data_dirs)
+    for line in output.split('\n'):
+        fields = line.rstrip('\r').split('\t', 6)
+        if len(fields) != 7:
+            continue
+        (kind, data_dir, device, inode, size, mtime, path) = fields
+        if kind == 'd':
+            snapshot_dirs.setdefault(data_dir, []).append(path)
+        elif kind == 'f':
+            files.setdefault(data_dir, []).append(
+                SnapshotFile(path, int(device), int(inode), int(size), float(mtime)))
+    return SnapshotDiscovery(data_dirs, snapshot_dirs, files)
+
+
+def find_snapshot_block(output, snapshot_id):
+    """
+    Finds one snapshot in the output of yb-admin list_snapshots [SHOW_DETAILS] without splitting
+    or parsing the lines of the other snapshots. Expected format:
+    Snapshot UUID                         State
+    0436035d-c4c5-40c6-b45b-19538849b0d9  COMPLETE
+      {"type":"NAMESPACE","id":"e4c5591446db417f83a52c679de03118","data":{"name":"a",...}}
+      {"type":"TABLE","id":"d9603c2cab0b48ec807936496ac0e70e","data":{"name":"t2",...}}
+    c1ad61bf-a42b-4bbb-94f9-28516985c2c5  COMPLETE
+      ...
+    :param output: the output of list_snapshots
+    :param snapshot_id: the snapshot to look for
+    :return: the state of the snapshot, or None if it is not listed, and the indented detail
+             lines that follow it
+    """
+    start = 0
+    while True:
+        index = output.find(snapshot_id, start)
+        if index < 0:
+            return None, []
+        start = index + len(snapshot_id)
+        if index > 0 and output[index - 1] != '\n':
+            continue
+        end = output.find('\n', index)
+        if end < 0:
+            end = len(output)
+        fields = output[index:end].split()
+        if fields[0] == snapshot_id and len(fields) > 1:
+            break
+
+    details = []
+    while end < len(output):
+        line_start = end + 1
+        end = output.find('\n', line_start)
+        if end < 0:
+            end = len(output)
+        line = output[line_start:end].rstrip('\r')
+        if not line.startswith(' '):
+            break
+        details.append(line)
+    return fields[1], details
+
+
+def backoff_delays(initial_sec, max_sec, factor=2, jitter=0.2):
+    """
+    :param initial_sec: the first delay
+    :param max_sec: the delay stops growing at this value
+    :param factor: each delay is this many times the previous one
+    :param jitter: each delay is randomly changed by up to this fraction, so that concurrent
+                   pollers do not hit the server at the same moments
+    :return: an endless generator of delays in seconds
+    """
+    delay = initial_sec
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * factor, max_sec)
+
+
 def split_by_tab(line):
     return [item.replace(' ', '') for item in line.split("\t")]
 
@@ -227,6 +1656,209 @@ def quote_cmd_line_for_bash(cmd_line):
     return ' '.join([pipes.quote(str(arg)) for arg in cmd_line])
 
 
+class SshConnectionPool:
+    """
+    Keeps one persistent SSH master connection per server, so that ssh and scp commands run over
+    it instead of making a connection each. Commands fall back to a connection of their own when
+    the master cannot be opened.
+    """
+    MASTER_TIMEOUT_SEC = 60
+
+    def __init__(self, ssh_args, ssh_program='ssh'):
+        """
+        :param ssh_args: the ssh options and the user, e.g. ['-i', key, '-p', port, '-l', user]
+        :param ssh_program: the ssh client to run
+        """
+        self.ssh_args = list(ssh_args)
+        self.ssh_program = ssh_program
+        # ssh expands %C to a hash of the local host, remote host, port and user. Unix socket
+        # paths are short, so stay out of deep temporary directories.
+        self.control_dir = tempfile.mkdtemp(prefix='yb_ssh_', dir='/tmp')
+        self.control_path = os.path.join(self.control_dir, '%C')
+        self.lock = threading.Lock()
+        self.server_locks = {}
+        # Server to True if its master is open, False if it could not be opened.
+        self.masters = {}
+        self.num_handshakes = 0
+        self.handshake_seconds = 0.0
+        self.num_reused = 0
+        self.num_failed = 0
+
+    def control_options(self, server_ip):
+        """
+        Opens the master connection to the given server unless it is open.
+        :return: the ssh options that make a command use the master connection
+        """
+        with self.lock:
+            server_lock = self.server_locks.setdefault(server_ip, threading.Lock())
+        with server_lock:
+            if server_ip not in self.masters:
+                self.masters[server_ip] = self.open_master(server_ip)
+            if not self.masters[server_ip]:
+                return []
+        with self.lock:
+            self.num_reused += 1
+        # With ControlMaster=no a command connects by itself if the master went away.
+        return ['-o', 'ControlMaster=no', '-o', 'ControlPath=' + self.control_path]
+
+    def open_master(self, server_ip):
+        """
+        :return: whether a master connection to the given server is open
+        """
+        args = ([self.ssh_program, '-M', '-N', '-f',
+                 '-o', 'ControlPersist=yes', '-o', 'ControlPath=' + self.control_path] +
+                self.ssh_args + [server_ip])
+        start_time = time.time()
+        # The backgrounded master keeps stderr open, so it must not be a pipe we wait on.
+        with tempfile.TemporaryFile() as err:
+            try:
+                returncode = subprocess.call(args, stdin=subprocess.DEVNULL,
+                                             stdout=subprocess.DEVNULL, stderr=err,
+                                             timeout=self.MASTER_TIMEOUT_SEC)
+            except (OSError, subprocess.TimeoutExpired) as ex:
+                returncode, message = None, str(ex)
+            else:
+                err.seek(0)
+                message = err.read().decode('utf-8', 'replace').strip()
+        elapsed = time.time() - start_time
+        with self.lock:
+            self.num_handshakes += 1
+            self.handshake_seconds += elapsed
+            if returncode != 0:
+                self.num_failed += 1
+        if returncode != 0:
+            logging.warning("Could not open an SSH master connection to {}, running commands "
+                            "without it: {}".format(server_ip, message))
+            return False
+        logging.info("Opened an SSH master connection to {} in {:.3f} sec".format(
+            server_ip, elapsed))
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {"handshakes": self.num_handshakes,
+                    "handshake_seconds": self.handshake_seconds,
+                    "reused": self.num_reused,
+                    "failed": self.num_failed}
+
+    def close(self):
+        """
+        Closes the master connections and logs how many connections they saved.
+        """
+        for server_ip, is_open in sorted(self.masters.items()):
+            if not is_open:
+                continue
+            try:
+                subprocess.call(
+                    [self.ssh_program, '-O', 'exit', '-o', 'ControlPath=' + self.control_path] +
+                    self.ssh_args + [server_ip],
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL, timeout=self.MASTER_TIMEOUT_SEC)
+            except (OSError, subprocess.TimeoutExpired) as ex:
+                logging.warning("Could not close the SSH master connection to {}: {}".format(
+                    server_ip, ex))
+        self.masters = {}
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        stats = self.stats()
+        if stats["handshakes"]:
+            logging.info(
+                "SSH connection pool: {} handshakes ({} failed) in {:.3f} sec, "
+                "{} commands ran over them".format(
+                    stats["handshakes"], stats["failed"], stats["handshake_seconds"],
+                    stats["reused"]))
+
+
+class NativeSshExecutor:
+    """
+    Runs remote commands in this process over one authenticated SSH transport per server, each
+    command on a channel of its own, instead of running an ssh client per command.
+    """
+    # The default MaxSessions of sshd.
+    MAX_CHANNELS_PER_SERVER = 10
+    READ_SIZE = 65536
+
+    def __init__(self, connect_fn, max_channels=MAX_CHANNELS_PER_SERVER):
+        """
+        :param connect_fn: function from a server to a new authenticated transport, which has
+            the open_session(), is_active() and close() methods of paramiko.Transport
+        :param max_channels: the number of commands run on a server at once
+        """
+        self.connect_fn = connect_fn
+        self.max_channels = max_channels
+        self.lock = threading.Lock()
+        self.server_locks = {}
+        self.channel_semaphores = {}
+        self.transports = {}
+        self.num_connects = 0
+        self.num_commands = 0
+
+    def get_transport(self, server_ip):
+        with self.lock:
+            server_lock = self.server_locks.setdefault(server_ip, threading.Lock())
+            channel_semaphore = self.channel_semaphores.setdefault(
+                server_ip, threading.BoundedSemaphore(self.max_channels))
+        with server_lock:
+            transport = self.transports.get(server_ip)
+            if transport is None or not transport.is_active():
+                transport = self.connect_fn(server_ip)
+                self.transports[server_ip] = transport
+                with self.lock:
+                    self.num_connects += 1
+        return transport, channel_semaphore
+
+    def iter_output(self, server_ip, cmd, stdin_data=None):
+        """
+        Runs the given shell command on the given server.
+        :param stdin_data: bytes to send to the standard input of the command
+        :return: a generator of the bytes the command writes to stdout and stderr. It raises
+            subprocess.CalledProcessError with the whole output if the command fails.
+        """
+        transport, channel_semaphore = self.get_transport(server_ip)
+        with channel_semaphore:
+            channel = transport.open_session()
+            with self.lock:
+                self.num_commands += 1
+            try:
+                # Like the stderr=subprocess.STDOUT of run_program().
+                channel.set_combine_stderr(True)
+                channel.exec_command(cmd)
+                if stdin_data is not None:
+                    channel.sendall(stdin_data)
+                    channel.shutdown_write()
+                output = []
+                while True:
+                    data = channel.recv(self.READ_SIZE)
+                    if not data:
+                        break
+                    output.append(data)
+                    yield data
+                returncode = channel.recv_exit_status()
+            finally:
+                channel.close()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, output=b''.join(output))
+
+    def run(self, server_ip, cmd, stdin_data=None):
+        """
+        :return: the output of the given shell command run on the given server, as bytes
+        """
+        return b''.join(self.iter_output(server_ip, cmd, stdin_data))
+
+    def close(self):
+        with self.lock:
+            transports = list(self.transports.items())
+            self.transports = {}
+        for server_ip, transport in transports:
+            try:
+                transport.close()
+            except Exception as ex:
+                logging.warning("Could not close the SSH transport to {}: {}".format(
+                    server_ip, ex))
+        if self.num_connects:
+            logging.info("Native SSH executor: {} connections, {} commands".format(
+                self.num_connects, self.num_commands))
+
+
 class BackupTimer:
     def __init__(self):
         # Store the start time as phase 0.
@@ -260,6 +1892,98 @@ class BackupTimer:
         logging.info("[app] " + log_str)
 
 
+class AsyncCmdEngine:
+    """
+    Runs the functions of the parallel commands on an asyncio event loop. Coroutine functions,
+    like run_ssh_cmd_async(), run on the loop itself, so that thousands of remote commands can be
+    in flight without a thread each. Other functions run on a pool of worker threads. Has the
+    map() of ThreadPool, so it can be passed to the parallel commands instead of one.
+    """
+    MAX_LABEL_LEN = 200
+
+    def __init__(self, num_threads, max_in_flight):
+        """
+        :param num_threads: the number of worker threads for functions that are not coroutines
+        :param max_in_flight: the number of tasks of a map() run at once
+        """
+        self.executor = concurrent.futures.ThreadPoolExecutor(num_threads)
+        self.max_in_flight = max_in_flight
+        self.lock = threading.Lock()
+        # Totals over all map() calls. Each call logs the timings of its own tasks.
+        self.num_tasks = 0
+        self.num_failed_tasks = 0
+        self.task_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(wait=True)
+
+    def map(self, fn, iterable, labels=None):
+        """
+        Runs fn on every item, at most max_in_flight at once. Once a task fails, the others are
+        cancelled and its exception is raised. Tasks already running on a worker thread finish.
+        :param labels: the names of the tasks in the logged timings, the items by default
+        :return: the list of results, in the order of the items
+        """
+        items = list(iterable)
+        labels = items if labels is None else labels
+        # A loop of its own, so that map() can be called from a worker thread too.
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._map(fn, items, labels))
+        finally:
+            loop.close()
+
+    async def _map(self, fn, items, labels):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        is_coroutine_fn = asyncio.iscoroutinefunction(fn)
+        # (label, seconds, succeeded) of every task of this call.
+        timings = []
+
+        async def run_task(item, label):
+            async with semaphore:
+                start_time = time.time()
+                succeeded = False
+                try:
+                    if is_coroutine_fn:
+                        result = await fn(item)
+                    else:
+                        result = await loop.run_in_executor(self.executor, fn, item)
+                    succeeded = True
+                    return result
+                finally:
+                    seconds = time.time() - start_time
+                    timings.append((label, seconds, succeeded))
+                    with self.lock:
+                        self.num_tasks += 1
+                        self.num_failed_tasks += 0 if succeeded else 1
+                        self.task_seconds += seconds
+
+        start_time = time.time()
+        tasks = [loop.create_task(run_task(item, label)) for item, label in zip(items, labels)]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # Cancel the tasks that are still waiting or running.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self.log_timings(timings, time.time() - start_time)
+
+    def log_timings(self, timings, elapsed):
+        if not timings:
+            return
+        (label, seconds, _) = max(timings, key=lambda timing: timing[1])
+        num_failed = sum(1 for timing in timings if not timing[2])
+        logging.info("Ran {} tasks ({} failed) in {:.3f} sec, the slowest in {:.3f} sec: {}".format(
+            len(timings), num_failed, elapsed, seconds, str(label)[:self.MAX_LABEL_LEN]))
+
+
 class SingleArgParallelCmd:
     """
     Invokes a single-argument function on the given set of argument values in a parallel way
@@ -280,7 +2004,10 @@ class SingleArgParallelCmd:
 
     @staticmethod
     def _run_internal(internal_fn, internal_fn_srgs, fn_args, pool):
-        values = pool.map(internal_fn, internal_fn_srgs)
+        if isinstance(pool, AsyncCmdEngine):
+            values = pool.map(internal_fn, internal_fn_srgs, labels=fn_args)
+        else:
+            values = pool.map(internal_fn, internal_fn_srgs)
         # Return a map from args to the command results.
         assert len(fn_args) == len(values)
         return dict(zip(fn_args, values))
@@ -308,9 +2035,13 @@ class MultiArgParallelCmd(SingleArgParallelCmd):
         self.args.append(args_tuple)
 
     def run(self, pool):
-        def internal_fn(args_tuple):
-            # One tuple - one function run.
-            return self.fn(*args_tuple)
+        if asyncio.iscoroutinefunction(self.fn):
+            async def internal_fn(args_tuple):
+                return await self.fn(*args_tuple)
+        else:
+            def internal_fn(args_tuple):
+                # One tuple - one function run.
+                return self.fn(*args_tuple)
 
         fn_args = sorted(set(self.args))
         return self._run_internal(internal_fn, fn_args, fn_args, pool)
@@ -318,9 +2049,269 @@ class MultiArgParallelCmd(SingleArgParallelCmd):
 
 class SequencedCmdArgs:
 
-    def __init__(self, args, index_to_return):
+    def __init__(self, args, index_to_return, host=None, disk=None):
         self.args = args
         self.index_to_return = index_to_return
+        # Where the sequence runs, for the limits of SequenceScheduler.
+        self.host = host
+        self.disk = disk
+        # The stage of every call. Calls of one stage may run at once, a stage starts once the
+        # calls of the stage before it finished.
+        self.stages = []
+        # The bytes every call transfers. Calls with more bytes depending on them start first.
+        self.weights = []
+        self.parallel_stage_open = False
+
+    def add(self, args_tuple, weight, parallel):
+        if not self.stages:
+            stage = 0
+        elif parallel and self.parallel_stage_open:
+            stage = self.stages[-1]
+        else:
+            stage = self.stages[-1] + 1
+        self.args.append(args_tuple)
+        self.stages.append(stage)
+        self.weights.append(weight)
+        self.parallel_stage_open = parallel
+
+
+# Limits on the calls run at once: in total, per host and per disk. 0 is no limit.
+CmdLimits = collections.namedtuple('CmdLimits', ['global_ops', 'per_host', 'per_disk'])
+
+
+class SequenceScheduler:
+    """
+    Hands out the calls of command sequences from one queue per host, as soon as the stages
+    before them finished. The call with the most bytes that cannot start before it finishes
+    goes first (longest processing time first), so that a large tablet does not start last and
+    decide when the run ends. Among calls with as many bytes the host with the fewest calls
+    running goes first, so the load is spread over all hosts until their queues run out. No
+    host, disk or the whole run goes over its limit. Not thread-safe.
+    """
+    def __init__(self, sequences, limits):
+        self.limits = limits
+        self.queues = collections.OrderedDict()
+        self.num_running = 0
+        self.running_by_host = collections.Counter()
+        self.running_by_disk = collections.Counter()
+        self.start_times = {}
+        self.start_time = time.time()
+        self.end_time = None
+        self.host_stats = {}
+        self.total_weight = 0
+        self.predicted_makespan = None
+        # Sequence id to the bytes of every call and the stages after it, the index of the first
+        # call of the next stage and the number of unfinished calls of the current stage.
+        self.priorities = {}
+        self.next_stage_index = {}
+        self.num_unfinished = {}
+        self.num_queued = 0
+        for sequence in sequences:
+            self.add(sequence)
+
+    def add(self, sequence):
+        """
+        Queues the first stage of the given sequence, also while others are running.
+        """
+        self.queues.setdefault(sequence.host, [])
+        self.host_stats.setdefault(
+            sequence.host, {"sequences": 0, "calls": 0, "busy_seconds": 0.0, "peak": 0})
+        if not sequence.args:
+            return
+        self.total_weight += sum(sequence.weights)
+        stage_weights = collections.Counter()
+        for stage, weight in zip(sequence.stages, sequence.weights):
+            stage_weights[stage] += weight
+        later_weight = {}
+        remaining = 0
+        for stage in sorted(stage_weights, reverse=True):
+            later_weight[stage] = remaining
+            remaining += stage_weights[stage]
+        self.priorities[id(sequence)] = [
+            weight + later_weight[stage]
+            for stage, weight in zip(sequence.stages, sequence.weights)]
+        self._queue_stage(sequence, 0)
+
+    def _queue_stage(self, sequence, first_index):
+        stage = sequence.stages[first_index]
+        index = first_index
+        queue = self.queues[sequence.host]
+        while index < len(sequence.args) and sequence.stages[index] == stage:
+            heapq.heappush(queue, (-self.priorities[id(sequence)][index], self.num_queued,
+                                   index, sequence))
+            self.num_queued += 1
+            index += 1
+        self.next_stage_index[id(sequence)] = index
+        self.num_unfinished[id(sequence)] = index - first_index
+
+    def has_queued(self):
+        return any(self.queues.values())
+
+    def is_done(self):
+        return self.num_running == 0 and not self.has_queued()
+
+    def _disk_available(self, sequence):
+        return (not self.limits.per_disk or sequence.disk is None or
+                self.running_by_disk[sequence.disk] < self.limits.per_disk)
+
+    def next_call(self):
+        """
+        :return: the (sequence, index of the call) to run next, or None if no call can run until
+            another one finishes
+        """
+        if self.limits.global_ops and self.num_running >= self.limits.global_ops:
+            return None
+        best = None
+        for host, queue in self.queues.items():
+            running = self.running_by_host[host]
+            if not queue or (self.limits.per_host and running >= self.limits.per_host):
+                continue
+            if best is not None and (queue[0][0], running, -len(queue)) >= best[0]:
+                continue
+            if self._disk_available(queue[0][3]):
+                item = queue[0]
+            else:
+                item = min((item for item in queue if self._disk_available(item[3])),
+                           default=None)
+            if item is not None:
+                priority = (item[0], running, -len(queue))
+                if best is None or priority < best[0]:
+                    best = (priority, host, item)
+        if best is None:
+            return None
+        (_, host, item) = best
+        queue = self.queues[host]
+        if item is queue[0]:
+            heapq.heappop(queue)
+        else:
+            queue.remove(item)
+            heapq.heapify(queue)
+        (_, _, index, sequence) = item
+        self.num_running += 1
+        self.running_by_host[host] += 1
+        self.running_by_disk[sequence.disk] += 1
+        stats = self.host_stats[host]
+        stats["peak"] = max(stats["peak"], self.running_by_host[host])
+        self.start_times[(id(sequence), index)] = time.time()
+        return sequence, index
+
+    def finish(self, sequence, index):
+        """
+        Queues the next stage of the sequence once the given call was the last of its stage.
+        :return: whether the sequence is complete
+        """
+        self.num_running -= 1
+        self.running_by_host[sequence.host] -= 1
+        self.running_by_disk[sequence.disk] -= 1
+        stats = self.host_stats[sequence.host]
+        stats["calls"] += 1
+        stats["busy_seconds"] += time.time() - self.start_times.pop((id(sequence), index))
+        self.end_time = time.time()
+        self.num_unfinished[id(sequence)] -= 1
+        if self.num_unfinished[id(sequence)] > 0:
+            return False
+        next_index = self.next_stage_index[id(sequence)]
+        if next_index < len(sequence.args):
+            self._queue_stage(sequence, next_index)
+            return False
+        stats["sequences"] += 1
+        return True
+
+    @classmethod
+    def predict_makespan(cls, sequences, limits):
+        """
+        Simulates running the given sequences with a scheduler, each call taking its weight in
+        time.
+        :return: the weight of the longest chain of calls, in the unit of the weights
+        """
+        scheduler = cls(sequences, limits)
+        now = 0
+        running = []
+        while True:
+            call = scheduler.next_call()
+            while call is not None:
+                (sequence, index) = call
+                heapq.heappush(running, (now + sequence.weights[index], id(sequence), index,
+                                         sequence))
+                call = scheduler.next_call()
+            if not running:
+                return now
+            (now, _, index, sequence) = heapq.heappop(running)
+            scheduler.finish(sequence, index)
+
+    def log_stats(self):
+        elapsed = max((self.end_time or time.time()) - self.start_time, 1e-6)
+        busy_seconds = sum(stats["busy_seconds"] for stats in self.host_stats.values())
+        if self.predicted_makespan and busy_seconds > 0:
+            # The bytes per second of one call, as measured by this run.
+            rate = self.total_weight / busy_seconds
+            logging.info("Predicted makespan {:.3f} sec at {:.3f} MB/s per call, actual "
+                         "{:.3f} sec".format(self.predicted_makespan / rate, rate / 1e6, elapsed))
+        for host, stats in sorted(self.host_stats.items(), key=lambda item: str(item[0])):
+            # The average number of calls running, relative to the host limit if any.
+            utilization = stats["busy_seconds"] / elapsed
+            if self.limits.per_host:
+                utilization /= self.limits.per_host
+            logging.info("Host {}: {} command sequences, {} calls, {:.3f} sec busy, {} at most "
+                         "at once, {:.0%} utilization".format(
+                             host, stats["sequences"], stats["calls"], stats["busy_seconds"],
+                             stats["peak"], utilization))
+
+
+class SequenceFeed:
+    """
+    Hands command sequences to a running SequencedParallelCmd from another thread, so that they
+    start while the rest are still being prepared. Thread-safe.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sequences = []
+        self.closed = False
+        self.cancelled = False
+        # Wakes up the workers of the run, from the thread of the caller.
+        self.listener = None
+
+    def add(self, sequences):
+        with self.lock:
+            self.sequences.extend(sequences)
+        self._notify()
+
+    def close(self):
+        """
+        No more sequences are added. The run returns once the added ones are done.
+        """
+        with self.lock:
+            self.closed = True
+        self._notify()
+
+    def cancel(self):
+        """
+        Stops the run from starting more calls, like a failed call does.
+        """
+        with self.lock:
+            self.closed = True
+            self.cancelled = True
+        self._notify()
+
+    def take(self):
+        """
+        :return: the sequences added since the last call, whether the feed is closed and whether
+            it was cancelled
+        """
+        with self.lock:
+            sequences = self.sequences
+            self.sequences = []
+            return sequences, self.closed, self.cancelled
+
+    def set_listener(self, listener):
+        with self.lock:
+            self.listener = listener
+
+    def _notify(self):
+        with self.lock:
+            listener = self.listener
+        if listener is not None:
+            listener()
 
 
 class SequencedParallelCmd(SingleArgParallelCmd):
@@ -338,6 +2329,8 @@ class SequencedParallelCmd(SingleArgParallelCmd):
         p.run(pool)
         -> run in parallel Thread-1: -> fn(a1, a2); fn(b1, b2)
                            Thread-2: -> fn(c1, c2); fn(d1, d2)
+    Consecutive calls added with add_parallel_args() do not depend on each other. When the
+    sequences run with limits, such calls run at once, otherwise one after another.
     """
     def __init__(self, fn):
         self.fn = fn
@@ -355,38 +2348,202 @@ class SequencedParallelCmd(SingleArgParallelCmd):
         """
         self.result_fn_call_index = None
         self.saved_result_indices = []
+        # The SequenceScheduler of the last run with limits, for its stats.
+        self.scheduler = None
 
-    def start_command(self):
+    def start_command(self, host=None, disk=None):
         # Start new set of argument tuples.
-        self.parallel_args.append(SequencedCmdArgs(args=[], index_to_return=None))
+        self.parallel_args.append(SequencedCmdArgs(
+            args=[], index_to_return=None, host=host, disk=disk))
 
-    def add_args(self, *args_tuple):
+    def add_args(self, *args_tuple, weight=0):
+        assert isinstance(args_tuple, tuple)
+        assert len(self.parallel_args) > 0, 'Call start_command() before'
+        self.parallel_args[-1].add(args_tuple, weight, parallel=False)
+
+    def add_parallel_args(self, *args_tuple, weight=0):
+        """
+        Adds a call that may run at the same time as the calls added by add_parallel_args()
+        right before it.
+        :param weight: the bytes the call transfers
+        """
         assert isinstance(args_tuple, tuple)
         assert len(self.parallel_args) > 0, 'Call start_command() before'
-        self.parallel_args[-1].args.append(args_tuple)
+        self.parallel_args[-1].add(args_tuple, weight, parallel=True)
 
     def add_args_and_save_result(self, *args_tuple):
         self.add_args(*args_tuple)
         current_args = self.parallel_args[-1]
         current_args.index_to_return = len(current_args.args) - 1
 
-    def run(self, pool):
-        def internal_fn(sequenced_cmd_args):
-            assert isinstance(sequenced_cmd_args, SequencedCmdArgs)
-            # A list of commands: do it one by one.
-            results = []
-            for cmd_args in sequenced_cmd_args.args:
-                assert isinstance(cmd_args, tuple)
-                results.append(self.fn(*cmd_args))
-
-            if sequenced_cmd_args.index_to_return is None:
-                return results
-            else:
-                return results[sequenced_cmd_args.index_to_return]
+    @staticmethod
+    def get_result(sequenced_cmd_args, results):
+        if sequenced_cmd_args.index_to_return is None:
+            return results
+        else:
+            return results[sequenced_cmd_args.index_to_return]
+
+    def run(self, pool, limits=None, feed=None):
+        """
+        :param limits: CmdLimits to run the calls with. Without them the sequences run in
+            the order they were added, as many at once as the pool runs.
+        :param feed: a SequenceFeed of more sequences to run with limits, until it is closed
+        """
+        if limits is not None:
+            return self._run_scheduled(pool, limits, feed)
+        assert feed is None, 'A feed needs limits'
+
+        if asyncio.iscoroutinefunction(self.fn):
+            async def internal_fn(sequenced_cmd_args):
+                assert isinstance(sequenced_cmd_args, SequencedCmdArgs)
+                results = []
+                for cmd_args in sequenced_cmd_args.args:
+                    assert isinstance(cmd_args, tuple)
+                    results.append(await self.fn(*cmd_args))
+                return self.get_result(sequenced_cmd_args, results)
+        else:
+            def internal_fn(sequenced_cmd_args):
+                assert isinstance(sequenced_cmd_args, SequencedCmdArgs)
+                # A list of commands: do it one by one.
+                results = []
+                for cmd_args in sequenced_cmd_args.args:
+                    assert isinstance(cmd_args, tuple)
+                    results.append(self.fn(*cmd_args))
+                return self.get_result(sequenced_cmd_args, results)
 
         fn_args = [str(sequenced_args.args) for sequenced_args in self.parallel_args]
         return self._run_internal(internal_fn, self.parallel_args, fn_args, pool)
 
+    def _run_scheduled(self, pool, limits, feed):
+        """
+        Runs the calls on workers that take them from a SequenceScheduler. With a feed, there are
+        limits.global_ops workers, which wait for sequences until the feed is closed.
+        """
+        scheduler = SequenceScheduler([], limits)
+        self.scheduler = scheduler
+        results = {}
+        call_results = {}
+
+        def add_sequences(sequences):
+            for sequence in sequences:
+                scheduler.add(sequence)
+                call_results[id(sequence)] = [None] * len(sequence.args)
+                if not sequence.args:
+                    results[str(sequence.args)] = self.get_result(sequence, [])
+
+        add_sequences(self.parallel_args)
+        if feed is None:
+            # The simulation assumes every sequence is ready at the start, which fed sequences
+            # are not, so only runs without a feed are predicted.
+            scheduler.predicted_makespan = SequenceScheduler.predict_makespan(
+                self.parallel_args, limits)
+        # Workers stop taking calls once one fails.
+        failed = []
+        if feed is None:
+            num_workers = sum(len(sequence.args) for sequence in self.parallel_args)
+            if limits.global_ops:
+                num_workers = min(num_workers, limits.global_ops)
+        else:
+            assert limits.global_ops, 'A feed needs a global limit'
+            num_workers = limits.global_ops
+        feed_state = {"closed": feed is None, "cancelled": False}
+
+        def next_call():
+            if feed is not None and not feed_state["closed"]:
+                (sequences, feed_state["closed"], feed_state["cancelled"]) = feed.take()
+                self.parallel_args.extend(sequences)
+                add_sequences(sequences)
+            stopped = failed or feed_state["cancelled"]
+            call = None if stopped else scheduler.next_call()
+            done = call is None and (stopped or (scheduler.is_done() and feed_state["closed"]))
+            return call, done
+
+        def finish(call, value):
+            (sequence, index) = call
+            call_results[id(sequence)][index] = value
+            if scheduler.finish(sequence, index):
+                results[str(sequence.args)] = self.get_result(
+                    sequence, call_results.pop(id(sequence)))
+
+        if asyncio.iscoroutinefunction(self.fn):
+            # All workers run on one thread, the loop of this map(). A worker waits for the event
+            # whenever no call can start, and every finished or fed sequence sets it.
+            events = []
+
+            def wake_up(loop, event):
+                try:
+                    loop.call_soon_threadsafe(event.set)
+                except RuntimeError:
+                    # The loop is closed, the run is over.
+                    pass
+
+            async def worker(_):
+                if not events:
+                    events.append(asyncio.Event())
+                    if feed is not None:
+                        feed.set_listener(functools.partial(
+                            wake_up, asyncio.get_running_loop(), events[0]))
+                changed = events[0]
+                while True:
+                    (call, done) = next_call()
+                    if call is None:
+                        if done:
+                            # Others may be waiting to see that the run is done.
+                            changed.set()
+                            return
+                        changed.clear()
+                        await changed.wait()
+                        continue
+                    (sequence, index) = call
+                    value = None
+                    try:
+                        value = await self.fn(*sequence.args[index])
+                    except BaseException:
+                        failed.append(call)
+                        raise
+                    finally:
+                        finish(call, value)
+                        changed.set()
+        else:
+            condition = threading.Condition()
+
+            def notify():
+                with condition:
+                    condition.notify_all()
+
+            if feed is not None:
+                feed.set_listener(notify)
+
+            def worker(_):
+                while True:
+                    with condition:
+                        while True:
+                            (call, done) = next_call()
+                            if call is not None or done:
+                                break
+                            condition.wait()
+                    if call is None:
+                        return
+                    (sequence, index) = call
+                    value = None
+                    try:
+                        value = self.fn(*sequence.args[index])
+                    except BaseException:
+                        failed.append(call)
+                        raise
+                    finally:
+                        with condition:
+                            finish(call, value)
+                            condition.notify_all()
+
+        try:
+            pool.map(worker, range(num_workers))
+        finally:
+            if feed is not None:
+                feed.set_listener(None)
+            scheduler.log_stats()
+        return results
+
 
 def check_arg_range(min_value, max_value):
     """
@@ -428,6 +2585,34 @@ def checksum_path_downloaded(file_path):
     return checksum_path(file_path) + '.downloaded'
 
 
+def batch_transfers(transfers, max_files, max_bytes):
+    """
+    Groups the file transfers that share their source and destination directories into
+    batches, each of which one storage command can run.
+    :param transfers: (source path, destination directory, file name, size) tuples. A transfer
+        renaming its file, whose source has another name, is a batch of its own.
+    :param max_files: most files of a batch.
+    :param max_bytes: most bytes of a batch, unless it is a single larger file.
+    :return: a list of batches, which are lists of transfers, in the order of the transfers
+    """
+    batches = []
+    open_batches = {}
+    for transfer in transfers:
+        (src, dest_dir, filename, size) = transfer
+        if os.path.basename(src) != filename:
+            batches.append([transfer])
+            continue
+        key = (os.path.dirname(src), dest_dir)
+        batch = open_batches.get(key)
+        if (batch is None or len(batch) >= max_files or
+                sum(t[3] for t in batch) + size > max_bytes):
+            batch = []
+            open_batches[key] = batch
+            batches.append(batch)
+        batch.append(transfer)
+    return batches
+
+
 # TODO: get rid of this sed / test program generation in favor of a more maintainable solution.
 def key_and_file_filter(checksum_file):
     return "\" $( sed 's| .*/| |' {} ) \"".format(pipes.quote(checksum_file))
@@ -499,6 +2684,49 @@ class AbstractBackupStorage(object):
     def _command_list_prefix(self):
         return []
 
+    # Fields of the stat_obj_cmd output that change when the object is rewritten.
+    OBJ_VERSION_FIELDS = ()
+
+    def stat_obj_cmd(self, src):
+        """
+        :return: the command printing the version of the given object, or None if the storage
+            does not support it.
+        """
+        return None
+
+    # Batch forms of upload_file_cmd, download_file_cmd and move_obj_cmd: a single command
+    # transferring the given files of src_dir to dest_dir, keeping their names. None means the
+    # storage has no batch mode and every file gets its own command.
+    def upload_files_cmd(self, src_dir, filenames, dest_dir):
+        return None
+
+    def download_files_cmd(self, src_dir, filenames, dest_dir):
+        return None
+
+    def move_objs_cmd(self, src_dir, filenames, dest_dir):
+        return None
+
+    def install_files(self, tmp_dir):
+        """
+        Copies the programs the storage commands run, other than the storage tools, into the
+        temporary directory.
+        :return: their paths, which also have to be copied to every server running the commands
+        """
+        return []
+
+    def parse_obj_version(self, output):
+        """
+        :return: a string that changes whenever the object is rewritten, or None.
+        """
+        fields = {}
+        for line in output.splitlines():
+            key, sep, value = line.partition(':')
+            if sep and key.strip() in self.OBJ_VERSION_FIELDS:
+                fields[key.strip()] = value.strip()
+        if not fields:
+            return None
+        return ';'.join('{}={}'.format(key, fields[key]) for key in sorted(fields))
+
 
 class AzBackupStorage(AbstractBackupStorage):
     def __init__(self, options):
@@ -550,6 +2778,32 @@ class AzBackupStorage(AbstractBackupStorage):
                                                        self._command_list_prefix(), "rm", src,
                                                        "--recursive=true")]
 
+    # The batch commands copy "src_dir/*" like upload_dir_cmd, restricted to the given names.
+    def _include_pattern(self, filenames):
+        return "--include-pattern '{}'".format(';'.join(filenames))
+
+    def upload_files_cmd(self, src_dir, filenames, dest_dir):
+        src = "'{}'".format(os.path.join(src_dir, '*'))
+        dest = "'{}'".format(dest_dir + os.getenv('AZURE_STORAGE_SAS_TOKEN'))
+        return ["{} {} {} {} {}".format(self._command_list_prefix(), "cp", src, dest,
+                                        self._include_pattern(filenames))]
+
+    def download_files_cmd(self, src_dir, filenames, dest_dir):
+        src = "'{}'".format(os.path.join(src_dir, '*') + os.getenv('AZURE_STORAGE_SAS_TOKEN'))
+        dest = "'{}'".format(dest_dir)
+        return ["{} {} {} {} {}".format(self._command_list_prefix(), "cp", src, dest,
+                                        self._include_pattern(filenames))]
+
+    def move_objs_cmd(self, src_dir, filenames, dest_dir):
+        # 'azcopy rm' reads the objects to delete, relative to src_dir, from a list file.
+        src = "'{}'".format(os.path.join(src_dir, '*') + os.getenv('AZURE_STORAGE_SAS_TOKEN'))
+        dest = "'{}'".format(dest_dir + os.getenv('AZURE_STORAGE_SAS_TOKEN'))
+        src_dir = "'{}'".format(src_dir + os.getenv('AZURE_STORAGE_SAS_TOKEN'))
+        return ["{} {} {} {} {} && {} {} {} --list-of-files <(printf '%s\\n' {})".format(
+            self._command_list_prefix(), "cp", src, dest, self._include_pattern(filenames),
+            self._command_list_prefix(), "rm", src_dir,
+            " ".join(pipes.quote(name) for name in filenames))]
+
 class GcsBackupStorage(AbstractBackupStorage):
     def __init__(self, options):
         super(GcsBackupStorage, self).__init__(options)
@@ -582,6 +2836,27 @@ class GcsBackupStorage(AbstractBackupStorage):
     def move_obj_cmd(self, src, dest):
         return self._command_list_prefix() + ["mv", src, dest]
 
+    # 'gsutil -m cp -I' reads the sources from stdin and transfers them in parallel.
+    def _files_from_stdin_cmd(self, op, src_dir, filenames, dest_dir):
+        return ["printf '%s\\n' {} | {} -m {} -I {}".format(
+            " ".join(pipes.quote(os.path.join(src_dir, name)) for name in filenames),
+            " ".join(pipes.quote(arg) for arg in self._command_list_prefix()), op,
+            pipes.quote(dest_dir))]
+
+    def upload_files_cmd(self, src_dir, filenames, dest_dir):
+        return self._files_from_stdin_cmd("cp", src_dir, filenames, dest_dir)
+
+    def download_files_cmd(self, src_dir, filenames, dest_dir):
+        return self._files_from_stdin_cmd("cp", src_dir, filenames, dest_dir)
+
+    def move_objs_cmd(self, src_dir, filenames, dest_dir):
+        return self._files_from_stdin_cmd("mv", src_dir, filenames, dest_dir)
+
+    OBJ_VERSION_FIELDS = ('Content-Length', 'ETag', 'Generation', 'Hash (md5)')
+
+    def stat_obj_cmd(self, src):
+        return self._command_list_prefix() + ["stat", src]
+
 class S3BackupStorage(AbstractBackupStorage):
     def __init__(self, options):
         super(S3BackupStorage, self).__init__(options)
@@ -623,6 +2898,48 @@ class S3BackupStorage(AbstractBackupStorage):
         cmd_list = ["mv", src, dest]
         return self._command_list_prefix() + cmd_list
 
+    # s3cmd put, get and mv take several sources when the destination ends with '/'.
+    def upload_files_cmd(self, src_dir, filenames, dest_dir):
+        cmd_list = (["put"] + [os.path.join(src_dir, name) for name in filenames] +
+                    [os.path.join(dest_dir, '')])
+        if self.options.args.sse:
+            cmd_list.append("--server-side-encryption")
+        return self._command_list_prefix() + cmd_list
+
+    def download_files_cmd(self, src_dir, filenames, dest_dir):
+        return self._command_list_prefix() + (
+            ["get"] + [os.path.join(src_dir, name) for name in filenames] +
+            [os.path.join(dest_dir, '')])
+
+    def move_objs_cmd(self, src_dir, filenames, dest_dir):
+        return self._command_list_prefix() + (
+            ["mv"] + [os.path.join(src_dir, name) for name in filenames] +
+            [os.path.join(dest_dir, '')])
+
+    OBJ_VERSION_FIELDS = ('File size', 'Last mod', 'MD5 sum', 'ETag')
+
+    def stat_obj_cmd(self, src):
+        return self._command_list_prefix() + ["info", src]
+
+class NativeS3BackupStorage(S3BackupStorage):
+    """
+    Runs the s3cmd commands of S3BackupStorage with yb_s3_transfer.py instead, which uploads
+    and downloads large files in parallel parts over kept-alive connections.
+    """
+    def __init__(self, options):
+        super(NativeS3BackupStorage, self).__init__(options)
+        self.script_path = None
+
+    def install_files(self, tmp_dir):
+        self.script_path = os.path.join(tmp_dir, S3_TRANSFER_SCRIPT)
+        shutil.copy(os.path.join(SCRIPT_DIR, S3_TRANSFER_SCRIPT), self.script_path)
+        return [self.script_path]
+
+    def _command_list_prefix(self):
+        return ['python3', self.script_path, '--config=%s' % self.options.cloud_cfg_file_path,
+                '--part_size_mb=%d' % self.options.args.s3_part_size_mb,
+                '--concurrency=%d' % self.options.args.s3_concurrency, '--no_check_certificate']
+
 class NfsBackupStorage(AbstractBackupStorage):
     def __init__(self, options):
         super(NfsBackupStorage, self).__init__(options)
@@ -666,6 +2983,32 @@ class NfsBackupStorage(AbstractBackupStorage):
                                                  pipes.quote(src),
                                                  pipes.quote(dest))]
 
+    # rsync reads the names, relative to src_dir, from stdin.
+    def _rsync_files_cmd(self, src_dir, filenames, dest_dir):
+        return "printf '%s\\n' {} | {} --files-from=- {} {}".format(
+            " ".join(pipes.quote(name) for name in filenames),
+            " ".join(self._command_list_prefix()), pipes.quote(os.path.join(src_dir, '')),
+            pipes.quote(os.path.join(dest_dir, '')))
+
+    def upload_files_cmd(self, src_dir, filenames, dest_dir):
+        return ["mkdir -p {} && {}".format(
+            pipes.quote(dest_dir), self._rsync_files_cmd(src_dir, filenames, dest_dir))]
+
+    def download_files_cmd(self, src_dir, filenames, dest_dir):
+        return [self._rsync_files_cmd(src_dir, filenames, dest_dir)]
+
+    def move_objs_cmd(self, src_dir, filenames, dest_dir):
+        return ["mkdir -p {} && mv {} {}".format(
+            pipes.quote(dest_dir),
+            " ".join(pipes.quote(os.path.join(src_dir, name)) for name in filenames),
+            pipes.quote(dest_dir))]
+
+    def stat_obj_cmd(self, src):
+        return ["stat", "-c", "size=%s;mtime=%Y;inode=%i", src]
+
+    def parse_obj_version(self, output):
+        return output.strip() or None
+
 BACKUP_STORAGE_ABSTRACTIONS = {
     S3BackupStorage.storage_type(): S3BackupStorage,
     NfsBackupStorage.storage_type(): NfsBackupStorage,
@@ -673,6 +3016,11 @@ BACKUP_STORAGE_ABSTRACTIONS = {
     AzBackupStorage.storage_type(): AzBackupStorage
 }
 
+# Storage types whose commands can run a native engine instead of the storage tool.
+NATIVE_BACKUP_STORAGE_ENGINES = {
+    S3BackupStorage.storage_type(): NativeS3BackupStorage
+}
+
 
 class KubernetesDetails():
     def __init__(self, server_fqdn, config_map):
@@ -743,6 +3091,8 @@ class YBBackup:
         self.live_tserver_ip = ''
         self.tmp_dir_name = ''
         self.server_ips_with_uploaded_cloud_cfg = {}
+        # Files the storage commands need next to the cloud config on every server.
+        self.storage_files = []
         self.k8s_namespace_to_cfg = {}
         self.timer = BackupTimer()
         self.tserver_ip_to_web_port = {}
@@ -751,7 +3101,25 @@ class YBBackup:
         self.prev_manifest_class = Manifest(uuid.uuid1())
         self.manifest_class = Manifest(uuid.uuid1())
         self.manifest_class_last_savepoint = ''
+        # With --manifest_format stream, tablets of the new manifest are written out as soon as
+        # their upload commands are prepared.
+        self.manifest_stream = None
+        # Content hash to location of every manifest fragment seen in this run.
+        self.known_manifest_shards = {}
+        self.manifest_cache = None
+        self.data_dir_cache = None
+        self.dedup_index = None
         self.pool = None
+        self.snapshot_discovery = {}
+        self.snapshot_discovery_id = None
+        # The list_tablets arguments of a table to its (tablet id, leader host) tuples.
+        self.tablet_leaders_by_table = {}
+        self.master_http = None
+        # Time to complete of every snapshot operation waited for, see wait_for_snapshot().
+        self.snapshot_waits = []
+        self.ssh_pool = None
+        self.ssh_pool_lock = threading.Lock()
+        self.native_ssh_executor = None
 
 
     def sleep_or_raise(self, num_retry, timeout, ex):
@@ -797,6 +3165,53 @@ class YBBackup:
                 self.sleep_or_raise(num_retry, timeout, ex)
 
 
+    async def run_program_async(self, args, num_retry=1, timeout=10, env=None):
+        """
+        Coroutine version of run_program() for the AsyncCmdEngine. A cancelled command is killed.
+        """
+        cmd_as_str = quote_cmd_line_for_bash(args)
+        if self.args.verbose:
+            logging.info("Running command{}: {}".format(
+                "" if num_retry == 1 else " ({} retries)".format(num_retry), cmd_as_str))
+
+        while num_retry > 0:
+            num_retry = num_retry - 1
+
+            try:
+                proc_env = os.environ.copy()
+                proc_env.update(env if env is not None else {})
+
+                proc = await asyncio.create_subprocess_exec(
+                    *args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=proc_env)
+                try:
+                    (output, _) = await proc.communicate()
+                except asyncio.CancelledError:
+                    proc.kill()
+                    await proc.wait()
+                    raise
+                if proc.returncode != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, args, output=output)
+                subprocess_result = output.decode('utf-8')
+
+                if self.args.verbose:
+                    logging.info(
+                        "Output from running command [[ {} ]]:\n{}\n[[ END OF OUTPUT ]]".format(
+                            cmd_as_str, subprocess_result))
+                return subprocess_result
+            except subprocess.CalledProcessError as e:
+                logging.error("Failed to run command [[ {} ]]: code={} output={}".format(
+                    cmd_as_str, e.returncode, str(e.output.decode('utf-8'))))
+                if num_retry <= 0:
+                    raise
+                logging.info("Sleep {}... ({} retries left)".format(timeout, num_retry))
+                await asyncio.sleep(timeout)
+            except Exception as ex:
+                logging.error("Failed to run command [[ {} ]]: {}".format(cmd_as_str, ex))
+                if num_retry <= 0:
+                    raise
+                logging.info("Sleep {}... ({} retries left)".format(timeout, num_retry))
+                await asyncio.sleep(timeout)
+
     @staticmethod
     def get_upload_file_path(backup_location, tablet_id, filename):
         return os.path.join(backup_location, f'tablet-{tablet_id}', filename)
@@ -875,6 +3290,39 @@ class YBBackup:
             '--no_ssh', action='store_true', default=False, help="Don't use SSH to run commands")
         parser.add_argument(
             '--mac', action='store_true', default=False, help="Use MacOS tooling")
+        parser.add_argument(
+            '--ssh_executor', choices=[SSH_EXECUTOR_PROCESS, SSH_EXECUTOR_NATIVE],
+            default=SSH_EXECUTOR_PROCESS,
+            help="How remote commands run: '{}' runs an ssh client per command, '{}' runs "
+                 "them over SSH connections kept in this process, which needs the paramiko "
+                 "module.".format(SSH_EXECUTOR_PROCESS, SSH_EXECUTOR_NATIVE))
+        parser.add_argument(
+            '--storage_engine', choices=[STORAGE_ENGINE_CLI, STORAGE_ENGINE_NATIVE],
+            default=STORAGE_ENGINE_CLI,
+            help="How files are transferred to and from the storage: '{}' runs the tool of the "
+                 "storage type, such as s3cmd, '{}' runs the native engine of the storage type, "
+                 "which is available for: {}.".format(
+                     STORAGE_ENGINE_CLI, STORAGE_ENGINE_NATIVE,
+                     ', '.join(sorted(NATIVE_BACKUP_STORAGE_ENGINES.keys()))))
+        parser.add_argument(
+            '--s3_part_size_mb', type=check_arg_range(5, 5 * 1024), default=64,
+            help="Files larger than this are transferred in parts by the native S3 engine.")
+        parser.add_argument(
+            '--s3_concurrency', type=check_arg_range(1, 1000), default=8,
+            help="Requests, and so connections, one native S3 engine command has in flight at "
+                 "once, over all the parts and files it transfers.")
+        parser.add_argument(
+            '--max_files_per_storage_cmd', type=check_arg_range(1, 10000), default=100,
+            help="Most files of a tablet one storage command transfers. 1 transfers every "
+                 "file with its own command.")
+        parser.add_argument(
+            '--max_mb_per_storage_cmd', type=check_arg_range(1, 1024 * 1024), default=256,
+            help="Most megabytes of files one storage command transfers. A larger file is "
+                 "transferred with a command of its own.")
+        parser.add_argument(
+            '--disable_ssh_multiplexing', action='store_true', default=False,
+            help="Make a new SSH connection for every remote command instead of running them "
+                 "over one persistent connection per server")
         parser.add_argument(
             '--ysql_port', help="Custom YSQL process port. "
                                 "Default port is used if not specified.")
@@ -918,9 +3366,42 @@ class YBBackup:
             help='Number or restore points for differential backups.')
         parser.add_argument(
             '-j', '--parallelism', type=check_arg_range(1, 100), default=8,
-            help='Maximum number of parallel commands to launch. '
-                 'This also affects the amount of outgoing s3cmd sync traffic when copying a '
-                 'backup to S3.')
+            help='Maximum number of parallel commands to launch, and by default of remote '
+                 'command sequences in flight, which limits the outgoing storage traffic. '
+                 'See --max_remote_ops.')
+        parser.add_argument(
+            '--parallel_engine', choices=[PARALLEL_ENGINE_ASYNCIO, PARALLEL_ENGINE_THREADS],
+            default=PARALLEL_ENGINE_ASYNCIO,
+            help="How parallel commands run. '{}' runs remote commands as asyncio subprocesses, "
+                 "up to --max_remote_ops at once, and other steps on --parallelism threads. "
+                 "'{}' runs everything on --parallelism threads.".format(
+                     PARALLEL_ENGINE_ASYNCIO, PARALLEL_ENGINE_THREADS))
+        parser.add_argument(
+            '--max_remote_ops', type=check_arg_range(1, 100000), default=None,
+            help="Maximum number of remote command sequences in flight with the '{}' "
+                 "parallel engine. Defaults to --parallelism, a larger value lets more "
+                 "transfers run at once without more threads.".format(PARALLEL_ENGINE_ASYNCIO))
+        parser.add_argument(
+            '--max_ops_per_tserver', type=check_arg_range(0, 100000), default=8,
+            help="Maximum number of file or tablet transfers running at once on one tablet "
+                 "server. 0 is no limit.")
+        parser.add_argument(
+            '--max_ops_per_data_dir', type=check_arg_range(0, 100000), default=0,
+            help="Maximum number of file or tablet transfers running at once on one data "
+                 "directory of a tablet server. 0 is no limit.")
+        parser.add_argument(
+            '--disable_pipelined_backup', action='store_true', default=False,
+            help="Find the snapshot files on all tablet servers before uploading any, instead of "
+                 "uploading the files of each tablet server as soon as they are found.")
+        parser.add_argument(
+            '--master_http_client', action='store_true', default=False,
+            help="Find the master leader, tablet servers, tablet leaders and tablet replicas "
+                 "through the JSON endpoints of the master web servers, over kept-alive HTTP "
+                 "connections, instead of running yb-admin. yb-admin is still used for the "
+                 "rest, and whenever an HTTP query fails.")
+        parser.add_argument(
+            '--master_web_port', type=int, default=DEFAULT_MASTER_WEB_PORT,
+            help="Port of the master web servers, used with --master_http_client.")
         parser.add_argument(
             '--storage_type', choices=list(BACKUP_STORAGE_ABSTRACTIONS.keys()),
             default=S3BackupStorage.storage_type(),
@@ -956,6 +3437,38 @@ class YBBackup:
         parser.add_argument(
             '--savepoint_number',required=False,
             help='The type of location of last differential backup savepoint. Allowed: s3 ')
+        parser.add_argument(
+            '--manifest_format', choices=MANIFEST_FORMATS, default=MANIFEST_FORMAT_BINARY,
+            help='Encoding of the MANIFEST written by create and create_diff. Manifests in any '
+                 'of the formats can be read. The binary format is memory-mapped and searched '
+                 'without being parsed, json is kept for exporting.')
+        parser.add_argument(
+            '--dedup_store', required=False,
+            help='Location of a content-addressed store shared by backups of any keyspace and '
+                 'chain. SST files are uploaded to it under their SHA-256 and files the store '
+                 'already has are only referenced by the manifest.')
+        parser.add_argument(
+            '--cache_dir', required=False,
+            help='Local directory for state kept between runs on this host. Manifests used '
+                 'as previous backups are cached there, so the next differential backup does '
+                 'not download them again while they are unchanged in the backup storage. So '
+                 'are the data directories of the tablet servers.')
+        parser.add_argument(
+            '--manifest_cache_max_age_days', type=float, default=7,
+            help='Cached manifests unused for this many days are removed.')
+        parser.add_argument(
+            '--manifest_cache_max_mb', type=int, default=1024,
+            help='Least recently used cached manifests are removed beyond this size.')
+        parser.add_argument(
+            '--data_dir_cache_max_age_hours', type=float, default=24,
+            help='Data directories of tablet servers found this many hours ago or earlier are '
+                 'read from the tablet servers again. 0 does not cache them.')
+        parser.add_argument(
+            '--manifest_shards', type=check_arg_range(0, 65536), default=0,
+            help='Store the MANIFEST as a small root object plus content-addressed fragments, '
+                 'with SST entries spread over this many fragments by tablet. Fragments that '
+                 'did not change since a previous backup are referenced instead of being '
+                 'uploaded again. 0 stores the MANIFEST as a single object.')
         parser.add_argument(
             '--aws_credentials_file', required=False,
             help='Path to aws credentials file.')
@@ -969,20 +3482,15 @@ class YBBackup:
         if self.args.verbose:
             logging.info("Parsed arguments: {}".format(vars(self.args)))
 
+        if self.args.master_http_client:
+            self.master_http = MasterHttpClient(
+                ["{}:{}".format(master.rsplit(':', 1)[0], self.args.master_web_port)
+                 for master in self.args.masters.split(',')])
+            atexit.register(self.master_http.close)
+
         if self.args.storage_type == 'nfs':
             logging.info('Checking whether NFS backup storage path mounted on TServers or not')
-            tablets_by_leader_ip = []
-
-            output = self.run_yb_admin(['list_all_tablet_servers'])
-            for line in output.splitlines():
-                if LEADING_UUID_RE.match(line):
-                    fields = split_by_space(line)
-                    ip_port = fields[1]
-                    state = fields[3]
-                    (ip, port) = ip_port.split(':')
-                    if state == 'ALIVE':
-                        tablets_by_leader_ip.append(ip)
-            tserver_ips = list(tablets_by_leader_ip)
+            tserver_ips = self.list_alive_tservers()
             SingleArgParallelCmd(self.find_nfs_storage, tserver_ips).run(self.pool)
 
         self.args.backup_location = self.args.backup_location or self.args.s3bucket
@@ -1039,7 +3547,32 @@ class YBBackup:
                 raise BackupException(
                     "SAS tokens must begin with '?sv'.")
 
-        self.storage = BACKUP_STORAGE_ABSTRACTIONS[self.args.storage_type](options)
+        if self.args.storage_engine == STORAGE_ENGINE_NATIVE:
+            if self.args.storage_type not in NATIVE_BACKUP_STORAGE_ENGINES:
+                raise BackupException("There is no native engine for storage type {}".format(
+                    self.args.storage_type))
+            self.storage = NATIVE_BACKUP_STORAGE_ENGINES[self.args.storage_type](options)
+        else:
+            self.storage = BACKUP_STORAGE_ABSTRACTIONS[self.args.storage_type](options)
+        self.storage_files = self.storage.install_files(self.get_tmp_dir())
+
+        if (self.args.ssh_executor == SSH_EXECUTOR_NATIVE and not self.args.no_ssh and
+                not self.is_k8s()):
+            if paramiko is None:
+                raise BackupException(
+                    "--ssh_executor {} needs the paramiko module".format(SSH_EXECUTOR_NATIVE))
+            self.native_ssh_executor = NativeSshExecutor(self.connect_native_ssh)
+            atexit.register(self.native_ssh_executor.close)
+
+        if self.args.cache_dir:
+            self.manifest_cache = ManifestCache(
+                os.path.join(self.args.cache_dir, 'manifests'),
+                self.args.manifest_cache_max_age_days * 24 * 3600,
+                self.args.manifest_cache_max_mb * 1024 * 1024)
+
+        self.data_dir_cache = DataDirCache(
+            os.path.join(self.args.cache_dir, DATA_DIR_CACHE) if self.args.cache_dir else None,
+            self.args.data_dir_cache_max_age_hours * 3600)
 
         if self.is_k8s():
             self.k8s_namespace_to_cfg = json.loads(self.args.k8s_config)
@@ -1093,6 +3626,12 @@ class YBBackup:
             return self.get_leader_master_ip()
 
     def get_leader_master_ip(self):
+        if not self.leader_master_ip and self.master_http:
+            try:
+                self.leader_master_ip = self.master_http.find_leader().rsplit(':', 1)[0]
+            except BackupException as ex:
+                logging.warning("Falling back to yb-admin to find the master leader: {}".format(ex))
+
         if not self.leader_master_ip:
             all_masters = self.args.masters.split(",")
             # Use first Master's ip in list to get list of all masters.
@@ -1113,21 +3652,38 @@ class YBBackup:
 
         return self.leader_master_ip
 
-    def get_live_tserver_ip(self):
-        if not self.live_tserver_ip:
-            output = self.run_yb_admin(['list_all_tablet_servers'])
-            for line in output.splitlines():
-                if LEADING_UUID_RE.match(line):
-                    fields = split_by_space(line)
-                    ip_port = fields[1]
-                    state = fields[3]
-                    ip, _ = ip_port.split(':')
-                    if state == 'ALIVE':
-                        self.live_tserver_ip = ip
-                        break
+    def list_alive_tservers(self):
+        """
+        :return: the hosts of all alive tablet servers, in the order the master lists them
+        """
+        if self.master_http:
+            try:
+                # The web servers are expected to listen on the hosts of the tablet servers.
+                tservers = self.master_http.list_tservers()
+                for (host, web_port, _) in tservers:
+                    self.tserver_ip_to_web_port.setdefault(host, web_port)
+                return [host for (host, _, state) in tservers if state == 'ALIVE']
+            except BackupException as ex:
+                logging.warning("Falling back to yb-admin to list tablet servers: {}".format(ex))
+
+        tserver_ips = []
+        output = self.run_yb_admin(['list_all_tablet_servers'])
+        for line in output.splitlines():
+            if LEADING_UUID_RE.match(line):
+                fields = split_by_space(line)
+                ip_port = fields[1]
+                state = fields[3]
+                ip, _ = ip_port.split(':')
+                if state == 'ALIVE':
+                    tserver_ips.append(ip)
+        return tserver_ips
 
+    def get_live_tserver_ip(self):
         if not self.live_tserver_ip:
-            raise BackupException("Cannot get alive TS:\n{}".format(output))
+            tserver_ips = self.list_alive_tservers()
+            if not tserver_ips:
+                raise BackupException("Cannot get alive TS")
+            self.live_tserver_ip = tserver_ips[0]
 
         return self.live_tserver_ip
 
@@ -1277,67 +3833,55 @@ class YBBackup:
     def wait_for_snapshot(self, snapshot_id, op, timeout_sec, update_table_list,
                           complete_state='COMPLETE'):
         """
-        Waits for the given snapshot to finish being created or restored.
+        Waits for the given snapshot to finish being created or restored. The state is polled
+        without details, first right away and then with growing jittered delays. The table list
+        is fetched once, after the snapshot is complete.
         """
         start_time = time.time()
-        snapshot_done = False
-        snapshot_tables = []
-        snapshot_keyspaces = []
-        snapshot_table_uuids = []
         failed_state = 'FAILED'
+        delays = backoff_delays(SNAPSHOT_POLL_INITIAL_DELAY_SEC, SNAPSHOT_POLL_MAX_DELAY_SEC)
+        num_polls = 0
+        while True:
+            num_polls += 1
+            (state, _) = find_snapshot_block(self.run_yb_admin(['list_snapshots']), snapshot_id)
+            if state == complete_state:
+                break
+            if state == failed_state:
+                raise BackupException('Snapshot id %s, %s failed!' % (snapshot_id, op))
+            elapsed = time.time() - start_time
+            if elapsed >= timeout_sec:
+                raise BackupException('Timed out waiting for snapshot!')
+            logging.info('Waiting for snapshot %s to complete...' % (op))
+            time.sleep(min(next(delays), timeout_sec - elapsed))
+
+        elapsed = time.time() - start_time
+        self.snapshot_waits.append({"snapshot_id": snapshot_id, "op": op,
+                                    "seconds": round(elapsed, 3), "polls": num_polls})
+        logging.info("Snapshot {} {} took {:.3f} sec and {} polls ({:.1f}% of the {} sec "
+                     "timeout)".format(snapshot_id, op, elapsed, num_polls,
+                                       100.0 * elapsed / timeout_sec, timeout_sec))
 
-        yb_admin_args = ['list_snapshots']
         if update_table_list:
-            yb_admin_args += ['SHOW_DETAILS']
-
-        while time.time() - start_time < timeout_sec and not snapshot_done:
-            output = self.run_yb_admin(yb_admin_args)
-            # Expected format:
-            # Snapshot UUID                         State
-            # 0436035d-c4c5-40c6-b45b-19538849b0d9  COMPLETE
-            #   {"type":"NAMESPACE","id":"e4c5591446db417f83a52c679de03118","data":{"name":"a",...}}
-            #   {"type":"TABLE","id":"d9603c2cab0b48ec807936496ac0e70e","data":{"name":"t2",...}}
-            #   {"type":"TABLE","id":"28b5cebe9b0c4cdaa70ce9ceab31b1e5","data":{\
-            #       "name":"t2idx","indexed_table_id":"d9603c2cab0b48ec807936496ac0e70e",...}}
-            # c1ad61bf-a42b-4bbb-94f9-28516985c2c5  COMPLETE
-            #   ...
+            (_, details) = find_snapshot_block(
+                self.run_yb_admin(['list_snapshots', 'SHOW_DETAILS']), snapshot_id)
+            snapshot_tables = []
+            snapshot_keyspaces = []
+            snapshot_table_uuids = []
             keyspaces = {}
-            for line in output.splitlines():
-                if not snapshot_done:
-                    if line.find(snapshot_id) == 0:
-                        (found_snapshot_id, state) = line.split()
-                        if found_snapshot_id == snapshot_id:
-                            if state == complete_state:
-                                snapshot_done = True
-                                if not update_table_list:
-                                    break
-                            elif state == failed_state:
-                                raise BackupException(
-                                    'Snapshot id %s, %s failed!' % (snapshot_id, op))
-                elif update_table_list:
-                    if line[0] != ' ':
-                        break
-                    loaded_json = json.loads(line)
-                    object_type = loaded_json['type']
-                    object_id = loaded_json['id']
-                    data = loaded_json['data']
-                    if object_type == 'NAMESPACE' and object_id not in keyspaces:
-                        keyspace_prefix = 'ysql.' \
-                            if data['database_type'] == 'YQL_DATABASE_PGSQL' else ''
-                        keyspaces[object_id] = keyspace_prefix + data['name']
-                    elif object_type == 'TABLE':
-                        snapshot_keyspaces.append(keyspaces[data['namespace_id']])
-                        snapshot_tables.append(data['name'])
-                        snapshot_table_uuids.append(object_id)
-
-            if not snapshot_done:
-                logging.info('Waiting for snapshot %s to complete...' % (op))
-                time.sleep(5)
-
-        if not snapshot_done:
-            raise BackupException('Timed out waiting for snapshot!')
+            for line in details:
+                loaded_json = json.loads(line)
+                object_type = loaded_json['type']
+                object_id = loaded_json['id']
+                data = loaded_json['data']
+                if object_type == 'NAMESPACE' and object_id not in keyspaces:
+                    keyspace_prefix = 'ysql.' \
+                        if data['database_type'] == 'YQL_DATABASE_PGSQL' else ''
+                    keyspaces[object_id] = keyspace_prefix + data['name']
+                elif object_type == 'TABLE':
+                    snapshot_keyspaces.append(keyspaces[data['namespace_id']])
+                    snapshot_tables.append(data['name'])
+                    snapshot_table_uuids.append(object_id)
 
-        if update_table_list:
             if len(snapshot_tables) == 0:
                 raise CompatibilityException("Created snapshot does not have tables.")
 
@@ -1353,31 +3897,82 @@ class YBBackup:
 
         logging.info('Snapshot id %s %s completed successfully' % (snapshot_id, op))
 
-    def find_tablet_leaders(self):
+    def list_tablet_leaders(self, yb_admin_args):
         """
-        Lists all tablets and their leaders for the table of interest.
+        Lists the tablets and their leaders of one table.
+        :param yb_admin_args: the list_tablets arguments for the table
         :return: a list of (tablet id, leader host) tuples
         """
         tablet_leaders = []
+        output = self.run_yb_admin(list(yb_admin_args))
+        for line in output.splitlines():
+            if LEADING_UUID_RE.match(line):
+                fields = split_by_tab(line)
+                tablet_id = fields[0]
+                tablet_leader_host_port = fields[2]
+                ts_host, _ = tablet_leader_host_port.split(":")
+                tablet_leaders.append((tablet_id, ts_host))
+        return tablet_leaders
+
+    def list_tablet_leaders_http(self, tables):
+        """
+        Lists the tablets and their leaders of the given tables with one master HTTP query.
+        :param tables: the list_tablets arguments of the tables, see find_tablet_leaders()
+        :return: a map from the arguments of each table to its (tablet id, leader host) tuples
+        """
+        entities = self.master_http.dump_entities()
+        tablet_leaders_by_table = {}
+        for yb_admin_args in tables:
+            if yb_admin_args[1].startswith('tableid.'):
+                table_id = yb_admin_args[1][len('tableid.'):]
+            else:
+                table_id = MasterHttpClient.find_table_id(
+                    entities, yb_admin_args[1], yb_admin_args[2])
+            tablet_leaders_by_table[yb_admin_args] = MasterHttpClient.tablet_leaders(
+                entities, table_id)
+        return tablet_leaders_by_table
 
+    def find_tablet_leaders(self):
+        """
+        Lists all tablets and their leaders for the tables of interest. The tables are listed in
+        parallel, once per run.
+        :return: a list of (tablet id, leader host) tuples
+        """
+        tables = []
         for i in range(0, len(self.args.table)):
             # Don't call list_tablets on a parent colocated table.
             if is_parent_colocated_table_name(self.args.table[i]):
                 continue
 
             if self.args.table_uuid:
-                yb_admin_args = ['list_tablets', 'tableid.' + self.args.table_uuid[i], '0']
+                yb_admin_args = ('list_tablets', 'tableid.' + self.args.table_uuid[i], '0')
             else:
-                yb_admin_args = ['list_tablets', self.args.keyspace[i], self.args.table[i], '0']
+                yb_admin_args = ('list_tablets', self.args.keyspace[i], self.args.table[i], '0')
+            tables.append(yb_admin_args)
 
-            output = self.run_yb_admin(yb_admin_args)
-            for line in output.splitlines():
-                if LEADING_UUID_RE.match(line):
-                    fields = split_by_tab(line)
-                    tablet_id = fields[0]
-                    tablet_leader_host_port = fields[2]
-                    ts_host, _ = tablet_leader_host_port.split(":")
-                    tablet_leaders.append((tablet_id, ts_host))
+        missing_tables = [yb_admin_args for yb_admin_args in tables
+                          if yb_admin_args not in self.tablet_leaders_by_table]
+        if missing_tables and self.master_http:
+            try:
+                self.tablet_leaders_by_table.update(
+                    self.list_tablet_leaders_http(missing_tables))
+                missing_tables = []
+            except BackupException as ex:
+                logging.warning("Falling back to yb-admin to list tablets: {}".format(ex))
+
+        parallel_list = MultiArgParallelCmd(self.list_tablet_leaders)
+        for yb_admin_args in missing_tables:
+            parallel_list.add_args(yb_admin_args)
+        if parallel_list.args:
+            if not self.args.local_yb_admin_binary:
+                # Find the master leader once instead of in every thread.
+                self.get_leader_master_ip()
+            for (yb_admin_args,), tablet_leaders in parallel_list.run(self.pool).items():
+                self.tablet_leaders_by_table[yb_admin_args] = tablet_leaders
+
+        tablet_leaders = []
+        for yb_admin_args in tables:
+            tablet_leaders += self.tablet_leaders_by_table[yb_admin_args]
         return tablet_leaders
 
     def create_remote_tmp_dir(self, server_ip):
@@ -1391,63 +3986,146 @@ class YBBackup:
 
     def upload_cloud_config(self, server_ip):
         if server_ip not in self.server_ips_with_uploaded_cloud_cfg:
-            if self.args.verbose:
-                logging.info(
-                    "Uploading {} to server {}".format(self.cloud_cfg_file_path, server_ip))
-
             output = self.create_remote_tmp_dir(server_ip)
-            if self.is_k8s():
-                k8s_details = KubernetesDetails(server_ip, self.k8s_namespace_to_cfg)
-                output += self.run_program([
-                    'kubectl',
-                    'cp',
-                    self.cloud_cfg_file_path,
-                    '{}/{}:{}'.format(
-                        k8s_details.namespace, k8s_details.pod_name, self.get_tmp_dir()),
-                    '-c',
-                    k8s_details.container,
-                    '--no-preserve=true'
-                ], env=k8s_details.env_config)
-            elif not self.args.no_ssh:
-                if self.needs_change_user():
-                    # TODO: Currently ssh_wrapper_with_sudo.sh will only change users to yugabyte,
-                    # not args.remote_user.
-                    ssh_wrapper_path = os.path.join(SCRIPT_DIR, 'ssh_wrapper_with_sudo.sh')
-                    output += self.run_program(
-                        ['scp',
-                         '-S', ssh_wrapper_path,
-                         '-o', 'StrictHostKeyChecking=no',
-                         '-o', 'UserKnownHostsFile=/dev/null',
-                         '-i', self.args.ssh_key_path,
-                         '-P', self.args.ssh_port,
-                         '-q',
-                         self.cloud_cfg_file_path,
-                         '%s@%s:%s' % (self.args.ssh_user, server_ip, self.get_tmp_dir())])
-                else:
-                    output += self.run_program(
-                        ['scp',
-                         '-o', 'StrictHostKeyChecking=no',
-                         '-o', 'UserKnownHostsFile=/dev/null',
-                         '-i', self.args.ssh_key_path,
-                         '-P', self.args.ssh_port,
-                         '-q',
-                         self.cloud_cfg_file_path,
-                         '%s@%s:%s' % (self.args.ssh_user, server_ip, self.get_tmp_dir())])
+            # With --no_ssh, the commands run here and find the files in place.
+            if self.is_k8s() or not self.args.no_ssh:
+                for local_path in [self.cloud_cfg_file_path] + self.storage_files:
+                    if self.args.verbose:
+                        logging.info("Uploading {} to server {}".format(local_path, server_ip))
+                    output += self.copy_file_to_server(local_path, server_ip)
 
             self.server_ips_with_uploaded_cloud_cfg[server_ip] = output
 
             if self.args.verbose:
-                logging.info("Uploading {} to server {} done: {}".format(
-                    self.cloud_cfg_file_path, server_ip, output))
+                logging.info("Uploading files to server {} done: {}".format(server_ip, output))
 
-    def run_ssh_cmd(self, cmd, server_ip, upload_cloud_cfg=True, num_ssh_retry=3, env_vars=None):
+    def copy_file_to_server(self, local_path, server_ip):
         """
-        Runs the given command on the given remote server over SSH.
-        :param cmd: either a string, or a list of arguments. In the latter case, each argument
-                    is properly escaped before being passed to ssh.
-        :param server_ip: IP address or host name of the server to SSH into.
-        :return: the standard output of the SSH command
+        Copies a file of the temporary directory to the same path on the given server, over
+        kubectl or ssh.
+        :return: the output of the copy
+        """
+        if self.is_k8s():
+            k8s_details = KubernetesDetails(server_ip, self.k8s_namespace_to_cfg)
+            return self.run_program([
+                'kubectl',
+                'cp',
+                local_path,
+                '{}/{}:{}'.format(
+                    k8s_details.namespace, k8s_details.pod_name, self.get_tmp_dir()),
+                '-c',
+                k8s_details.container,
+                '--no-preserve=true'
+            ], env=k8s_details.env_config)
+        elif self.native_ssh_executor is not None:
+            # Written by the remote user, like the scp through ssh_wrapper_with_sudo.sh.
+            change_user_cmd = 'sudo -u %s' % (self.args.remote_user) \
+                if self.needs_change_user() else ''
+            remote_path = os.path.join(self.get_tmp_dir(), os.path.basename(local_path))
+            with open(local_path, 'rb') as local_file:
+                return self.native_ssh_executor.run(
+                    server_ip,
+                    'cd / && %s bash -c ' % (change_user_cmd) +
+                    pipes.quote('cat > ' + pipes.quote(remote_path)),
+                    stdin_data=local_file.read()).decode('utf-8')
+        elif self.needs_change_user():
+            # TODO: Currently ssh_wrapper_with_sudo.sh will only change users to yugabyte,
+            # not args.remote_user.
+            ssh_wrapper_path = os.path.join(SCRIPT_DIR, 'ssh_wrapper_with_sudo.sh')
+            return self.run_program(
+                ['scp',
+                 '-S', ssh_wrapper_path,
+                 '-o', 'StrictHostKeyChecking=no',
+                 '-o', 'UserKnownHostsFile=/dev/null',
+                 '-i', self.args.ssh_key_path,
+                 '-P', self.args.ssh_port,
+                 '-q'] +
+                self.ssh_control_options(server_ip) +
+                [local_path,
+                 '%s@%s:%s' % (self.args.ssh_user, server_ip, self.get_tmp_dir())])
+        else:
+            return self.run_program(
+                ['scp',
+                 '-o', 'StrictHostKeyChecking=no',
+                 '-o', 'UserKnownHostsFile=/dev/null',
+                 '-i', self.args.ssh_key_path,
+                 '-P', self.args.ssh_port,
+                 '-q'] +
+                self.ssh_control_options(server_ip) +
+                [local_path,
+                 '%s@%s:%s' % (self.args.ssh_user, server_ip, self.get_tmp_dir())])
+
+    def get_ssh_pool(self):
+        """
+        :return: the SshConnectionPool commands run over, or None if they do not use ssh
+        """
+        if (self.args.no_ssh or self.is_k8s() or self.args.disable_ssh_multiplexing or
+                self.native_ssh_executor is not None):
+            return None
+        with self.ssh_pool_lock:
+            if self.ssh_pool is None:
+                self.ssh_pool = SshConnectionPool(
+                    ['-o', 'StrictHostKeyChecking=no',
+                     '-o', 'UserKnownHostsFile=/dev/null',
+                     '-i', self.args.ssh_key_path,
+                     '-p', self.args.ssh_port,
+                     '-q',
+                     '-l', self.args.ssh_user])
+                # Exit hooks run in reverse order, so the remote cleanup runs before this one.
+                atexit.register(self.ssh_pool.close)
+        return self.ssh_pool
+
+    def connect_native_ssh(self, server_ip):
+        """
+        :return: an authenticated paramiko transport to the given server
+        """
+        client = paramiko.SSHClient()
+        # Same as StrictHostKeyChecking=no of the ssh commands.
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(server_ip, port=int(self.args.ssh_port), username=self.args.ssh_user,
+                       key_filename=self.args.ssh_key_path, allow_agent=False,
+                       look_for_keys=self.args.ssh_key_path is None)
+        return client.get_transport()
+
+    def run_native_ssh_cmd(self, remote_cmd, server_ip, num_retry):
+        """
+        Runs a command built by run_ssh_cmd() on the native SSH executor, retrying like
+        run_program().
+        """
+        if self.args.verbose:
+            logging.info("Running command on {} in process: {}".format(server_ip, remote_cmd))
+        while num_retry > 0:
+            num_retry = num_retry - 1
+            try:
+                output = self.native_ssh_executor.run(server_ip, remote_cmd).decode('utf-8')
+                if self.args.verbose:
+                    logging.info(
+                        "Output from running command [[ {} ]]:\n{}\n[[ END OF OUTPUT ]]".format(
+                            remote_cmd, output))
+                return output
+            except subprocess.CalledProcessError as e:
+                logging.error("Failed to run command [[ {} ]] on {}: code={} output={}".format(
+                    remote_cmd, server_ip, e.returncode, e.output.decode('utf-8', 'replace')))
+                self.sleep_or_raise(num_retry, 10, e)
+            except Exception as ex:
+                logging.error("Failed to run command [[ {} ]] on {}: {}".format(
+                    remote_cmd, server_ip, ex))
+                self.sleep_or_raise(num_retry, 10, ex)
+
+    def ssh_control_options(self, server_ip):
+        ssh_pool = self.get_ssh_pool()
+        return ssh_pool.control_options(server_ip) if ssh_pool is not None else []
+
+    def prepare_ssh_cmd(self, cmd, server_ip, upload_cloud_cfg=True, num_ssh_retry=3,
+                        env_vars=None):
         """
+        Sets up the given server for run_ssh_cmd() and builds the command that runs cmd there.
+        :return: the program arguments, the number of retries and the environment for
+            run_program(). The program arguments are the command line for the native SSH
+            executor instead when it is used.
+        """
+        # Before the upload registers its exit hooks, which need the pool open.
+        ssh_pool = self.get_ssh_pool()
         if upload_cloud_cfg and self.has_cfg_file():
             self.upload_cloud_config(server_ip)
 
@@ -1469,7 +4147,7 @@ class YBBackup:
             cmd = "{} {}".format(bash_env_args, cmd)
         if self.is_k8s():
             k8s_details = KubernetesDetails(server_ip, self.k8s_namespace_to_cfg)
-            return self.run_program([
+            return ([
                 'kubectl',
                 'exec',
                 '-t',
@@ -1482,34 +4160,117 @@ class YBBackup:
                 'bash',
                 '-c',
                 cmd],
-                num_retry=num_retries,
-                env=k8s_details.env_config)
+                num_retries,
+                k8s_details.env_config)
         elif not self.args.no_ssh:
             change_user_cmd = 'sudo -u %s' % (self.args.remote_user) \
                 if self.needs_change_user() else ''
-            return self.run_program([
-                'ssh',
-                '-o', 'StrictHostKeyChecking=no',
-                '-o', 'UserKnownHostsFile=/dev/null',
-                '-i', self.args.ssh_key_path,
-                '-p', self.args.ssh_port,
-                '-q',
-                '%s@%s' % (self.args.ssh_user, server_ip),
-                'cd / && %s bash -c ' % (change_user_cmd) + pipes.quote(cmd)],
-                num_retry=num_retries)
+            if self.native_ssh_executor is not None:
+                return ('cd / && %s bash -c ' % (change_user_cmd) + pipes.quote(cmd),
+                        num_retries, None)
+            return (
+                ['ssh'] +
+                (ssh_pool.control_options(server_ip) if ssh_pool is not None else []) +
+                ['-o', 'StrictHostKeyChecking=no',
+                 '-o', 'UserKnownHostsFile=/dev/null',
+                 '-i', self.args.ssh_key_path,
+                 '-p', self.args.ssh_port,
+                 '-q',
+                 '%s@%s' % (self.args.ssh_user, server_ip),
+                 'cd / && %s bash -c ' % (change_user_cmd) + pipes.quote(cmd)],
+                num_retries,
+                None)
+        else:
+            return (['bash', '-c', cmd], 1, None)
+
+    def run_ssh_cmd(self, cmd, server_ip, upload_cloud_cfg=True, num_ssh_retry=3, env_vars=None):
+        """
+        Runs the given command on the given remote server over SSH.
+        :param cmd: either a string, or a list of arguments. In the latter case, each argument
+                    is properly escaped before being passed to ssh.
+        :param server_ip: IP address or host name of the server to SSH into.
+        :return: the standard output of the SSH command
+        """
+        (args, num_retry, env) = self.prepare_ssh_cmd(
+            cmd, server_ip, upload_cloud_cfg, num_ssh_retry, env_vars)
+        if isinstance(args, str):
+            return self.run_native_ssh_cmd(args, server_ip, num_retry)
+        return self.run_program(args, num_retry=num_retry, env=env)
+
+    def ssh_cmd_may_block(self, server_ip, upload_cloud_cfg):
+        """
+        :return: whether prepare_ssh_cmd() may still have to run commands for the given server
+        """
+        if (upload_cloud_cfg and self.has_cfg_file() and
+                server_ip not in self.server_ips_with_uploaded_cloud_cfg):
+            return True
+        ssh_pool = self.get_ssh_pool()
+        return ssh_pool is not None and server_ip not in ssh_pool.masters
+
+    async def run_ssh_cmd_async(self, cmd, server_ip, upload_cloud_cfg=True, num_ssh_retry=3,
+                                env_vars=None):
+        """
+        Coroutine version of run_ssh_cmd() for the AsyncCmdEngine.
+        """
+        loop = asyncio.get_running_loop()
+        prepare = functools.partial(self.prepare_ssh_cmd, cmd, server_ip, upload_cloud_cfg,
+                                    num_ssh_retry, env_vars)
+        if self.ssh_cmd_may_block(server_ip, upload_cloud_cfg):
+            # The first command to a server uploads the cloud config and connects.
+            (args, num_retry, env) = await loop.run_in_executor(self.pool.executor, prepare)
+        else:
+            (args, num_retry, env) = prepare()
+        if isinstance(args, str):
+            return await loop.run_in_executor(
+                self.pool.executor, self.run_native_ssh_cmd, args, server_ip, num_retry)
+        return await self.run_program_async(args, num_retry=num_retry, env=env)
+
+    def cmd_limits(self):
+        """
+        :return: the CmdLimits for the per-tablet command sequences
+        """
+        if isinstance(self.pool, AsyncCmdEngine):
+            global_ops = self.max_remote_ops()
         else:
-            return self.run_program(['bash', '-c', cmd])
+            global_ops = self.args.parallelism
+        return CmdLimits(global_ops, self.args.max_ops_per_tserver,
+                         self.args.max_ops_per_data_dir)
+
+    def max_remote_ops(self):
+        """
+        :return: the number of remote command sequences the asyncio engine runs at once
+        """
+        return self.args.max_remote_ops or self.args.parallelism
+
+    def parallel_ssh_cmd_fn(self):
+        """
+        :return: the function running remote commands that suits the parallel engine
+        """
+        if isinstance(self.pool, AsyncCmdEngine):
+            return self.run_ssh_cmd_async
+        return self.run_ssh_cmd
+
+    def get_tserver_web_address(self, tserver_ip):
+        web_port = (self.tserver_ip_to_web_port[tserver_ip]
+                    if tserver_ip in self.tserver_ip_to_web_port else DEFAULT_TS_WEB_PORT)
+        return "{}:{}".format(tserver_ip, web_port)
 
     def find_data_dirs(self, tserver_ip):
         """
         Finds the data directories on the given tserver. This just reads a config file on the target
-        server.
+        server, unless the data directory cache has them.
         :param tserver_ip: tablet server ip
         :return: a list of top-level YB data directories
         """
-        web_port = (self.tserver_ip_to_web_port[tserver_ip]
-                    if tserver_ip in self.tserver_ip_to_web_port else DEFAULT_TS_WEB_PORT)
-        output = self.run_program(['curl', "{}:{}/varz".format(tserver_ip, web_port)], num_retry=10)
+        web_address = self.get_tserver_web_address(tserver_ip)
+        data_dirs = self.data_dir_cache.get(web_address)
+        if data_dirs is not None:
+            if self.args.verbose:
+                logging.info("Cached data directories of tablet server '{}': {}".format(
+                    tserver_ip, data_dirs))
+            return data_dirs
+
+        output = self.run_program(['curl', "{}/varz".format(web_address)], num_retry=10)
         data_dirs = []
         for line in output.split('\n'):
             if line.startswith(FS_DATA_DIRS_ARG_PREFIX):
@@ -1522,14 +4283,59 @@ class YBBackup:
         if not data_dirs:
             raise BackupException(
                 ("Did not find any data directories in tserver by querying /varz endpoint"
-                 " on tserver '{}:{}'. Was looking for '{}', got this: [[ {} ]]").format(
-                     tserver_ip, web_port, FS_DATA_DIRS_ARG_PREFIX, output))
+                 " on tserver '{}'. Was looking for '{}', got this: [[ {} ]]").format(
+                     web_address, FS_DATA_DIRS_ARG_PREFIX, output))
         elif self.args.verbose:
             logging.info("Found data directories on tablet server '{}': {}".format(
                 tserver_ip, data_dirs))
 
+        self.data_dir_cache.put(web_address, data_dirs)
         return data_dirs
 
+    def run_data_dir_cmd(self, tserver_ip, cmd_fn):
+        """
+        Runs a command on the data directories of the given tserver. If the command fails on
+        cached data directories, they are read from the tserver again and the command is retried
+        once, in case they changed.
+        :param cmd_fn: returns the command for a list of data directories
+        :return: the data directories and the output of the command
+        """
+        web_address = self.get_tserver_web_address(tserver_ip)
+        cached = web_address in self.data_dir_cache
+        data_dirs = self.find_data_dirs(tserver_ip)
+        try:
+            return data_dirs, self.run_ssh_cmd(cmd_fn(data_dirs), tserver_ip)
+        except Exception as ex:
+            self.data_dir_cache.invalidate(web_address)
+            if not cached:
+                raise
+            logging.info("Command failed on the cached data directories {} of tablet server "
+                         "'{}', finding them again: {}".format(data_dirs, tserver_ip, ex))
+        data_dirs = self.find_data_dirs(tserver_ip)
+        return data_dirs, self.run_ssh_cmd(cmd_fn(data_dirs), tserver_ip)
+
+    def find_tablet_dirs(self, tserver_ip, data_dir):
+        """
+        Finds the tablet directories of all tables in the given data directory.
+        :param tserver_ip: tablet server ip
+        :param data_dir: one of the data directories of the tablet server
+        :return: a list of tablet directories
+        """
+        try:
+            output = self.run_ssh_cmd(
+                ['find', data_dir, '-maxdepth', TABLET_DIR_DEPTH,
+                 '!', '-readable', '-prune', '-o',
+                 '-name', TABLET_MASK,
+                 '-and',
+                 '-wholename', TABLET_DIR_GLOB.format('*'),
+                 '-prune', '-print'],
+                tserver_ip)
+        except Exception:
+            # The data directories may have changed, the next run reads them again.
+            self.data_dir_cache.invalidate(self.get_tserver_web_address(tserver_ip))
+            raise
+        return [line.strip() for line in output.split("\n") if line.strip()]
+
     def generate_snapshot_dirs(self, data_dir_by_tserver, snapshot_id,
                                tablets_by_tserver_ip, table_ids):
         """
@@ -1546,37 +4352,32 @@ class YBBackup:
         tserver_ip_to_tablet_id_to_snapshot_dirs = {}
         deleted_tablets_by_tserver_ip = {}
 
+        # One walk per data directory finds the tablets of all tables at once.
+        parallel_find = MultiArgParallelCmd(self.find_tablet_dirs)
+        for tserver_ip in tablets_by_tserver_ip:
+            for data_dir in data_dir_by_tserver[tserver_ip]:
+                parallel_find.add_args(tserver_ip, data_dir)
         tserver_ip_to_tablet_dirs = {}
         for tserver_ip in tablets_by_tserver_ip:
             tserver_ip_to_tablet_dirs.setdefault(tserver_ip, [])
+        table_ids = set(table_ids)
+        for (tserver_ip, _), tablet_dirs in parallel_find.run(self.pool).items():
+            for tablet_dir in tablet_dirs:
+                table_dir = os.path.basename(os.path.dirname(tablet_dir))
+                if table_dir[len('table-'):] in table_ids:
+                    tserver_ip_to_tablet_dirs[tserver_ip].append(tablet_dir)
 
-        for table_id in table_ids:
-            for tserver_ip in tablets_by_tserver_ip:
-                data_dirs = data_dir_by_tserver[tserver_ip]
-                tablet_dirs = tserver_ip_to_tablet_dirs[tserver_ip]
-
-                for data_dir in data_dirs:
-                    # Find all tablets for this table on this TS in this data_dir:
-                    output = self.run_ssh_cmd(
-                      ['find', data_dir,
-                       '!', '-readable', '-prune', '-o',
-                       '-name', TABLET_MASK,
-                       '-and',
-                       '-wholename', TABLET_DIR_GLOB.format(table_id),
-                       '-print'],
-                      tserver_ip)
-                    tablet_dirs += [line.strip() for line in output.split("\n") if line.strip()]
-
-                if self.args.verbose:
-                    msg = "Found tablet directories for table '{}' on  tablet server '{}': {}"
-                    logging.info(msg.format(table_id, tserver_ip, tablet_dirs))
+        for tserver_ip, tablet_dirs in tserver_ip_to_tablet_dirs.items():
+            if self.args.verbose:
+                msg = "Found tablet directories for tables {} on tablet server '{}': {}"
+                logging.info(msg.format(sorted(table_ids), tserver_ip, tablet_dirs))
 
-                if not tablet_dirs:
-                    logging.error("No tablet directory found for table '{}' on "
-                                  "tablet server '{}'.".format(table_id, tserver_ip))
+            if not tablet_dirs:
+                logging.error("No tablet directory found for tables {} on "
+                              "tablet server '{}'.".format(sorted(table_ids), tserver_ip))
 
-                    raise BackupException("Tablets for table " + table_id
-                                          + " not found on tablet server " + tserver_ip)
+                raise BackupException("Tablets for tables " + ", ".join(sorted(table_ids))
+                                      + " not found on tablet server " + tserver_ip)
 
         for tserver_ip in tablets_by_tserver_ip:
             tablets = tablets_by_tserver_ip[tserver_ip]
@@ -1613,96 +4414,105 @@ class YBBackup:
 
         return (tserver_ip_to_tablet_id_to_snapshot_dirs, deleted_tablets_by_tserver_ip)
 
-    def find_snapshot_files(self, data_dir, snapshot_id, tserver_ip):
+    def discover_snapshot(self, tserver_ip, snapshot_id):
         """
-        Find snapshot directories under the given data directory for the given snapshot id on the
-        given tserver.
-        :param data_dir: top-level data directory
-        :param snapshot_id: snapshot UUID
+        Finds the snapshot directories of the given snapshot and the files in them on the given
+        tserver. All data directories are walked by one find command.
         :param tserver_ip: tablet server IP or host name
-        :return: a list of absolute paths of remote snapshot directories for the given snapshot
-        """
-        #files plus directories need find command like one below..
-        #look in manifest of last save point and then compare to current
-        output = self.run_ssh_cmd(
-            ['find', data_dir,
-             '-mindepth', SNAPSHOT_FILES_DIR_MIN_DEPTH,
-             '-maxdepth', SNAPSHOT_FILES_DIR_MAX_DEPTH,
-             '-name', "*", '-and',
-             '-wholename', DIFF_SNAPSHOT_DIR_GLOB + snapshot_id + "*", '-type', 'f'],
-            tserver_ip)
-        return [line.strip() for line in output.split("\n") if line.strip()]
-
-    def get_filelist(self, tablet_leaders, snapshot_id):
+        :param snapshot_id: snapshot UUID
+        :return: a SnapshotDiscovery
         """
-         Uploads snapshot directories from all tablet servers hosting our table to subdirectories
-         of the given target backup directory.
-         :param tablet_leaders: a list of (tablet_id, tserver_ip) pairs
-         :param snapshot_id: self-explanatory
-         :param snapshot_filepath: the top-level directory under which to upload the data directories
-         """
-        tablets_by_leader_ip = {}
-        for (tablet_id, leader_ip) in tablet_leaders:
-            tablets_by_leader_ip.setdefault(leader_ip, set()).add(tablet_id)
-
-        tserver_ips = sorted(tablets_by_leader_ip.keys())
-        if self.args.verbose:
-            logging.info('Tablets_by_leader_ip {} {}'.format(type(tablets_by_leader_ip), tablets_by_leader_ip))
-        data_dir_by_tserver = SingleArgParallelCmd(self.find_data_dirs, tserver_ips).run(self.pool)
+        (data_dirs, output) = self.run_data_dir_cmd(tserver_ip, lambda data_dirs: (
+            ['find'] + data_dirs +
+            ['-maxdepth', SNAPSHOT_FILES_DIR_MAX_DEPTH,
+             '!', '-readable', '-prune', '-o',
+             '-wholename', DIFF_SNAPSHOT_DIR_GLOB + snapshot_id + '*', '(',
+             '-type', 'd', '-name', snapshot_id, '-printf', SNAPSHOT_DISCOVERY_DIR_FORMAT, '-o',
+             '-type', 'f', '-printf', SNAPSHOT_DISCOVERY_FILE_FORMAT, ')']))
+        discovery = parse_snapshot_discovery(data_dirs, output)
         if self.args.verbose:
-            logging.info('\nData_dir_by_tserver\n{}\n{}\n'.format( type(data_dir_by_tserver), data_dir_by_tserver))
+            logging.info("Found {} snapshot files in {} on tablet server '{}'".format(
+                sum(len(files) for files in discovery.files.values()), data_dirs, tserver_ip))
+        return discovery
 
+    def discover_snapshots(self, tablet_leaders, snapshot_id):
+        """
+        Runs discover_snapshot() on all tablet servers hosting the given tablets, once per
+        snapshot. The upload reuses what the manifest was built from.
+        :param tablet_leaders: a list of (tablet_id, tserver_ip) pairs
+        :param snapshot_id: snapshot UUID
+        :return: a map from tserver ip to SnapshotDiscovery
+        """
+        if self.snapshot_discovery_id != snapshot_id:
+            self.snapshot_discovery = {}
+            self.snapshot_discovery_id = snapshot_id
+        parallel_discover = MultiArgParallelCmd(self.discover_snapshot)
+        for (_, tserver_ip) in tablet_leaders:
+            if tserver_ip not in self.snapshot_discovery:
+                parallel_discover.add_args(tserver_ip, snapshot_id)
+        if parallel_discover.args:
+            for (tserver_ip, _), discovery in parallel_discover.run(self.pool).items():
+                self.snapshot_discovery[tserver_ip] = discovery
+        return self.snapshot_discovery
+
+    def iter_snapshot_discoveries(self, tablet_leaders, snapshot_id):
+        """
+        Runs discover_snapshot() on all tablet servers hosting the given tablets.
+        :param tablet_leaders: a list of (tablet_id, tserver_ip) pairs
+        :param snapshot_id: snapshot UUID
+        :return: a generator of maps from tserver ip to SnapshotDiscovery. Each map holds one
+            tserver and comes as soon as its discovery is done, or with
+            --disable_pipelined_backup one map holds all of them.
+        """
+        if self.args.disable_pipelined_backup:
+            yield self.discover_snapshots(tablet_leaders, snapshot_id)
+            return
+        if self.snapshot_discovery_id != snapshot_id:
+            self.snapshot_discovery = {}
+            self.snapshot_discovery_id = snapshot_id
+        tserver_ips = []
+        for (_, tserver_ip) in tablet_leaders:
+            if tserver_ip not in tserver_ips:
+                tserver_ips.append(tserver_ip)
         for tserver_ip in tserver_ips:
-            data_dir_by_tserver[tserver_ip] = copy.deepcopy(data_dir_by_tserver[tserver_ip])
-
-        parallel_find_files = MultiArgParallelCmd(self.find_snapshot_files)
-        if self.args.verbose:
-            logging.info('Parallel_find_files {} '.format(parallel_find_files))
-
-        tservers_processed = []
-        while len(tserver_ips) > len(tservers_processed):
-            for tserver_ip in list(tserver_ips):
-                if tserver_ip not in tservers_processed:
-                    data_dirs = data_dir_by_tserver[tserver_ip]
-                    if len(data_dirs) > 0:
-                        data_dir = data_dirs[0]
-                        parallel_find_files.add_args(data_dir, snapshot_id, tserver_ip)
-                        data_dirs.remove(data_dir)
-
-                        if len(data_dirs) == 0:
-                            tservers_processed += [tserver_ip]
-                    else:
-                        tservers_processed += [tserver_ip]
-
-        find_snapshot_file_results = parallel_find_files.run(self.pool)
-        if self.args.verbose:
-            logging.info('Find_snapshot_file_results type {} \n{}'.format(type(find_snapshot_file_results), find_snapshot_file_results))
-
-        return find_snapshot_file_results
+            if tserver_ip in self.snapshot_discovery:
+                yield {tserver_ip: self.snapshot_discovery[tserver_ip]}
+        tserver_ips = [tserver_ip for tserver_ip in tserver_ips
+                       if tserver_ip not in self.snapshot_discovery]
+        if not tserver_ips:
+            return
+        with concurrent.futures.ThreadPoolExecutor(self.args.parallelism) as executor:
+            futures = dict(
+                (executor.submit(self.discover_snapshot, tserver_ip, snapshot_id), tserver_ip)
+                for tserver_ip in tserver_ips)
+            for future in concurrent.futures.as_completed(futures):
+                tserver_ip = futures[future]
+                self.snapshot_discovery[tserver_ip] = future.result()
+                yield {tserver_ip: self.snapshot_discovery[tserver_ip]}
 
-    def find_snapshot_directories(self, data_dir, snapshot_id, tserver_ip):
+    @staticmethod
+    def get_filelist(discovery_by_tserver, snapshot_id):
         """
-        Find snapshot directories under the given data directory for the given snapshot id on the
-        given tserver.
-        :param data_dir: top-level data directory
-        :param snapshot_id: snapshot UUID
-        :param tserver_ip: tablet server IP or host name
-        :return: a list of absolute paths of remote snapshot directories for the given snapshot
+        :param discovery_by_tserver: a map from tserver ip to SnapshotDiscovery
+        :param snapshot_id: self-explanatory
+        :return: a map from (data_dir, snapshot_id, tserver_ip) tuples to the SnapshotFile
+            records under that data directory on that tserver
         """
-        output = self.run_ssh_cmd(
-            ['find', data_dir,
-             '!', '-readable', '-prune', '-o',
-             '-name', snapshot_id, '-and',
-             '-wholename', SNAPSHOT_DIR_GLOB,
-             '-print'],
-            tserver_ip)
-        return [line.strip() for line in output.split("\n") if line.strip()]
+        find_snapshot_file_results = {}
+        for tserver_ip, discovery in discovery_by_tserver.items():
+            for data_dir, files in discovery.files.items():
+                find_snapshot_file_results[(data_dir, snapshot_id, tserver_ip)] = files
+        return find_snapshot_file_results
 
-    def upload_snapshot_directories(self, tablet_leaders, snapshot_id, snapshot_filepath):
+    def prepare_snapshot_uploads(self, parallel_uploads, tablet_leaders, discovery_by_tserver,
+                                 snapshot_id, snapshot_filepath):
         """
-        Uploads snapshot directories from all tablet servers hosting our table to subdirectories
-        of the given target backup directory.
+        Prepares the upload of the snapshot directories from the tablet servers hosting the given
+        tablets to subdirectories of the given target backup directory.
+        :param parallel_uploads: the SequencedParallelCmd to add a sequence per tablet to
         :param tablet_leaders: a list of (tablet_id, tserver_ip) pairs
+        :param discovery_by_tserver: a map from tserver ip to SnapshotDiscovery, for every
+            tserver of tablet_leaders
         :param snapshot_id: self-explanatory
         :param snapshot_filepath: the top-level directory under which to upload the data directories
         """
@@ -1710,41 +4520,20 @@ class YBBackup:
         for (tablet_id, leader_ip) in tablet_leaders:
             tablets_by_leader_ip.setdefault(leader_ip, set()).add(tablet_id)
 
-        tserver_ips = sorted(tablets_by_leader_ip.keys())
-        data_dir_by_tserver = SingleArgParallelCmd(self.find_data_dirs, tserver_ips).run(self.pool)
-
-        for tserver_ip in tserver_ips:
-            data_dir_by_tserver[tserver_ip] = copy.deepcopy(data_dir_by_tserver[tserver_ip])
-
-        parallel_find_snapshots = MultiArgParallelCmd(self.find_snapshot_directories)
-        tservers_processed = []
-        while len(tserver_ips) > len(tservers_processed):
-            for tserver_ip in list(tserver_ips):
-                if tserver_ip not in tservers_processed:
-                    data_dirs = data_dir_by_tserver[tserver_ip]
-                    if len(data_dirs) > 0:
-                        data_dir = data_dirs[0]
-                        parallel_find_snapshots.add_args(data_dir, snapshot_id, tserver_ip)
-                        data_dirs.remove(data_dir)
-
-                        if len(data_dirs) == 0:
-                            tservers_processed += [tserver_ip]
-                    else:
-                        tservers_processed += [tserver_ip]
-
-        find_snapshot_dir_results = parallel_find_snapshots.run(self.pool)
+        # The snapshot directories were found along with the files of the manifest.
+        find_snapshot_dir_results = {}
+        for tserver_ip in tablets_by_leader_ip:
+            discovery = discovery_by_tserver[tserver_ip]
+            for data_dir, snapshot_dirs in discovery.snapshot_dirs.items():
+                find_snapshot_dir_results[(data_dir, snapshot_id, tserver_ip)] = snapshot_dirs
 
         leader_ip_to_tablet_id_to_snapshot_dirs = self.rearrange_snapshot_dirs(
             find_snapshot_dir_results, snapshot_id, tablets_by_leader_ip)
 
-        parallel_uploads = SequencedParallelCmd(self.run_ssh_cmd)
         self.prepare_cloud_ssh_cmds(
              parallel_uploads, leader_ip_to_tablet_id_to_snapshot_dirs, snapshot_filepath,
              snapshot_id, tablets_by_leader_ip, upload=True, snapshot_metadata=None)
 
-        # Run a sequence of steps for each tablet, handling different tablets in parallel.
-        parallel_uploads.run(self.pool)
-
     def rearrange_snapshot_dirs(
             self, find_snapshot_dir_results, snapshot_id, tablets_by_tserver_ip):
         """
@@ -1836,12 +4625,11 @@ class YBBackup:
         logging.info('Uploading %s from tablet server %s to %s URL %s' % (
                      snapshot_dir, tserver_ip, self.args.storage_type, target_filepath))
 
-        # Commands to be run on TSes over ssh for uploading the tablet backup.
+        # Commands to be run on TSes over ssh for uploading the tablet backup. The check-sum and
+        # the uploads do not depend on each other.
         if not self.args.disable_checksums:
             # 1. Create check-sum file (via sha256sum tool).
-            parallel_commands.add_args(create_checksum_cmd, tserver_ip)
-            # 2. Upload check-sum file.
-            parallel_commands.add_args(tuple(upload_checksum_cmd), tserver_ip)
+            parallel_commands.add_parallel_args(create_checksum_cmd, tserver_ip)
 
         if not 'DIRECTORY' in self.manifest_class.storage_tablet_ids[tablet_id].keys():
             if self.args.verbose:
@@ -1850,30 +4638,88 @@ class YBBackup:
         # Actions: move or copy or ignore
         # 1 - copy  2 - move 3 - noop.
         # **********************************
+            copies = []
+            moves = []
             for file in self.manifest_class.storage_tablet_ids[tablet_id]:
                 target_filename = os.path.join(target_filepath, file)
-                if self.manifest_class.storage_tablet_ids[tablet_id][file]["action"] == ACTION_NOOP:
+                entry = self.manifest_class.storage_tablet_ids[tablet_id][file]
+                if entry["action"] == ACTION_NOOP:
                     pass
                 else:
-                    if self.manifest_class.storage_tablet_ids[tablet_id][file]["action"] == ACTION_COPY:
-                        upload_file_cmd = self.storage.upload_file_cmd(self.manifest_class.storage_tablet_ids[tablet_id][file]["src_location"], target_filepath)
-                        parallel_commands.add_args(tuple(upload_file_cmd), tserver_ip)
-                    else:
-                        if self.manifest_class.storage_tablet_ids[tablet_id][file]["action"] == ACTION_MOVE:
-                            upload_file_cmd = self.storage.move_obj_cmd(self.manifest_class.storage_tablet_ids[tablet_id][file]["src_location"], target_filepath)
-                    parallel_commands.add_args(tuple(upload_file_cmd), tserver_ip)
-                    self.manifest_class.storage_tablet_ids[tablet_id][file]["src_location"] = copy.deepcopy(target_filename)
+                    if entry["action"] == ACTION_COPY:
+                        content_key = entry.get("content_key")
+                        if content_key:
+                            # Objects of the dedup store are named by their content key.
+                            target_filename = self.dedup_object_path(content_key)
+                            upload_file_cmd = self.storage.upload_file_cmd(entry["src_location"],
+                                                                           target_filename)
+                            parallel_commands.add_parallel_args(tuple(upload_file_cmd),
+                                                                tserver_ip,
+                                                                weight=entry.get("size") or 0)
+                        else:
+                            copies.append((entry["src_location"], target_filepath, file,
+                                           entry.get("size") or 0))
+                    elif entry["action"] == ACTION_MOVE:
+                        # Moves stay in the storage, only copies transfer the file.
+                        moves.append((entry["src_location"], target_filepath, file, 0))
+                    entry["src_location"] = target_filename
+            self.add_storage_transfers(
+                parallel_commands, tserver_ip, copies,
+                lambda src, dest_dir, file: self.storage.upload_file_cmd(src, dest_dir),
+                self.storage.upload_files_cmd)
+            self.add_storage_transfers(
+                parallel_commands, tserver_ip, moves,
+                lambda src, dest_dir, file: self.storage.move_obj_cmd(src, dest_dir),
+                self.storage.move_objs_cmd)
         else:
-            # 3. Upload tablet folder.
+            # 2. Upload tablet folder.
             if self.args.verbose:
                 logging.info("\n\nUploading directories\n\n")
             upload_tablet_cmd = self.storage.upload_dir_cmd(snapshot_dir, target_filepath)
-            parallel_commands.add_args(tuple(upload_tablet_cmd), tserver_ip)
+            del self.manifest_class.storage_tablet_ids[tablet_id]['DIRECTORY']
+            weight = sum(entry.get("size") or 0
+                         for entry in self.manifest_class.storage_tablet_ids[tablet_id].values())
+            parallel_commands.add_parallel_args(tuple(upload_tablet_cmd), tserver_ip,
+                                                weight=weight)
             for file in self.manifest_class.storage_tablet_ids[tablet_id]:
                 target_filename = os.path.join(target_filepath, file)
-                self.manifest_class.storage_tablet_ids[tablet_id][file]["src_location"]= copy.deepcopy(target_filename)
-            del self.manifest_class.storage_tablet_ids[tablet_id]['DIRECTORY']
+                self.manifest_class.storage_tablet_ids[tablet_id][file]["src_location"]= target_filename
+
+        if not self.args.disable_checksums:
+            # 3. Upload check-sum file once it is created.
+            parallel_commands.add_args(tuple(upload_checksum_cmd), tserver_ip)
+
+        if self.manifest_stream is not None:
+            self.manifest_stream.write_tablet(
+                tablet_id, self.manifest_class.storage_tablet_ids.pop(tablet_id))
+
+    def add_storage_transfers(self, parallel_commands, tserver_ip, transfers, file_cmd,
+                              files_cmd):
+        """
+        Adds the parallel commands running the given file transfers on a tserver, one command
+        per batch of batch_transfers().
 
+        :param parallel_commands: result parallel commands to run.
+        :param tserver_ip: tserver ip on which the commands run.
+        :param transfers: (source path, destination directory, file name, size) tuples.
+        :param file_cmd: function of (source path, destination directory, file name) returning
+            the storage command transferring one file.
+        :param files_cmd: function of (source directory, file names, destination directory)
+            returning the storage command transferring several files, or None.
+        """
+        for batch in batch_transfers(transfers, self.args.max_files_per_storage_cmd,
+                                     self.args.max_mb_per_storage_cmd * 1024 * 1024):
+            cmd = None
+            if len(batch) > 1:
+                (src, dest_dir, _, _) = batch[0]
+                cmd = files_cmd(os.path.dirname(src), [t[2] for t in batch], dest_dir)
+            if cmd is None:
+                for (src, dest_dir, file, size) in batch:
+                    parallel_commands.add_parallel_args(tuple(file_cmd(src, dest_dir, file)),
+                                                        tserver_ip, weight=size)
+            else:
+                parallel_commands.add_parallel_args(tuple(cmd), tserver_ip,
+                                                    weight=sum(t[3] for t in batch))
 
     def prepare_download_command(self, parallel_commands, snapshot_filepath, tablet_id,
                                  tserver_ip, snapshot_dir, snapshot_metadata, restore_mode_file):
@@ -1912,23 +4758,26 @@ class YBBackup:
         parallel_commands.add_args(tuple(rmcmd), tserver_ip)
         # 2. Create temporary snapshot dir.
         parallel_commands.add_args(tuple(mkdircmd), tserver_ip)
+        # The downloads into the temporary dir do not depend on each other.
         if restore_mode_file:
-            for file in self.prev_manifest_class.storage_tablet_ids[old_tablet_id]:
-                target_filename = os.path.join(snapshot_dir_tmp, file)
-                download_file_cmd = self.storage.download_file_cmd(self.prev_manifest_class.storage_tablet_ids[old_tablet_id][file]['src_location'], 
-                                                                   target_filename)
-                parallel_commands.add_args(tuple(download_file_cmd), tserver_ip)
+            downloads = [(entry['src_location'], snapshot_dir_tmp, file, entry.get('size') or 0)
+                         for file, entry in self.prev_manifest_class.tablet_files(old_tablet_id)]
+            self.add_storage_transfers(
+                parallel_commands, tserver_ip, downloads,
+                lambda src, dest_dir, file: self.storage.download_file_cmd(
+                    src, os.path.join(dest_dir, file)),
+                self.storage.download_files_cmd)
         else:
             logging.info('Downloading %s from %s to %s on tablet server %s' % (source_filepath,
                      self.args.storage_type, snapshot_dir_tmp, tserver_ip))
             # Download the data to a tmp directory and then move it in place.
             cmd = self.storage.download_dir_cmd(source_filepath, snapshot_dir_tmp)
             # 3. Download tablet folder.
-            parallel_commands.add_args(tuple(cmd), tserver_ip)
+            parallel_commands.add_parallel_args(tuple(cmd), tserver_ip)
         if not self.args.disable_checksums:
             # 4. Download check-sum file.
-            parallel_commands.add_args(tuple(cmd_checksum), tserver_ip)
-            # 5. Create new check-sum file.
+            parallel_commands.add_parallel_args(tuple(cmd_checksum), tserver_ip)
+            # 5. Create new check-sum file once all files are downloaded.
             parallel_commands.add_args(create_checksum_cmd, tserver_ip)
             # 6. Compare check-sum files.
             parallel_commands.add_args_and_save_result(check_checksum_cmd, tserver_ip)
@@ -1975,7 +4824,10 @@ class YBBackup:
 
                         assert len(snapshot_dirs) == 1
                         snapshot_dir = list(snapshot_dirs)[0] + '/'
-                        parallel_commands.start_command()
+                        # The data directory is the disk the sequence reads or writes.
+                        parallel_commands.start_command(
+                            host=tserver_ip, disk=(tserver_ip, snapshot_dir.split(
+                                ROCKSDB_PATH_PREFIX)[0]))
 
                         if upload:
                             self.prepare_upload_command(
@@ -2219,64 +5071,484 @@ class YBBackup:
                 dest = None
         return dest
 
-    def create_manifest(self, current_manifest, files, tablet_leaders):
-        compare_set_curr = set()
-        copy_set_curr = set()
-        curr_manifest = dict()
-        tablet_from_leader = set()
+    @staticmethod
+    def create_manifest(files, tablet_leaders):
+        """
+        Collects the snapshot files of the tablet leaders.
+        :param files: map from the find_snapshot_files arguments to the files found
+        :param tablet_leaders: a list of (tablet_id, tserver_ip) pairs
+        :return: a map from tablet id to TabletEntry, with an entry for every tablet leader
+        """
+        tablets = {}
+        tablets_by_tserver = {}
+        for (tablet_id, tserver) in tablet_leaders:
+            tablet_id = sys.intern(tablet_id)
+            tablets[tablet_id] = TabletEntry(tablet_id)
+            tablets_by_tserver.setdefault(tserver, set()).add(tablet_id)
         for key, value in files.items():
             tserver = key[2]
-            tablet_from_leader.clear()
-            for leader_tablet in tablet_leaders:
-                if leader_tablet[1] == tserver:
-                    tablet_from_leader.add(leader_tablet[0])
-            for filename in value:
-                fields = filename.split("/")
-                generation = 1
+            tablet_from_leader = tablets_by_tserver.get(tserver, ())
+            for snapshot_file in value:
+                fields = snapshot_file.path.split("/")
                 tablet = fields[-3].split("-")[1].split(".")[0]
                 # todo(zdrudi): this comparison is brittle. find a better way to do this.
                 if not tablet in tablet_from_leader:
                     continue
-                file = fields[-1]
-                dict_key =(tablet + "/" + file)
-                if not current_manifest.storage_tablet_ids:
-                    current_manifest.storage_tablet_ids = dict()
-                curr_manifest[dict_key] = \
-                    {"filename": file, "generation": generation, "src_location": filename}
-                if file.find(".sst") != -1:
-                    compare_set_curr.add(dict_key)
+                tablets[tablet].add_file(sys.intern(fields[-1]), snapshot_file.path,
+                                         (tserver, snapshot_file.device, snapshot_file.inode),
+                                         snapshot_file.size)
+        return tablets
+
+    def get_planned_location(self, entry, snapshot_filepath):
+        """
+        :return: where the given planned entry is stored once the backup is uploaded.
+        """
+        if entry.content_key is not None and self.args.dedup_store:
+            return self.dedup_object_path(entry.content_key)
+        return self.get_upload_file_path(snapshot_filepath, entry.tablet_id, entry.filename)
+
+    def dedup_object_path(self, content_key):
+        return os.path.join(self.args.dedup_store, 'objects', content_key[:2], content_key)
+
+    def load_dedup_index(self, local_path):
+        """
+        Downloads the index of the dedup store. A store without an index is empty.
+        """
+        prev_disable_checksums = self.args.disable_checksums
+        self.args.disable_checksums = True
+        try:
+            self.download_file(os.path.join(self.args.dedup_store, DEDUP_INDEX), local_path,
+                               run_local=True)
+        except Exception as ex:
+            logging.info("No index in dedup store {}: {}".format(self.args.dedup_store, ex))
+            if os.path.exists(local_path):
+                os.remove(local_path)
+        finally:
+            self.args.disable_checksums = prev_disable_checksums
+        return DedupIndex(local_path)
+
+    def hash_snapshot_files(self, tserver_ip, paths):
+        """
+        :return: a map from the given paths on the tserver to the SHA-256 of their contents.
+        """
+        output = self.run_ssh_cmd([SHA_TOOL_PATH] + list(paths), tserver_ip)
+        hashes = {}
+        for line in output.splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                hashes[fields[1].strip()] = fields[0]
+        return hashes
+
+    def resolve_shared_files(self, tablets, snapshot_filepath):
+        """
+        Points the entries left out by share_physical_files() at the object of the entry they
+        share it with.
+        :param tablets: a map from tablet id to TabletEntry, updated in place
+        :param snapshot_filepath: the location of this backup
+        """
+        for tablet in tablets.values():
+            for entry in tablet.files.values():
+                first_entry = entry.shared_with
+                if first_entry is None:
+                    continue
+                entry.src_location = self.get_planned_location(first_entry, snapshot_filepath)
+                entry.generation = first_entry.generation
+                entry.content_key = first_entry.content_key
+
+    def plan_dedup_store_uploads(self, tablets, tablet_leaders):
+        """
+        Hashes the SST files to be copied. Files the dedup store already has are referenced
+        where they are, the others are uploaded to the store by prepare_upload_command().
+        :param tablets: a map from tablet id to TabletEntry, updated in place
+        :param tablet_leaders: a list of (tablet_id, tserver_ip) pairs
+        """
+        leader_by_tablet = dict(tablet_leaders)
+        parallel_hash = MultiArgParallelCmd(self.hash_snapshot_files)
+        for tablet in tablets.values():
+            paths = sorted(entry.src_location for entry in tablet.files.values()
+                           if entry.action == ACTION_CODE_COPY and is_sst_file(entry.filename))
+            if paths:
+                parallel_hash.add_args(leader_by_tablet[tablet.tablet_id], tuple(paths))
+        hashes = {}
+        for result in parallel_hash.run(self.pool).values():
+            hashes.update(result)
+
+        if self.dedup_index is None:
+            self.dedup_index = self.load_dedup_index(
+                os.path.join(self.get_tmp_dir(), DEDUP_INDEX))
+        num_referenced = 0
+        for tablet in tablets.values():
+            for entry in tablet.files.values():
+                content_key = hashes.get(entry.src_location)
+                if entry.action != ACTION_CODE_COPY or content_key is None:
+                    continue
+                entry.content_key = content_key
+                if content_key in self.dedup_index:
+                    entry.action = ACTION_CODE_NOOP
+                    entry.src_location = self.dedup_object_path(content_key)
+                    num_referenced += 1
                 else:
-                    copy_set_curr.add(dict_key)
-        return (curr_manifest, compare_set_curr, copy_set_curr)
+                    self.dedup_index.add(content_key)
+        logging.info("Dedup store {}: {} files to upload so far, {} already stored".format(
+            self.args.dedup_store, len(self.dedup_index.added), num_referenced))
+
+    def upload_dedup_index(self):
+        """
+        Adds the objects uploaded by this backup to the index of the dedup store. The index is
+        downloaded again first, to keep what other backups added in the meantime.
+        """
+        if not self.dedup_index.added:
+            return
+        tmp_dir = self.get_tmp_dir()
+        latest_index = self.load_dedup_index(os.path.join(tmp_dir, DEDUP_INDEX + '.latest'))
+        index_path = os.path.join(tmp_dir, DEDUP_INDEX + '.new')
+        self.dedup_index.write(index_path, latest_index)
+        self.upload_metadata_and_checksum(
+            index_path, os.path.join(self.args.dedup_store, DEDUP_INDEX), run_local=True)
 
     def get_manifest(self, dest_path, manifest_file, manifest):
+        return self.get_manifests({0: (dest_path, manifest_file, manifest)})[0]
+
+    def load_manifest(self, dest_path, manifest_file, manifest):
+        """
+        Loads the manifest from the manifest cache, or downloads it to dest_path and loads it.
+        Fragments of sharded manifests are not fetched.
+        :return: whether the manifest was found in the cache, and the version to cache it under
+        """
+        version = self.get_manifest_version(manifest_file)
+        cached_path = self.manifest_cache.lookup(manifest_file, version) if version else None
+        if cached_path:
+            logging.info("Using cached manifest {}".format(manifest_file))
+            load_manifest_file(cached_path, manifest)
+            return True, version
+        self.download_file(manifest_file, dest_path, run_local=True)
+        load_manifest_file(dest_path, manifest)
+        return False, version
+
+    def get_manifests(self, manifests):
+        """
+        Loads the given manifests in parallel.
+        :param manifests: a map from key to (local path, manifest object path, Manifest)
+        :return: a map from key to whether the manifest was loaded
+        """
+        def load_fn(key):
+            try:
+                return self.load_manifest(*manifests[key])
+            except Exception as ex:
+                logging.info("Failed to get manifest {}: {}".format(manifests[key][1], ex))
+                return None
+
         prev_disable_checksums = self.args.disable_checksums
         self.args.disable_checksums = True
+        results = {}
         try:
-            self.download_file(manifest_file, dest_path, run_local=True)
-            with open(dest_path, 'r') as fp:
-                json_dict = json.load(fp)
-            manifest.storage_tablet_ids = json_dict['manifest']['storage']['tablet_ids']
-            if 'manifest_previous' in json_dict['manifest']['metadata']:
-                manifest.manifest_previous = json_dict['manifest']['metadata']['manifest_previous']
-            else:
-                manifest.manifest_previous = ''
-            result = True
-        except Exception:
-             result =  False
-             logging.info("Failed to get manifest {}".format(manifest_file))
+            loaded = SingleArgParallelCmd(load_fn, list(manifests.keys())).run(self.pool)
+            # Fragments are fetched on the pool as well, so not from within its workers.
+            for key in sorted(loaded):
+                results[key] = False
+                if loaded[key] is None:
+                    continue
+                (cached, version) = loaded[key]
+                (_, manifest_file, manifest) = manifests[key]
+                try:
+                    if cached:
+                        self.register_manifest_shards(manifest)
+                    else:
+                        self.fetch_manifest_shards(manifest)
+                        if version:
+                            self.manifest_cache.store(manifest_file, version, manifest)
+                    results[key] = True
+                except Exception as ex:
+                    logging.info("Failed to get manifest {}: {}".format(manifest_file, ex))
         finally:
             self.args.disable_checksums = prev_disable_checksums
-        return result
+        return results
+
+    def get_chain_catalog(self, backup_location):
+        """
+        :return: the BackupChainCatalog stored with the given backup, or None if it has none.
+        """
+        catalog_path = os.path.join(self.get_tmp_dir(), CHAIN_CATALOG)
+        prev_disable_checksums = self.args.disable_checksums
+        self.args.disable_checksums = True
+        try:
+            self.download_file(os.path.join(backup_location, CHAIN_CATALOG), catalog_path,
+                               run_local=True)
+            with open(catalog_path) as fp:
+                return BackupChainCatalog.from_json_dict(json.load(fp))
+        except Exception as ex:
+            logging.info("No chain catalog for {}: {}".format(backup_location, ex))
+            return None
+        finally:
+            self.args.disable_checksums = prev_disable_checksums
+
+    def upload_chain_catalog(self, catalog):
+        catalog_path = os.path.join(self.get_tmp_dir(), CHAIN_CATALOG)
+        with open(catalog_path, 'w') as fp:
+            json.dump(catalog.to_json_dict(), fp)
+        self.upload_metadata_and_checksum(
+            catalog_path, os.path.join(self.args.backup_location, CHAIN_CATALOG), run_local=True)
+
+    def get_restore_point_manifests(self, dest_path, chain_catalog):
+        """
+        Loads the previous manifest and up to --restore_points - 1 manifests before it.
+        :param dest_path: local path of the previous manifest, the others are put next to it
+        :param chain_catalog: the BackupChainCatalog of the previous backup, or None
+        :return: a map from the distance to the previous backup to the loaded Manifest
+        """
+        # Pipelined batches keep diffing against the previous manifest while earlier batches
+        # update the restore points, so the first restore point is a copy of it. A manifest
+        # backed by a reader shares it with the copy, which only keeps its own updates.
+        restore_point_manifests = dict()
+        restore_point_manifests[0] = copy.deepcopy(self.prev_manifest_class)
+        restore_point_manifests[0].manifest_location = self.args.prev_manifest_source
+        ancestors = None
+        if chain_catalog is not None:
+            ancestors = chain_catalog.ancestors(self.args.prev_manifest_source,
+                                                self.args.restore_points)
+        if ancestors is not None:
+            manifests = dict()
+            for index, entry in enumerate(ancestors[1:], 1):
+                manifest = Manifest(uuid.uuid1())
+                manifest.manifest_location = entry['location']
+                # Every manifest gets its own local file, binary ones stay memory-mapped.
+                manifests[index] = ('{}.{}'.format(dest_path, index),
+                                    os.path.join(entry['location'], MANIFEST), manifest)
+            loaded = self.get_manifests(manifests)
+            for index in sorted(loaded):
+                if not loaded[index]:
+                    break
+                restore_point_manifests[index] = manifests[index][2]
+            return restore_point_manifests
+
+        # Backups without a catalog are followed through their manifest_previous links.
+        for num_manifests in range(1, self.args.restore_points):
+            manifest_location = restore_point_manifests[num_manifests - 1].manifest_previous
+            if not manifest_location:
+                break
+            manifest = Manifest(uuid.uuid1())
+            if not self.get_manifest('{}.{}'.format(dest_path, num_manifests),
+                                     os.path.join(manifest_location, MANIFEST), manifest):
+                break
+            manifest.manifest_location = manifest_location
+            restore_point_manifests[num_manifests] = manifest
+        return restore_point_manifests
+
+    def get_manifest_version(self, manifest_file):
+        """
+        :return: the version of the given manifest object for the manifest cache, or None if the
+            cache is disabled or the version cannot be determined.
+        """
+        if self.manifest_cache is None:
+            return None
+        try:
+            stat_cmd = self.storage.stat_obj_cmd(manifest_file)
+            if stat_cmd is not None:
+                return self.storage.parse_obj_version(self.run_program(stat_cmd))
+            # Without object metadata fall back to the checksum uploaded with the manifest.
+            checksum_dest = os.path.join(self.get_tmp_dir(), 'MANIFEST.version')
+            self.run_program(
+                self.storage.download_file_cmd(checksum_path(manifest_file), checksum_dest))
+            with open(checksum_dest) as fp:
+                return 'sha256={}'.format(fp.read().split()[0])
+        except Exception as ex:
+            logging.info("Could not get the version of {}: {}".format(manifest_file, ex))
+            return None
+
+    def cache_manifest(self, manifest_file, manifest):
+        version = self.get_manifest_version(manifest_file)
+        if version:
+            self.manifest_cache.store(manifest_file, version, manifest)
 
     def update_manifest_from_local_file(self, manifest_file, manifest):
-        with open(manifest_file, 'r') as fp:
-            manifest_dict = json.load(fp)
-            manifest.update_storage_tablet_ids(manifest_dict)
+        load_manifest_file(manifest_file, manifest)
+        self.fetch_manifest_shards(manifest)
 
     def write_manifest(self, manifest_file, manifest_class):
-        with open(manifest_file, 'w') as fp:
-            json.dump(manifest_class.to_json_dict(), fp)
+        write_manifest_file(manifest_file, manifest_class, self.args.manifest_format)
+
+    def get_manifest_shard_local_path(self, content_hash):
+        shards_dir = os.path.join(self.get_tmp_dir(), MANIFEST_SHARDS_DIR)
+        os.makedirs(shards_dir, exist_ok=True)
+        return os.path.join(shards_dir, content_hash)
+
+    def download_manifest_shard(self, shard, savepoint):
+        """
+        Downloads and decodes one fragment of a sharded manifest. Fragments already downloaded in
+        this run are not downloaded again.
+        :param shard: the fragment reference from the root manifest
+        :param savepoint: savepoint number of the manifest the fragment belongs to
+        :return: the fragment entries in the nested dict form of Manifest.storage_tablet_ids
+        """
+        local_path = self.get_manifest_shard_local_path(shard['hash'])
+        if not os.path.exists(local_path):
+            self.download_file(shard['location'], local_path, run_local=True)
+        with open(local_path, 'rb') as fp:
+            data = fp.read()
+        if ManifestShardCodec.content_hash(data) != shard['hash']:
+            os.remove(local_path)
+            raise BackupException("Manifest fragment {} does not match its hash {}".format(
+                shard['location'], shard['hash']))
+        return ManifestShardCodec.decode(data, savepoint)
+
+    def register_manifest_shards(self, manifest):
+        """
+        Records the fragments of a sharded manifest, so that upload_manifest() can reference
+        them instead of uploading the same contents again.
+        :return: a map from content hash to fragment reference
+        """
+        shards_by_hash = {}
+        for shard in manifest.manifest_shards:
+            shards_by_hash[shard['hash']] = shard
+            self.known_manifest_shards[shard['hash']] = shard['location']
+        return shards_by_hash
+
+    def fetch_manifest_shards(self, manifest):
+        """
+        Loads the entries of a sharded manifest by fetching and parsing its fragments in parallel.
+        Does nothing for a manifest stored as a single object.
+        """
+        if not manifest.manifest_shards:
+            return
+        shards_by_hash = self.register_manifest_shards(manifest)
+
+        def fetch_fn(content_hash):
+            return self.download_manifest_shard(shards_by_hash[content_hash],
+                                                manifest.manifest_savepoint_number)
+
+        tablet_ids = {}
+        for shard_tablet_ids in SingleArgParallelCmd(
+                fetch_fn, list(shards_by_hash.keys())).run(self.pool).values():
+            for tablet_id, files in shard_tablet_ids.items():
+                tablet_ids.setdefault(tablet_id, {}).update(files)
+        manifest.storage_tablet_ids = tablet_ids
+
+    def upload_manifest_shards(self, manifest):
+        """
+        Splits the manifest into fragments and uploads the ones that are not stored yet.
+        Fragments with a known content hash are referenced where they already are.
+        """
+        shard_refs = []
+        shards_to_upload = {}
+        for name, data in sorted(
+                ManifestShardCodec.encode(manifest, self.args.manifest_shards).items()):
+            content_hash = ManifestShardCodec.content_hash(data)
+            location = self.known_manifest_shards.get(content_hash)
+            if location is None:
+                location = os.path.join(
+                    manifest.manifest_location, MANIFEST_SHARDS_DIR, content_hash)
+                if content_hash not in shards_to_upload:
+                    with open(self.get_manifest_shard_local_path(content_hash), 'wb') as fp:
+                        fp.write(data)
+                    shards_to_upload[content_hash] = location
+            shard_refs.append({"name": name, "hash": content_hash, "location": location,
+                               "bytes": len(data)})
+
+        def upload_fn(content_hash):
+            self.upload_metadata_and_checksum(self.get_manifest_shard_local_path(content_hash),
+                                              shards_to_upload[content_hash], run_local=True)
+
+        SingleArgParallelCmd(upload_fn, list(shards_to_upload.keys())).run(self.pool)
+        self.known_manifest_shards.update(shards_to_upload)
+        manifest.manifest_shards = shard_refs
+        logging.info("Uploaded {} of {} manifest fragments ({} of {} bytes) to {}".format(
+            len(shards_to_upload), len(shard_refs),
+            sum(ref['bytes'] for ref in shard_refs if ref['hash'] in shards_to_upload),
+            sum(ref['bytes'] for ref in shard_refs), manifest.manifest_location))
+
+    def upload_manifest(self, manifest_file, manifest):
+        """
+        Writes the given manifest to the local manifest_file and uploads it to its location.
+        With --manifest_shards only the root manifest and the changed fragments are uploaded.
+        """
+        if self.args.manifest_shards:
+            self.upload_manifest_shards(manifest)
+            with open(manifest_file + '.tmp', 'w') as fp:
+                json.dump(manifest.to_json_dict(include_tablet_ids=False), fp)
+            os.replace(manifest_file + '.tmp', manifest_file)
+        else:
+            self.write_manifest(manifest_file, manifest)
+        manifest_dest = os.path.join(manifest.manifest_location, MANIFEST)
+        self.upload_metadata_and_checksum(manifest_file, manifest_dest, run_local=True)
+        if self.manifest_cache is not None:
+            # The next differential backup will most likely start from this manifest.
+            self.cache_manifest(manifest_dest, manifest)
+
+    def plan_backup_batch(self, tablets, tablet_leaders, snapshot_filepath,
+                          restore_point_manifests, first_entries):
+        """
+        Decides the action of every file of the given tablets, which may be a part of the backup.
+        :param tablets: a map from tablet id to TabletEntry, updated in place
+        :param tablet_leaders: a list of (tablet_id, tserver_ip) pairs of the given tablets
+        :param snapshot_filepath: the location of this backup
+        :param restore_point_manifests: for a differential backup against
+            self.prev_manifest_class, the manifests of its restore points, updated with the
+            files moved into this backup. None for a full backup.
+        :param first_entries: the files shared by the tablets planned before, see
+            share_physical_files()
+        :return: the number of files moved into this backup
+        """
+        moved_entries = []
+        if restore_point_manifests is not None:
+            # Look up the current files in the previous manifest instead of loading all of it.
+            (num_files_in_curr, num_files_in_both, moved_entries) = diff_tablet_entries(
+                tablets, self.prev_manifest_class, self.args.restore_points)
+            logging.info("Differential backup of {} tablets: {} new, {} unchanged of which {} "
+                         "moved".format(len(tablets), num_files_in_curr, num_files_in_both,
+                                        len(moved_entries)))
+
+            if self.args.verbose:
+                # Create the set of files to compare from the previous backup
+                compare_set_prev = set()
+                for tablet, file, _ in self.prev_manifest_class.iter_files():
+                    if tablet in tablets and is_sst_file(file):
+                        compare_set_prev.add(tablet + "/" + file)
+                logging.info('Previous manifest files\n{}'.format(compare_set_prev))
+                compare_set_curr = set()
+                files_in_curr = set()
+                for tablet in tablets.values():
+                    for entry in tablet.files.values():
+                        if is_sst_file(entry.filename):
+                            compare_set_curr.add(tablet.tablet_id + "/" + entry.filename)
+                            if entry.action == ACTION_CODE_COPY:
+                                files_in_curr.add(tablet.tablet_id + "/" + entry.filename)
+                files_in_both = compare_set_curr - files_in_curr
+                files_in_prev = compare_set_prev - compare_set_curr
+                logging.info(
+                   "\n\n\nSets: \nfiles_in_both_backups {}\nfiles_in_prev {}\nfiles_in_curr {}\n\n\n".format(
+                        files_in_both, files_in_prev, files_in_curr  ))
+
+            # If there are only new files, copy directories instead of individual files
+            if num_files_in_curr and not num_files_in_both and not self.args.dedup_store:
+                for tablet in tablets.values():
+                    tablet.directory = True
+        else:
+            for tablet in tablets.values():
+                # Files go to the dedup store one by one.
+                tablet.directory = not self.args.dedup_store
+                for entry in tablet.files.values():
+                    entry.action = ACTION_CODE_COPY
+
+        # Before hashing, so that every physical file is hashed once as well.
+        num_shared = share_physical_files(tablets, first_entries)
+        if num_shared:
+            logging.info("{} snapshot files are shared with other tablets".format(num_shared))
+
+        if self.args.dedup_store:
+            self.plan_dedup_store_uploads(tablets, tablet_leaders)
+
+        if num_shared:
+            self.resolve_shared_files(tablets, snapshot_filepath)
+
+        for entry in moved_entries:
+            location = self.get_planned_location(entry.shared_with or entry, snapshot_filepath)
+            # reset generation and location for restore_point manifests
+            for manifest in restore_point_manifests.values():
+                manifest.update_file(
+                    entry.tablet_id, entry.filename,
+                    generation=self.args.restore_points - 1,
+                    src_location=location)
+        return len(moved_entries)
 
     def backup_table(self):
         """
@@ -2326,158 +5598,126 @@ class YBBackup:
         self.timer.log_new_phase("Find tablet leaders")
         tablet_leaders = self.find_tablet_leaders()
 
-        self.timer.log_new_phase("Get snapshot files and create manifest")
-        # Get a list of all the files to be differentially backed up
-        files = self.get_filelist(tablet_leaders, snapshot_id)
-
-        # Build the current manifest
-        (curr_manifest, compare_set_curr, copy_set_curr) = self.create_manifest(self.manifest_class, files, tablet_leaders)
         self.manifest_class.manifest_location = self.args.backup_location
-        if self.args.verbose:
-            logging.info("Current manifest {}:  ".format(
-                curr_manifest))
 
         self.timer.log_new_phase("Get the previous manifest for differential backup")
         is_differential_backup = self.is_differential_backup()
+        chain_catalog = None
         if self.args.prev_manifest_source and is_differential_backup:
             prev_manifestfile = os.path.join(self.args.prev_manifest_source, MANIFEST)
             dest_path = os.path.join(self.get_tmp_dir(), MANIFEST)
             if self.get_manifest(dest_path, prev_manifestfile, self.prev_manifest_class):
                 is_differential_backup = True
                 self.manifest_class.manifest_previous = self.args.prev_manifest_source
+                self.manifest_class.manifest_savepoint_number = \
+                    self.prev_manifest_class.manifest_savepoint_number + 1
+                chain_catalog = self.get_chain_catalog(self.args.prev_manifest_source)
             else:
                 is_differential_backup = False
                 logging.info("Previous manifest " + dest_path + "  not found or could not be loaded, proceeding with full backup.")
 
-        for key in tablet_leaders:
-            self.manifest_class.storage_tablet_ids.setdefault(key[0], {})
-
-        final_manifest = dict()
-        write_previous_manifests = False
+        restore_point_manifests = None
         if is_differential_backup:
-            self.timer.log_new_phase("Run differential backup")
-            compare_set_prev = set()
-
-            restore_point_manifests = dict()
-            restore_point_manifests[0] = copy.deepcopy(self.prev_manifest_class)
-            restore_point_manifests[0].manifest_location = self.args.prev_manifest_source
-            # load number of restore points previous_manifests
-            for num_manifests in range(1, self.args.restore_points):
-                restore_point_manifests[num_manifests] = Manifest(uuid.uuid1())
-                manifest_location = restore_point_manifests[num_manifests - 1].manifest_previous
-                if not manifest_location:
-                    break
-                prev_manifestfile = os.path.join(manifest_location, MANIFEST)
-                if self.get_manifest(dest_path, prev_manifestfile, restore_point_manifests[num_manifests]):
-                    restore_point_manifests[num_manifests].manifest_location = manifest_location
-
-            prev_manifest = dict()
-            for tablet in self.prev_manifest_class.storage_tablet_ids:
-                for file in self.prev_manifest_class.storage_tablet_ids[tablet]:
-                    prev_manifest[tablet + "/" + file] = self.prev_manifest_class.storage_tablet_ids[tablet][file]
-
-            if self.args.verbose:
-                logging.info('Previous manifest\n{}'.format(prev_manifest))
-
-            # Create the set of files to copy and compare from the previous backup
-            for key in prev_manifest.keys():
-                if prev_manifest[key]["filename"].find(".sst") != -1:
-                    compare_set_prev.add(key)
-
-            files_in_both = compare_set_curr & compare_set_prev
-            files_in_curr = compare_set_curr - compare_set_prev
-
-            if self.args.verbose:
-                files_in_prev = compare_set_prev - compare_set_curr
-                logging.info(
-                   "\n\n\nSets: \nfiles_in_both_backups {}\nfiles_in_prev {}\nfiles_in_curr {}\n\n\n".format(
-                        files_in_both, files_in_prev, files_in_curr  ))
-
-            # Copy new files off-cluster
-            for key in files_in_curr:
-                final_manifest[key] = curr_manifest[key]
-                final_manifest[key]["action"] = ACTION_COPY
-                tablet = key.split("/")[0]
-                file = final_manifest[key]["filename"]
-                self.manifest_class.storage_tablet_ids[tablet][file] = final_manifest[key]
-
-            # Copy files that are always copied
-            for key in copy_set_curr:
-                final_manifest[key] = curr_manifest[key]
-                final_manifest[key]["action"] = ACTION_COPY
-                tablet = key.split("/")[0]
-                file = final_manifest[key]["filename"]
-                self.manifest_class.storage_tablet_ids[tablet][file] = final_manifest[key]
-
-            # Update the current manifest with the previous information files
-            for key in files_in_both:
-                final_manifest[key] = prev_manifest[key]
-                if self.args.restore_points <= prev_manifest[key]["generation"]:
-                    write_previous_manifests = True
-                    tablet = key.split("/")[0]
-                    filename = key.split("/")[1]
-                    final_manifest[key]["action"] = ACTION_MOVE
-                    final_manifest[key]["generation"] = 1
-                    # reset generation and location for restore_point manifests
-                    for manifest in restore_point_manifests.values():
-                        if (manifest.storage_tablet_ids.get(tablet) and manifest.storage_tablet_ids[tablet].get(filename)):
-                            manifest.storage_tablet_ids[tablet][filename]['generation'] = self.args.restore_points - 1
-                            manifest.storage_tablet_ids[tablet][filename]['src_location'] = self.get_upload_file_path(
-                                self.args.backup_location, tablet, filename)
-                else:
-                    final_manifest[key]["action"] = ACTION_NOOP
-                    final_manifest[key]["generation"] = prev_manifest[key]["generation"] + 1
-                tablet = key.split("/")[0]
-                file = final_manifest[key]["filename"]
-                self.manifest_class.storage_tablet_ids[tablet][file] = final_manifest[key]
-
-            for key in final_manifest:
-                fields = key.split("/")
-                tablet = fields[0]
-                file = final_manifest[key]["filename"]
-                self.manifest_class.storage_tablet_ids[tablet][file] = final_manifest[key]
-
-            # If there are only new files, copy directories instead of individual files
-            # if files_in_curr and not files_in_both:
-            if files_in_curr and not files_in_both:
-                for tablet in self.manifest_class.storage_tablet_ids:
-                    self.manifest_class.storage_tablet_ids[tablet]['DIRECTORY'] = {}
+            restore_point_manifests = self.get_restore_point_manifests(dest_path, chain_catalog)
+            if chain_catalog is None:
+                # Start a catalog from the part of the chain that was found.
+                chain_catalog = BackupChainCatalog()
+                for index in sorted(restore_point_manifests, reverse=True):
+                    chain_catalog.add(restore_point_manifests[index])
 
-
-            self.manifest_class.storage_tablet_ids = copy.deepcopy(self.manifest_class.storage_tablet_ids)
-
-
-        else:
-            self.timer.log_new_phase("Run full backup")
-            for key in self.manifest_class.storage_tablet_ids:
-                self.manifest_class.storage_tablet_ids[key]['DIRECTORY'] = {}
-            for key in curr_manifest:
-                fields = key.split("/")
-                tablet = fields[0]
-                file = curr_manifest[key]["filename"]
-                self.manifest_class.storage_tablet_ids[tablet][file] = curr_manifest[key]
-                self.manifest_class.storage_tablet_ids[tablet][file]["action"] = ACTION_COPY
-
-            self.manifest_class.storage_tablet_ids = copy.deepcopy(self.manifest_class.storage_tablet_ids)
-
-        self.timer.log_new_phase("Upload snapshot directories")
-        self.upload_snapshot_directories(tablet_leaders, snapshot_id, snapshot_filepath)
+        manifestfile = os.path.join(self.get_tmp_dir(), MANIFEST)
+        manifest_stream_path = manifestfile + '.stream'
+        if self.args.manifest_format == MANIFEST_FORMAT_STREAM and not self.args.manifest_shards:
+            self.manifest_stream = StreamingManifestWriter(
+                open(manifest_stream_path, 'w'), self.manifest_class)
+
+        self.timer.log_new_phase("Get snapshot files and upload snapshot directories")
+        plan_stats = collections.Counter()
+        num_moved = 0
+        # The files shared by the tablets planned so far.
+        first_entries = {}
+        feed = SequenceFeed()
+        parallel_uploads = SequencedParallelCmd(self.parallel_ssh_cmd_fn())
+        # Run a sequence of steps for each tablet, handling different tablets in parallel. The
+        # tablets of a tablet server are uploaded as soon as its files are found and planned.
+        # The upload workers wait for the feed, so they get a pool of their own and the planning
+        # keeps self.pool.
+        with self.create_pool() as upload_pool, \
+                concurrent.futures.ThreadPoolExecutor(1) as upload_executor:
+            uploads = upload_executor.submit(
+                parallel_uploads.run, upload_pool, self.cmd_limits(), feed)
+            try:
+                for discovery_by_tserver in self.iter_snapshot_discoveries(
+                        tablet_leaders, snapshot_id):
+                    if uploads.done():
+                        # The uploads only end early when they failed: raise their error
+                        # instead of planning the remaining tablet servers.
+                        uploads.result()
+                    batch_leaders = [(tablet_id, tserver_ip)
+                                     for (tablet_id, tserver_ip) in tablet_leaders
+                                     if tserver_ip in discovery_by_tserver]
+                    # Build the current manifest of these tablets.
+                    tablets = self.create_manifest(
+                        self.get_filelist(discovery_by_tserver, snapshot_id), batch_leaders)
+                    if self.args.verbose:
+                        logging.info("Current manifest {}:  ".format(list(tablets.values())))
+                    num_moved += self.plan_backup_batch(
+                        tablets, batch_leaders, snapshot_filepath, restore_point_manifests,
+                        first_entries)
+                    plan_stats.update(tablet_entries_stats(tablets))
+                    # Convert to the manifest form once the plan is final.
+                    self.manifest_class.storage_tablet_ids.update(
+                        tablet_entries_to_storage_tablet_ids(tablets))
+
+                    batch_uploads = SequencedParallelCmd(None)
+                    self.prepare_snapshot_uploads(
+                        batch_uploads, batch_leaders, discovery_by_tserver, snapshot_id,
+                        snapshot_filepath)
+                    feed.add(batch_uploads.parallel_args)
+            except BaseException:
+                # Stop the uploads, the error of the planning is the one raised.
+                feed.cancel()
+                concurrent.futures.wait([uploads])
+                raise
+            feed.close()
+            uploads.result()
+
+        if chain_catalog is None:
+            chain_catalog = BackupChainCatalog()
+        chain_catalog.add(self.manifest_class, dict(plan_stats))
+
+        if self.dedup_index is not None:
+            # Only index objects once they are uploaded.
+            self.upload_dedup_index()
         logging.info(
             '[app] Backed up tables %s to %s successfully!' %
             (self.table_names_str(), snapshot_filepath))
 
-        if write_previous_manifests:
-            manifestfile = os.path.join(self.get_tmp_dir(), MANIFEST)
+        if num_moved:
             for index in restore_point_manifests.keys():
-                self.write_manifest(manifestfile, restore_point_manifests[index])
-                manifest_source = restore_point_manifests[index].manifest_location
-                manifest_dest = os.path.join(manifest_source, MANIFEST)
-                self.upload_metadata_and_checksum(manifestfile, manifest_dest, run_local=True)
+                self.upload_manifest(manifestfile, restore_point_manifests[index])
+
+        if self.manifest_stream is not None:
+            # Every tablet should have been written while preparing its upload commands.
+            for tablet_id, files in self.manifest_class.storage_tablet_ids.items():
+                self.manifest_stream.write_tablet(tablet_id, files)
+            self.manifest_stream.close()
+            self.manifest_stream = None
+            os.replace(manifest_stream_path, manifestfile)
+            manifest_dest = os.path.join(self.manifest_class.manifest_location, MANIFEST)
+            self.upload_metadata_and_checksum(manifestfile, manifest_dest, run_local=True)
+            if self.manifest_cache is not None:
+                self.update_manifest_from_local_file(manifestfile, self.manifest_class)
+                self.cache_manifest(manifest_dest, self.manifest_class)
+        else:
+            self.upload_manifest(manifestfile, self.manifest_class)
 
-        manifestfile = os.path.join(self.get_tmp_dir(), MANIFEST)
-        manifest_dest = os.path.join(self.manifest_class.manifest_location, MANIFEST)
-        self.write_manifest(manifestfile, self.manifest_class)
-        self.upload_metadata_and_checksum(manifestfile, manifest_dest, run_local=True)
+        # Written after the manifest, so the catalog never lists a backup without one.
+        self.upload_chain_catalog(chain_catalog)
+
+        if self.manifest_cache is not None:
+            logging.info("Manifest cache: {} hits, {} misses".format(
+                self.manifest_cache.hits, self.manifest_cache.misses))
 
         if self.args.backup_keys_source:
             self.upload_encryption_key_file()
@@ -2635,20 +5875,48 @@ class YBBackup:
 
         return snapshot_metadata
 
-    def find_tablet_replicas(self, snapshot_metadata):
+    def list_tablet_replicas(self, tablet_id):
+        """
+        :return: the list of tservers hosting a replica of the given tablet
+        """
+        tserver_ips = []
+        output = self.run_yb_admin(['list_tablet_servers', tablet_id])
+        for line in output.splitlines():
+            if LEADING_UUID_RE.match(line):
+                _, ts_ip_port, _ = split_by_tab(line)
+                ts_ip, _ = ts_ip_port.split(':')
+                tserver_ips.append(ts_ip)
+        return tserver_ips
+
+    def find_tablet_replicas(self, snapshot_metadata, tablet_ids=None):
         """
         Finds the tablet replicas for tablets present in snapshot_metadata and returns a list of all
-        tservers that need to be processed.
+        tservers that need to be processed. The tablets are listed in parallel.
+        :param tablet_ids: the tablets to list, all tablets of snapshot_metadata by default
+        :return: a map from tserver ip to the set of tablets it hosts
         """
+        if tablet_ids is None:
+            tablet_ids = snapshot_metadata['tablet']
 
+        start_time = time.time()
         tablets_by_tserver_ip = {}
-        for new_id in snapshot_metadata['tablet']:
-            output = self.run_yb_admin(['list_tablet_servers', new_id])
-            for line in output.splitlines():
-                if LEADING_UUID_RE.match(line):
-                    _, ts_ip_port, _ = split_by_tab(line)
-                    ts_ip, _ = ts_ip_port.split(':')
-                    tablets_by_tserver_ip.setdefault(ts_ip, set()).add(new_id)
+        replicas = None
+        if self.master_http:
+            try:
+                replicas = MasterHttpClient.tablet_replicas(
+                    self.master_http.dump_entities(), tablet_ids)
+            except BackupException as ex:
+                logging.warning("Falling back to yb-admin to list replicas: {}".format(ex))
+        if replicas is None:
+            if not self.args.local_yb_admin_binary:
+                # Find the master leader once instead of in every thread.
+                self.get_leader_master_ip()
+            replicas = SingleArgParallelCmd(self.list_tablet_replicas, tablet_ids).run(self.pool)
+        for new_id, tserver_ips in replicas.items():
+            for ts_ip in tserver_ips:
+                tablets_by_tserver_ip.setdefault(ts_ip, set()).add(new_id)
+        logging.info("Listed the replicas of {} tablets in {:.3f} sec".format(
+            len(replicas), time.time() - start_time))
 
         return tablets_by_tserver_ip
 
@@ -2693,14 +5961,14 @@ class YBBackup:
             tablets_by_tserver_to_download[tserver_ip] -= deleted_tablets
 
         self.timer.log_new_phase("Download data")
-        parallel_downloads = SequencedParallelCmd(self.run_ssh_cmd)
+        parallel_downloads = SequencedParallelCmd(self.parallel_ssh_cmd_fn())
         self.prepare_cloud_ssh_cmds(
             parallel_downloads, tserver_to_tablet_to_snapshot_dirs, self.args.backup_location,
             snapshot_id, tablets_by_tserver_to_download, upload=False,
             snapshot_metadata=snapshot_meta, restore_mode_file=restore_mode_file)
 
         # Run a sequence of steps for each tablet, handling different tablets in parallel.
-        results = parallel_downloads.run(self.pool)
+        results = parallel_downloads.run(self.pool, self.cmd_limits())
 
         if not self.args.disable_checksums:
             for k, v_raw in results.items():
@@ -2763,6 +6031,7 @@ class YBBackup:
 
         self.timer.log_new_phase("Generate list of tservers for every tablet")
         all_tablets_by_tserver = self.find_tablet_replicas(snapshot_metadata)
+        download_round = 1
         tablets_by_tserver_to_download = all_tablets_by_tserver
 
         #if diff Manifest setup for diff restore and structure for while loop
@@ -2787,12 +6056,26 @@ class YBBackup:
                 snapshot_metadata, tablets_by_tserver_to_download, snapshot_id, table_ids, restore_mode_file)
 
             # Remove deleted tablets from the list of all tablets.
+            moved_tablets = set()
             for tserver_ip in tserver_to_deleted_tablets:
                 deleted_tablets = tserver_to_deleted_tablets[tserver_ip]
                 all_tablets_by_tserver[tserver_ip] -= deleted_tablets
-
-            self.timer.log_new_phase("Regenerate list of tservers for every tablet")
-            tablets_by_tserver_new = self.find_tablet_replicas(snapshot_metadata)
+                moved_tablets |= deleted_tablets
+
+            download_round += 1
+            if moved_tablets:
+                # Only the tablets that moved away from a tserver are listed again, as long as
+                # there are some.
+                self.timer.log_new_phase(
+                    "Regenerate list of tservers for {} moved tablets (round {})".format(
+                        len(moved_tablets), download_round))
+                tablets_by_tserver_new = self.find_tablet_replicas(
+                    snapshot_metadata, moved_tablets)
+            else:
+                self.timer.log_new_phase(
+                    "Regenerate list of tservers for every tablet (round {})".format(
+                        download_round))
+                tablets_by_tserver_new = self.find_tablet_replicas(snapshot_metadata)
             # Calculate the new downloading list as a subtraction of sets:
             #     downloading_list = NEW_all_tablet_replicas - OLD_all_tablet_replicas
             # And extend the list of all tablets (as unioun of sets) for using it on the next
@@ -2802,6 +6085,17 @@ class YBBackup:
             (all_tablets_by_tserver, tablets_by_tserver_to_download) =\
                 self.identify_new_tablet_replicas(all_tablets_by_tserver, tablets_by_tserver_new)
 
+            if moved_tablets and not tablets_by_tserver_to_download:
+                # Other tablets may have moved without being noticed, list all of them before
+                # finishing.
+                self.timer.log_new_phase(
+                    "Regenerate list of tservers for every tablet (round {})".format(
+                        download_round))
+                tablets_by_tserver_new = self.find_tablet_replicas(snapshot_metadata)
+                (all_tablets_by_tserver, tablets_by_tserver_to_download) =\
+                    self.identify_new_tablet_replicas(
+                        all_tablets_by_tserver, tablets_by_tserver_new)
+
         # Finally, restore the snapshot.
         logging.info('Downloading is finished. Restoring snapshot %s ...', snapshot_id)
         self.timer.log_new_phase("Restore the snapshot")
@@ -2876,8 +6170,16 @@ class YBBackup:
         return self.run_yb_admin(['delete_snapshot', snapshot_id])
 
 
+    def create_pool(self):
+        """
+        :return: a pool of the --parallel_engine to run parallel commands on
+        """
+        if self.args.parallel_engine == PARALLEL_ENGINE_ASYNCIO:
+            return AsyncCmdEngine(self.args.parallelism, self.max_remote_ops())
+        return ThreadPool(self.args.parallelism)
+
     def run(self):
-        with ThreadPool(self.args.parallelism) as pool:
+        with self.create_pool() as pool:
             self.pool = pool
             self.__run_internal()
 
@@ -2891,6 +6193,7 @@ class YBBackup:
                            "start_time": self.timer.logged_times[0],
                            "end_time": time.time(),
                            "status": "OK" if not run_exc else repr(run_exc),
+                           "snapshot_waits": self.snapshot_waits,
                            "args": vars(self.args)}
                 json.dump(payload, fp, indent=2)
         except Exception as ex:
@@ -0,0 +1,651 @@
+#!/usr/bin/env python
+#
+# Copyright 2022 YugaByte, Inc. and Contributors
+
+# Licensed under the Polyform Free Trial License 1.0.0 (the "License"); you
+# may not use this file except in compliance with the License. You
+# may obtain a copy of the License at
+#
+# https://github.com/YugaByte/yugabyte-db/blob/master/licenses/POLYFORM-FREE-TRIAL-LICENSE-1.0.0.txt
+
+"""
+Benchmarks for the manifest handling and the diff engine of yb_backup_diff.py on synthetic
+manifests, and for the native S3 engine on a local S3 stand-in.
+
+Every case runs in a fresh interpreter, so the reported peak RSS belongs to that case only.
+Example:
+    python yb_backup_diff_bench.py manifest_io --num_files 5000000
+    python yb_backup_diff_bench.py s3 --s3_file_mb 256
+"""
+
+import argparse
+import copy
+import hashlib
+import http.server
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import yb_backup_diff
+import yb_s3_transfer
+
+BENCH_BUCKET = 's3://bench-bucket/backup'
+BENCH_TSERVERS = ['10.0.0.{}'.format(i) for i in range(1, 4)]
+BENCH_SNAPSHOT_DIR = '/mnt/d0/yb-data/tserver/data/rocksdb/table-bench/tablet-{}.snapshots/snap'
+BENCH_RESTORE_POINTS = 2
+
+
+def synthetic_tablet_id(index):
+    return '{:032x}'.format(index)
+
+
+def synthetic_tablets(num_files, files_per_tablet):
+    """
+    Yields (tablet_id, files) pairs in the nested dict form of Manifest.storage_tablet_ids.
+    """
+    num_tablets = max(1, num_files // files_per_tablet)
+    for tablet_index in range(num_tablets):
+        tablet_id = synthetic_tablet_id(tablet_index)
+        files = {}
+        for file_index in range(files_per_tablet):
+            filename = '{:06d}.sst.sblock.0'.format(file_index)
+            files[filename] = {
+                "filename": filename,
+                "generation": 1 + file_index % 3,
+                "src_location": yb_backup_diff.YBBackup.get_upload_file_path(
+                    BENCH_BUCKET, tablet_id, filename),
+                "action": yb_backup_diff.ACTION_NOOP}
+        yield tablet_id, files
+
+
+def synthetic_manifest(num_files, files_per_tablet):
+    manifest = yb_backup_diff.Manifest('bench')
+    manifest.storage_tablet_ids = dict(synthetic_tablets(num_files, files_per_tablet))
+    return manifest
+
+
+def synthetic_snapshot(num_files, files_per_tablet):
+    """
+    :return: the find_snapshot_files results and the tablet leaders of a snapshot holding the
+        files of synthetic_manifest().
+    """
+    files = {}
+    tablet_leaders = []
+    for tablet_id, tablet_files in synthetic_tablets(num_files, files_per_tablet):
+        tserver = BENCH_TSERVERS[len(tablet_leaders) % len(BENCH_TSERVERS)]
+        tablet_leaders.append((tablet_id, tserver))
+        snapshot_dir = BENCH_SNAPSHOT_DIR.format(tablet_id)
+        tserver_files = files.setdefault(('/mnt/d0', 'snap', tserver), [])
+        for filename in tablet_files:
+            tserver_files.append(yb_backup_diff.SnapshotFile(
+                os.path.join(snapshot_dir, filename), 1, len(tserver_files), 0, 0.0))
+    return files, tablet_leaders
+
+
+def peak_rss_mb():
+    # ru_maxrss survives execve on Linux, so it would include the peak of the benchmark driver.
+    # VmHWM is the peak of this process only.
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# Manifest I/O cases. Each one is run by run_case() in a child process.
+
+def case_write_json(path, args):
+    manifest = synthetic_manifest(args.num_files, args.files_per_tablet)
+    yb_backup_diff.write_manifest_file(path, manifest, yb_backup_diff.MANIFEST_FORMAT_JSON)
+
+
+def case_write_stream(path, args):
+    writer = yb_backup_diff.StreamingManifestWriter(
+        open(path, 'w'), yb_backup_diff.Manifest('bench'))
+    for tablet_id, files in synthetic_tablets(args.num_files, args.files_per_tablet):
+        writer.write_tablet(tablet_id, files)
+    writer.close()
+
+
+def case_read_json(path, args):
+    manifest = yb_backup_diff.Manifest('bench')
+    yb_backup_diff.load_manifest_file(path, manifest)
+    return sum(1 for _ in manifest.iter_files())
+
+
+def case_read_stream(path, args):
+    return sum(1 for _ in yb_backup_diff.iter_manifest_records(path))
+
+
+# Diff engine cases. Both diff the same snapshot against the manifest at path.
+
+def legacy_create_manifest(files, tablet_leaders):
+    # The dict based create_manifest() the diff engine used before FileEntry.
+    compare_set_curr = set()
+    copy_set_curr = set()
+    curr_manifest = dict()
+    tablet_from_leader = set()
+    for key, value in files.items():
+        tserver = key[2]
+        tablet_from_leader.clear()
+        for leader_tablet in tablet_leaders:
+            if leader_tablet[1] == tserver:
+                tablet_from_leader.add(leader_tablet[0])
+        for snapshot_file in value:
+            filename = snapshot_file.path
+            fields = filename.split("/")
+            tablet = fields[-3].split("-")[1].split(".")[0]
+            if not tablet in tablet_from_leader:
+                continue
+            file = fields[-1]
+            dict_key = (tablet + "/" + file)
+            curr_manifest[dict_key] = \
+                {"filename": file, "generation": 1, "src_location": filename}
+            if file.find(".sst") != -1:
+                compare_set_curr.add(dict_key)
+            else:
+                copy_set_curr.add(dict_key)
+    return (curr_manifest, compare_set_curr, copy_set_curr)
+
+
+def case_diff_dicts(path, args):
+    files, tablet_leaders = synthetic_snapshot(args.num_files, args.files_per_tablet)
+    prev_manifest_class = yb_backup_diff.Manifest('prev')
+    yb_backup_diff.load_manifest_file(path, prev_manifest_class)
+    (curr_manifest, compare_set_curr, copy_set_curr) = legacy_create_manifest(
+        files, tablet_leaders)
+    storage_tablet_ids = {}
+    for key in tablet_leaders:
+        storage_tablet_ids.setdefault(key[0], {})
+
+    prev_manifest = dict()
+    for key in sorted(compare_set_curr):
+        tablet, file = key.split("/")
+        prev_entry = prev_manifest_class.lookup_file(tablet, file)
+        if prev_entry is not None:
+            prev_manifest[key] = prev_entry
+    files_in_both = set(prev_manifest.keys())
+    files_in_curr = compare_set_curr - files_in_both
+
+    final_manifest = dict()
+    for key in files_in_curr | copy_set_curr:
+        final_manifest[key] = curr_manifest[key]
+        final_manifest[key]["action"] = yb_backup_diff.ACTION_COPY
+    for key in files_in_both:
+        final_manifest[key] = prev_manifest[key]
+        if BENCH_RESTORE_POINTS <= prev_manifest[key]["generation"]:
+            final_manifest[key]["action"] = yb_backup_diff.ACTION_MOVE
+            final_manifest[key]["generation"] = 1
+        else:
+            final_manifest[key]["action"] = yb_backup_diff.ACTION_NOOP
+            final_manifest[key]["generation"] = prev_manifest[key]["generation"] + 1
+    for key in final_manifest:
+        tablet = key.split("/")[0]
+        storage_tablet_ids[tablet][final_manifest[key]["filename"]] = final_manifest[key]
+    storage_tablet_ids = copy.deepcopy(storage_tablet_ids)
+    return len(files_in_both)
+
+
+def case_diff_entries(path, args):
+    files, tablet_leaders = synthetic_snapshot(args.num_files, args.files_per_tablet)
+    prev_manifest_class = yb_backup_diff.Manifest('prev')
+    yb_backup_diff.load_manifest_file(path, prev_manifest_class)
+    tablets = yb_backup_diff.YBBackup.create_manifest(files, tablet_leaders)
+    (_, num_unchanged, _) = yb_backup_diff.diff_tablet_entries(
+        tablets, prev_manifest_class, BENCH_RESTORE_POINTS)
+    storage_tablet_ids = yb_backup_diff.tablet_entries_to_storage_tablet_ids(tablets)
+    return num_unchanged
+
+
+# Restore point cases. Both move the files old enough and rewrite the manifest at path.
+
+def moved_files(path):
+    return [(tablet_id, filename) for tablet_id, filename, entry
+            in yb_backup_diff.iter_manifest_records(path)
+            if entry['generation'] >= BENCH_RESTORE_POINTS + 1]
+
+
+def case_restore_point_copy(path, args):
+    moved = moved_files(path)
+    prev_manifest_class = yb_backup_diff.Manifest('prev')
+    yb_backup_diff.load_manifest_file(path, prev_manifest_class)
+    manifest = copy.deepcopy(prev_manifest_class)
+    for tablet_id, filename in moved:
+        if (manifest.storage_tablet_ids.get(tablet_id) and
+                manifest.storage_tablet_ids[tablet_id].get(filename)):
+            manifest.storage_tablet_ids[tablet_id][filename]['generation'] = BENCH_RESTORE_POINTS
+    yb_backup_diff.write_manifest_file(
+        path + '.out', manifest, yb_backup_diff.MANIFEST_FORMAT_BINARY)
+    return len(moved)
+
+
+def case_restore_point_overlay(path, args):
+    moved = moved_files(path)
+    manifest = yb_backup_diff.Manifest('prev')
+    yb_backup_diff.load_manifest_file(path, manifest)
+    for tablet_id, filename in moved:
+        manifest.update_file(tablet_id, filename, generation=BENCH_RESTORE_POINTS)
+    yb_backup_diff.write_manifest_file(
+        path + '.out', manifest, yb_backup_diff.MANIFEST_FORMAT_BINARY)
+    return len(moved)
+
+
+MANIFEST_IO_CASES = {
+    'write_json': case_write_json,
+    'write_stream': case_write_stream,
+    'read_json': case_read_json,
+    'read_stream': case_read_stream,
+}
+
+DIFF_CASES = {
+    'diff_dicts': case_diff_dicts,
+    'diff_entries': case_diff_entries,
+}
+
+RESTORE_POINT_CASES = {
+    'restore_point_copy': case_restore_point_copy,
+    'restore_point_overlay': case_restore_point_overlay,
+}
+
+CASES = dict(MANIFEST_IO_CASES)
+CASES.update(DIFF_CASES)
+CASES.update(RESTORE_POINT_CASES)
+
+
+# A local stand-in for S3, for the native S3 engine.
+
+class LocalS3Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the S3 requests yb_s3_transfer.py sends, path style, from memory. Signatures are not
+    checked.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(LocalS3Handler, self).setup()
+        with self.server.lock:
+            self.server.num_connections += 1
+        # Stands for the TCP and TLS handshakes of a new connection.
+        time.sleep(self.server.connect_delay_sec)
+
+    def log_message(self, *args):
+        pass
+
+    def throttle(self, num_bytes, start_time):
+        if self.server.stream_bytes_per_sec:
+            delay = num_bytes / float(self.server.stream_bytes_per_sec) - (time.time() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+
+    def send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            start_time = time.time()
+            for offset in range(0, len(body), yb_s3_transfer.IO_CHUNK_SIZE):
+                self.wfile.write(body[offset:offset + yb_s3_transfer.IO_CHUNK_SIZE])
+                self.throttle(offset + yb_s3_transfer.IO_CHUNK_SIZE, start_time)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        chunks = []
+        start_time = time.time()
+        while length > 0:
+            chunk = self.rfile.read(min(length, yb_s3_transfer.IO_CHUNK_SIZE))
+            chunks.append(chunk)
+            length -= len(chunk)
+            self.throttle(sum(len(chunk) for chunk in chunks), start_time)
+        return b''.join(chunks)
+
+    def handle_request(self):
+        url = urllib.parse.urlsplit(self.path)
+        (bucket, _, key) = urllib.parse.unquote(url.path).lstrip('/').partition('/')
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        body = self.read_body()
+        server = self.server
+        time.sleep(server.request_delay_sec)
+        with server.lock:
+            server.requests.append((self.command, key, sorted(query)))
+            if self.headers.get('x-amz-server-side-encryption'):
+                server.sse_keys.add(key)
+            if server.failures > 0:
+                server.failures -= 1
+                return self.send(500, b'<Error><Code>InternalError</Code></Error>')
+            if server.redirects > 0:
+                server.redirects -= 1
+                return self.send(301, b'<Error><Code>PermanentRedirect</Code></Error>', {
+                    'x-amz-bucket-region': 'region-{}'.format(server.redirects)})
+            objects = server.objects.setdefault(bucket, {})
+
+            if self.command == 'GET' and 'list-type' in query:
+                keys = sorted(name for name in objects if name.startswith(query.get('prefix', '')))
+                start = int(query.get('continuation-token') or 0)
+                page = keys[start:start + server.page_size]
+                body = ''.join('<Contents><Key>{}</Key><Size>{}</Size></Contents>'.format(
+                    name, len(objects[name])) for name in page)
+                if start + server.page_size < len(keys):
+                    body += '<NextContinuationToken>{}</NextContinuationToken>'.format(
+                        start + server.page_size)
+                return self.send(200, '<ListBucketResult>{}</ListBucketResult>'.format(
+                    body).encode('utf-8'))
+            if self.command == 'POST' and 'delete' in query:
+                for name in yb_s3_transfer.xml_texts(body, 'Key'):
+                    objects.pop(name, None)
+                return self.send(200, b'<DeleteResult></DeleteResult>')
+            if self.command == 'POST' and 'uploads' in query:
+                upload_id = uuid.uuid4().hex
+                server.uploads[upload_id] = {}
+                return self.send(200, '<InitiateMultipartUploadResult><UploadId>{}</UploadId>'
+                                      '</InitiateMultipartUploadResult>'.format(
+                                          upload_id).encode('utf-8'))
+            if self.command == 'POST' and 'uploadId' in query:
+                parts = server.uploads.pop(query['uploadId'])
+                numbers = yb_s3_transfer.xml_texts(body, 'PartNumber')
+                objects[key] = b''.join(parts[int(number)] for number in numbers)
+                return self.send(200, b'<CompleteMultipartUploadResult>'
+                                      b'</CompleteMultipartUploadResult>')
+            if self.command == 'DELETE':
+                if 'uploadId' in query:
+                    server.uploads.pop(query['uploadId'], None)
+                else:
+                    objects.pop(key, None)
+                return self.send(204)
+
+            source = self.headers.get('x-amz-copy-source')
+            if source is not None:
+                (src_bucket, _, src_key) = urllib.parse.unquote(source).lstrip('/').partition('/')
+                body = server.objects.get(src_bucket, {})[src_key]
+                copy_range = self.headers.get('x-amz-copy-source-range')
+                if copy_range:
+                    (first, last) = copy_range.split('=')[1].split('-')
+                    body = body[int(first):int(last) + 1]
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            if self.command == 'PUT' and 'partNumber' in query:
+                server.uploads[query['uploadId']][int(query['partNumber'])] = body
+                if source is not None:
+                    return self.send(200, '<CopyPartResult><ETag>{}</ETag></CopyPartResult>'.format(
+                        etag).encode('utf-8'))
+                return self.send(200, headers={'ETag': etag})
+            if self.command == 'PUT':
+                objects[key] = body
+                if source is not None:
+                    return self.send(200, '<CopyObjectResult><ETag>{}</ETag></CopyObjectResult>'.format(
+                        etag).encode('utf-8'))
+                return self.send(200, headers={'ETag': etag})
+
+            data = objects.get(key)
+        if data is None:
+            return self.send(404, b'<Error><Code>NoSuchKey</Code></Error>')
+        headers = {'ETag': '"{}"'.format(hashlib.md5(data).hexdigest()),
+                   'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+        if self.command == 'HEAD':
+            headers['Content-Length'] = str(len(data))
+            self.send_response(200)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            return self.end_headers()
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            (first, last) = byte_range.split('=')[1].split('-')
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, len(data))
+            return self.send(206, data[int(first):int(last) + 1], headers)
+        return self.send(200, data, headers)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = handle_request
+
+
+class LocalS3Server(http.server.ThreadingHTTPServer):
+    """
+    An in-memory S3 stand-in on a local port, with optional costs per connection, per request
+    and per byte of a stream, so that transfers can be compared without a real S3.
+    """
+    daemon_threads = True
+
+    def __init__(self, connect_delay_sec=0, request_delay_sec=0, stream_bytes_per_sec=0):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), LocalS3Handler)
+        self.connect_delay_sec = connect_delay_sec
+        self.request_delay_sec = request_delay_sec
+        self.stream_bytes_per_sec = stream_bytes_per_sec
+        self.lock = threading.Lock()
+        # Bucket to key to content.
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.sse_keys = set()
+        self.num_connections = 0
+        self.page_size = 1000
+        # The number of next requests that fail.
+        self.failures = 0
+        # The number of next requests redirected to another region.
+        self.redirects = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def config(self):
+        """
+        :return: the S3Client config addressing this server
+        """
+        return {'access_key': 'bench', 'secret_key': 'bench', 'access_token': '',
+                'host_base': '127.0.0.1:{}'.format(self.server_address[1]),
+                'host_bucket': '127.0.0.1:{}'.format(self.server_address[1]),
+                'bucket_location': '', 'use_https': 'False'}
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def s3_transfer_case(server, name, fn):
+    """
+    Runs fn(client factory) against the stand-in.
+    :return: the result row of the case
+    """
+    clients = []
+
+    def new_client(**kwargs):
+        client = yb_s3_transfer.S3Client(server.config(), **kwargs)
+        clients.append(client)
+        return client
+    num_connections = server.num_connections
+    start = time.time()
+    fn(new_client)
+    seconds = time.time() - start
+    for client in clients:
+        client.close()
+    num_bytes = sum(client.num_bytes for client in clients)
+    return (name, seconds, num_bytes / 1024.0 / 1024.0 / seconds,
+            sum(client.num_requests for client in clients),
+            server.num_connections - num_connections)
+
+
+def run_case(name, path, args):
+    cmd = [sys.executable, os.path.abspath(__file__), 'case', name, '--path', path,
+           '--num_files', str(args.num_files), '--files_per_tablet', str(args.files_per_tablet)]
+    return json.loads(subprocess.check_output(cmd).decode('utf-8'))
+
+
+def print_results(results):
+    print('{:<20} {:>12} {:>14} {:>12}'.format('case', 'seconds', 'peak RSS (MB)', 'result'))
+    for name, result in results:
+        print('{:<20} {:>12.2f} {:>14.1f} {:>12}'.format(
+            name, result['seconds'], result['peak_rss_mb'], str(result['result'])))
+
+
+def bench_manifest_io(args):
+    """
+    Compares writing and reading the whole manifest as one JSON document against the
+    streaming codec, which works one tablet at a time.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    paths = {'json': os.path.join(tmp_dir, 'MANIFEST.json'),
+             'stream': os.path.join(tmp_dir, 'MANIFEST.stream')}
+    results = []
+    for name in ['write_json', 'write_stream', 'read_json', 'read_stream']:
+        results.append((name, run_case(name, paths[name.split('_')[1]], args)))
+    for kind, path in sorted(paths.items()):
+        print('{} manifest: {:.1f} MB'.format(kind, os.path.getsize(path) / 1024.0 / 1024.0))
+        os.remove(path)
+    os.rmdir(tmp_dir)
+    print_results(results)
+
+
+def bench_diff(args):
+    """
+    Compares the dict based diff engine against the FileEntry based one on a snapshot whose
+    files are all in the previous binary manifest.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'MANIFEST')
+    yb_backup_diff.write_manifest_file(
+        path, synthetic_manifest(args.num_files, args.files_per_tablet),
+        yb_backup_diff.MANIFEST_FORMAT_BINARY)
+    results = []
+    for name in ['diff_dicts', 'diff_entries']:
+        results.append((name, run_case(name, path, args)))
+    os.remove(path)
+    os.rmdir(tmp_dir)
+    print_results(results)
+
+
+def bench_restore_points(args):
+    """
+    Compares updating a restore point manifest on a full copy of it against updating it
+    through Manifest.update_file(), for a manifest in which a third of the files are moved.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'MANIFEST')
+    yb_backup_diff.write_manifest_file(
+        path, synthetic_manifest(args.num_files, args.files_per_tablet),
+        yb_backup_diff.MANIFEST_FORMAT_BINARY)
+    results = []
+    for name in ['restore_point_copy', 'restore_point_overlay']:
+        results.append((name, run_case(name, path, args)))
+        os.remove(path + '.out')
+    os.remove(path)
+    os.rmdir(tmp_dir)
+    print_results(results)
+
+
+def bench_s3(args):
+    """
+    Compares the native S3 engine transferring one large file as a single stream against
+    parallel multipart uploads and ranged downloads, and many small files over new connections
+    against kept-alive ones, on the local S3 stand-in. The stand-in charges every new connection,
+    every request and every stream the given costs.
+    """
+    server = LocalS3Server(args.s3_connect_ms / 1000.0, args.s3_request_ms / 1000.0,
+                           args.s3_stream_mb_per_sec * 1024 * 1024)
+    tmp_dir = tempfile.mkdtemp()
+    large_path = os.path.join(tmp_dir, 'large.sst.sblock.0')
+    with open(large_path, 'wb') as fp:
+        for _ in range(args.s3_file_mb):
+            fp.write(os.urandom(1024 * 1024))
+    small_dir = os.path.join(tmp_dir, 'small')
+    os.mkdir(small_dir)
+    for index in range(args.s3_small_files):
+        with open(os.path.join(small_dir, '{:06d}.sst'.format(index)), 'wb') as fp:
+            fp.write(os.urandom(64 * 1024))
+    small_paths = sorted(os.path.join(small_dir, name) for name in os.listdir(small_dir))
+    part_size = args.s3_part_size_mb * 1024 * 1024
+    single_part = (args.s3_file_mb + 1) * 1024 * 1024
+
+    def new_connection_per_file(new_client):
+        for path in small_paths:
+            new_client().put_file(path, 'bench', 'small/' + os.path.basename(path))
+
+    def kept_alive(new_client):
+        client = new_client()
+        for path in small_paths:
+            client.put_file(path, 'bench', 'small/' + os.path.basename(path))
+
+    cases = [
+        ('put_single_stream', lambda new_client: new_client(
+            part_size=single_part, concurrency=1).put_file(large_path, 'bench', 'large')),
+        ('put_multipart', lambda new_client: new_client(
+            part_size=part_size, concurrency=args.s3_concurrency).put_file(
+                large_path, 'bench', 'large')),
+        ('get_single_stream', lambda new_client: new_client(
+            part_size=single_part, concurrency=1).get_file(
+                'bench', 'large', large_path + '.out')),
+        ('get_ranged', lambda new_client: new_client(
+            part_size=part_size, concurrency=args.s3_concurrency).get_file(
+                'bench', 'large', large_path + '.out')),
+        ('small_new_conns', new_connection_per_file),
+        ('small_kept_alive', kept_alive),
+        ('small_sync', lambda new_client: yb_s3_transfer.sync(
+            new_client(concurrency=args.s3_concurrency), small_dir, 's3://bench/small/')),
+    ]
+    try:
+        rows = [s3_transfer_case(server, name, fn) for name, fn in cases]
+    finally:
+        server.stop()
+        for path in small_paths + [large_path, large_path + '.out']:
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(small_dir)
+        os.rmdir(tmp_dir)
+    print('{:<20} {:>10} {:>10} {:>10} {:>12}'.format(
+        'case', 'seconds', 'MB/s', 'requests', 'connections'))
+    for row in rows:
+        print('{:<20} {:>10.2f} {:>10.1f} {:>10} {:>12}'.format(*row))
+
+
+BENCHMARKS = {
+    'manifest_io': bench_manifest_io,
+    'diff': bench_diff,
+    'restore_points': bench_restore_points,
+    's3': bench_s3,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for yb_backup_diff.py')
+    parser.add_argument('benchmark', choices=list(BENCHMARKS.keys()) + ['case'])
+    parser.add_argument('case', nargs='?', choices=list(CASES.keys()),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    parser.add_argument('--num_files', type=int, default=5000000,
+                        help='Number of files in the synthetic manifest.')
+    parser.add_argument('--files_per_tablet', type=int, default=100,
+                        help='Number of files per tablet in the synthetic manifest.')
+    parser.add_argument('--s3_file_mb', type=int, default=256,
+                        help='Size of the large file of the s3 benchmark.')
+    parser.add_argument('--s3_small_files', type=int, default=200,
+                        help='Number of 64 KB files of the s3 benchmark.')
+    parser.add_argument('--s3_part_size_mb', type=int, default=16,
+                        help='Part size of the native S3 engine.')
+    parser.add_argument('--s3_concurrency', type=int, default=8,
+                        help='Parts or files the native S3 engine transfers at once.')
+    parser.add_argument('--s3_connect_ms', type=float, default=30,
+                        help='Cost of a new connection to the S3 stand-in.')
+    parser.add_argument('--s3_request_ms', type=float, default=5,
+                        help='Cost of a request to the S3 stand-in.')
+    parser.add_argument('--s3_stream_mb_per_sec', type=float, default=64,
+                        help='Throughput of one connection to the S3 stand-in.')
+    args = parser.parse_args()
+
+    if args.benchmark == 'case':
+        start = time.time()
+        result = CASES[args.case](args.path, args)
+        print(json.dumps({'seconds': time.time() - start,
+                          'peak_rss_mb': peak_rss_mb(),
+                          'result': result}))
+    else:
+        BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
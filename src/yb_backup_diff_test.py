@@ -7,14 +7,23 @@
 # https://github.com/YugaByte/yugabyte-db/blob/master/licenses/POLYFORM-FREE-TRIAL-LICENSE-1.0.0.txt
 
 import abc
+import asyncio
 import collections
+import copy
+import hashlib
+import http.server
 import json
 import inspect
 import logging
 import os
 import os.path
 import random
+import shutil
 import string
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 
 import cassandra.cluster
@@ -22,6 +31,8 @@ import cassandra.query
 import psycopg2
 
 import yb_backup_diff
+import yb_backup_diff_bench
+import yb_s3_transfer
 
 def random_suffix(prefix, n):
     return prefix + ''.join(random.choices(string.ascii_lowercase + string.digits, k=n))
@@ -420,6 +431,1448 @@ class YCQLBackupDiffTest(BackupDiffTest, unittest.TestCase):
         with self.assertRaises(cassandra.InvalidRequest):
             self.read_data(db_name, table_name)
 
+class ManifestFormatTest(unittest.TestCase):
+    STORAGE_TABLET_IDS = {
+        "tablet2": {
+            "000010.sst": {"filename": "000010.sst", "generation": 2, "action": "NOOP",
+                           "src_location": "s3://bucket/full/tablet-tablet2/000010.sst"},
+            "CURRENT": {"filename": "CURRENT", "generation": 1, "action": "COPY",
+                        "src_location": "s3://bucket/diff_0/tablet-tablet2/CURRENT"}},
+        "tablet1": {
+            "000011.sst.sblock.0": {"filename": "000011.sst.sblock.0", "generation": 1,
+                                    "src_location": "/mnt/d0/yb-data/000011.sst.sblock.0"}},
+        "tablet3": {}
+    }
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = yb_backup_diff.Manifest("manifest_id")
+        self.manifest.manifest_previous = "s3://bucket/full"
+        self.manifest.storage_tablet_ids = copy.deepcopy(self.STORAGE_TABLET_IDS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_and_load(self, manifest_format):
+        path = os.path.join(self.tmp_dir, "MANIFEST")
+        yb_backup_diff.write_manifest_file(path, self.manifest, manifest_format)
+        loaded = yb_backup_diff.Manifest("loaded_id")
+        yb_backup_diff.load_manifest_file(path, loaded)
+        return loaded
+
+    def test_json_round_trip(self):
+        loaded = self.write_and_load(yb_backup_diff.MANIFEST_FORMAT_JSON)
+        self.assertEqual(loaded.manifest_previous, "s3://bucket/full")
+        self.assertEqual(loaded.storage_tablet_ids, self.STORAGE_TABLET_IDS)
+
+    def test_binary_lookups(self):
+        loaded = self.write_and_load(yb_backup_diff.MANIFEST_FORMAT_BINARY)
+        self.assertIsNotNone(loaded.storage_reader)
+        self.assertEqual(loaded.manifest_previous, "s3://bucket/full")
+        self.assertEqual(loaded.lookup_file("tablet2", "000010.sst"),
+                         self.STORAGE_TABLET_IDS["tablet2"]["000010.sst"])
+        self.assertIsNone(loaded.lookup_file("tablet2", "000011.sst.sblock.0"))
+        self.assertIsNone(loaded.lookup_file("tablet4", "CURRENT"))
+        self.assertEqual(dict(loaded.tablet_files("tablet2")), self.STORAGE_TABLET_IDS["tablet2"])
+        self.assertEqual(dict(loaded.tablet_files("tablet3")), {})
+
+    def test_binary_content_keys(self):
+        self.manifest.storage_tablet_ids["tablet2"]["000010.sst"]["content_key"] = "ab12"
+        expected = copy.deepcopy(self.manifest.storage_tablet_ids)
+        loaded = self.write_and_load(yb_backup_diff.MANIFEST_FORMAT_BINARY)
+        self.assertEqual(loaded.lookup_file("tablet2", "000010.sst")["content_key"], "ab12")
+        self.assertNotIn("content_key", loaded.lookup_file("tablet2", "CURRENT"))
+        self.assertEqual(loaded.storage_tablet_ids, expected)
+
+    def test_binary_sizes(self):
+        self.manifest.storage_tablet_ids["tablet2"]["000010.sst"]["size"] = 5 << 32
+        expected = copy.deepcopy(self.manifest.storage_tablet_ids)
+        loaded = self.write_and_load(yb_backup_diff.MANIFEST_FORMAT_BINARY)
+        self.assertEqual(loaded.lookup_file("tablet2", "000010.sst")["size"], 5 << 32)
+        self.assertNotIn("size", loaded.lookup_file("tablet2", "CURRENT"))
+        self.assertEqual(loaded.storage_tablet_ids, expected)
+
+    def test_binary_round_trip(self):
+        loaded = self.write_and_load(yb_backup_diff.MANIFEST_FORMAT_BINARY)
+        self.assertEqual(loaded.storage_tablet_ids, self.STORAGE_TABLET_IDS)
+        self.assertIsNone(loaded.storage_reader)
+
+    def test_stream_round_trip(self):
+        loaded = self.write_and_load(yb_backup_diff.MANIFEST_FORMAT_STREAM)
+        self.assertIsNotNone(loaded.storage_reader)
+        self.assertEqual(loaded.lookup_file("tablet2", "CURRENT"),
+                         self.STORAGE_TABLET_IDS["tablet2"]["CURRENT"])
+        self.assertEqual(loaded.storage_tablet_ids, self.STORAGE_TABLET_IDS)
+
+    def test_iter_records_all_formats(self):
+        expected = sorted((tablet_id, filename, entry["src_location"])
+                          for tablet_id, files in self.STORAGE_TABLET_IDS.items()
+                          for filename, entry in files.items())
+        path = os.path.join(self.tmp_dir, "MANIFEST")
+        for manifest_format in yb_backup_diff.MANIFEST_FORMATS:
+            yb_backup_diff.write_manifest_file(path, self.manifest, manifest_format)
+            records = sorted((tablet_id, filename, entry["src_location"])
+                             for tablet_id, filename, entry
+                             in yb_backup_diff.iter_manifest_records(path))
+            self.assertEqual(records, expected, manifest_format)
+
+    def test_truncated_stream(self):
+        path = os.path.join(self.tmp_dir, "MANIFEST")
+        yb_backup_diff.write_manifest_file(path, self.manifest,
+                                           yb_backup_diff.MANIFEST_FORMAT_STREAM)
+        with open(path) as fp:
+            lines = fp.readlines()
+        with open(path, "w") as fp:
+            fp.writelines(lines[:-1])
+        with self.assertRaises(yb_backup_diff.BackupException):
+            list(yb_backup_diff.iter_manifest_records(path))
+
+    def test_update_file_without_loading(self):
+        for manifest_format in yb_backup_diff.MANIFEST_FORMATS:
+            loaded = self.write_and_load(manifest_format)
+            loaded.update_file("tablet2", "000010.sst", generation=1,
+                               src_location="s3://bucket/diff_1/000010.sst")
+            loaded.update_file("tablet2", "000099.sst", generation=1)
+            self.assertIsNone(loaded.lookup_file("tablet2", "000099.sst"))
+            self.assertEqual(loaded.lookup_file("tablet2", "000010.sst")["generation"], 1)
+            path = os.path.join(self.tmp_dir, "MANIFEST.rewritten")
+            yb_backup_diff.write_manifest_file(path, loaded, manifest_format)
+            if manifest_format != yb_backup_diff.MANIFEST_FORMAT_JSON:
+                self.assertIsNotNone(loaded.storage_reader, manifest_format)
+            rewritten = yb_backup_diff.Manifest("rewritten_id")
+            yb_backup_diff.load_manifest_file(path, rewritten)
+            expected = copy.deepcopy(self.STORAGE_TABLET_IDS)
+            expected["tablet2"]["000010.sst"].update(
+                generation=1, src_location="s3://bucket/diff_1/000010.sst")
+            self.assertEqual(rewritten.storage_tablet_ids, expected, manifest_format)
+
+    def decode_shards(self, shards, savepoint):
+        tablet_ids = {}
+        for data in shards.values():
+            for tablet_id, files in yb_backup_diff.ManifestShardCodec.decode(
+                    data, savepoint).items():
+                tablet_ids.setdefault(tablet_id, {}).update(files)
+        return tablet_ids
+
+    def test_shards_round_trip(self):
+        self.manifest.manifest_savepoint_number = 3
+        shards = yb_backup_diff.ManifestShardCodec.encode(self.manifest, 4)
+        self.assertIn(yb_backup_diff.ManifestShardCodec.OTHER_SHARD, shards)
+        tablet_ids = self.decode_shards(shards, 3)
+        expected = copy.deepcopy(self.STORAGE_TABLET_IDS)
+        for files in expected.values():
+            for entry in files.values():
+                entry.pop("action", None)
+        self.assertEqual(tablet_ids, expected)
+
+    def test_unchanged_shard_keeps_hash(self):
+        codec = yb_backup_diff.ManifestShardCodec
+        self.manifest.manifest_savepoint_number = 3
+        before = codec.encode(self.manifest, 4)
+        # The next backup finds the same SST files and recopies the other files.
+        self.manifest.manifest_savepoint_number = 4
+        for files in self.manifest.storage_tablet_ids.values():
+            for filename, entry in files.items():
+                if yb_backup_diff.is_sst_file(filename):
+                    entry["generation"] += 1
+        after = codec.encode(self.manifest, 4)
+        for name in before:
+            if name != codec.OTHER_SHARD:
+                self.assertEqual(codec.content_hash(before[name]),
+                                 codec.content_hash(after[name]), name)
+        self.assertEqual(self.decode_shards(after, 4)["tablet2"]["000010.sst"]["generation"], 3)
+
+
+class ManifestCacheTest(unittest.TestCase):
+    LOCATION = "s3://bucket/backup/MANIFEST"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = yb_backup_diff.Manifest("manifest_id")
+        self.manifest.storage_tablet_ids = copy.deepcopy(ManifestFormatTest.STORAGE_TABLET_IDS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookup(self):
+        cache = yb_backup_diff.ManifestCache(self.tmp_dir, 3600, 1 << 20)
+        self.assertIsNone(cache.lookup(self.LOCATION, "etag=1"))
+        cache.store(self.LOCATION, "etag=1", self.manifest)
+        self.assertIsNone(cache.lookup(self.LOCATION, "etag=2"))
+        self.assertIsNone(cache.lookup("s3://bucket/other/MANIFEST", "etag=1"))
+        path = cache.lookup(self.LOCATION, "etag=1")
+        loaded = yb_backup_diff.Manifest("loaded_id")
+        yb_backup_diff.load_manifest_file(path, loaded)
+        self.assertIsNotNone(loaded.storage_reader)
+        self.assertEqual(loaded.storage_tablet_ids, ManifestFormatTest.STORAGE_TABLET_IDS)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_evict_by_size(self):
+        cache = yb_backup_diff.ManifestCache(self.tmp_dir, 3600, 1 << 20)
+        cache.store(self.LOCATION, "etag=1", self.manifest)
+        path = cache.lookup(self.LOCATION, "etag=1")
+        cache.max_bytes = os.path.getsize(path) + 1
+        old_time = time.time() - 60
+        os.utime(path[:-len(".manifest")] + ".json", (old_time, old_time))
+        cache.store("s3://bucket/newer/MANIFEST", "etag=1", self.manifest)
+        self.assertIsNone(cache.lookup(self.LOCATION, "etag=1"))
+        self.assertIsNotNone(cache.lookup("s3://bucket/newer/MANIFEST", "etag=1"))
+
+    def test_evict_by_age(self):
+        cache = yb_backup_diff.ManifestCache(self.tmp_dir, 3600, 1 << 20)
+        cache.store(self.LOCATION, "etag=1", self.manifest)
+        old_time = time.time() - 7200
+        for name in os.listdir(self.tmp_dir):
+            os.utime(os.path.join(self.tmp_dir, name), (old_time, old_time))
+        cache.evict()
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_parse_obj_version(self):
+        output = ("s3://bucket/backup/MANIFEST (object):\n"
+                  "   File size: 1024\n"
+                  "   Last mod:  Sat, 17 Oct 2026 20:00:00 GMT\n"
+                  "   MIME type: application/octet-stream\n"
+                  "   MD5 sum:   0123456789abcdef\n")
+        storage = yb_backup_diff.S3BackupStorage(None)
+        self.assertEqual(storage.parse_obj_version(output),
+                         "File size=1024;Last mod=Sat, 17 Oct 2026 20:00:00 GMT;"
+                         "MD5 sum=0123456789abcdef")
+        self.assertIsNone(storage.parse_obj_version("ERROR: not found\n"))
+
+
+class DataDirCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "state", "data_dirs.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_persisted(self):
+        cache = yb_backup_diff.DataDirCache(self.path, 3600)
+        self.assertIsNone(cache.get("10.0.0.1:9000"))
+        cache.put("10.0.0.1:9000", ["/mnt/d0", "/mnt/d1"])
+        self.assertEqual(cache.get("10.0.0.1:9000"), ["/mnt/d0", "/mnt/d1"])
+        # The next run.
+        cache = yb_backup_diff.DataDirCache(self.path, 3600)
+        self.assertIn("10.0.0.1:9000", cache)
+        self.assertEqual(cache.get("10.0.0.1:9000"), ["/mnt/d0", "/mnt/d1"])
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        cache.invalidate("10.0.0.1:9000")
+        self.assertIsNone(yb_backup_diff.DataDirCache(self.path, 3600).get("10.0.0.1:9000"))
+
+    def test_expired(self):
+        cache = yb_backup_diff.DataDirCache(self.path, 3600)
+        cache.put("10.0.0.1:9000", ["/mnt/d0"])
+        cache.entries["10.0.0.1:9000"]["time"] -= 7200
+        self.assertNotIn("10.0.0.1:9000", cache)
+        self.assertIsNone(cache.get("10.0.0.1:9000"))
+
+    def test_corrupt_state_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w") as fp:
+            fp.write("{")
+        cache = yb_backup_diff.DataDirCache(self.path, 3600)
+        self.assertIsNone(cache.get("10.0.0.1:9000"))
+        cache.put("10.0.0.1:9000", ["/mnt/d0"])
+        self.assertEqual(yb_backup_diff.DataDirCache(self.path, 3600).get("10.0.0.1:9000"),
+                         ["/mnt/d0"])
+
+
+class GenerateSnapshotDirsTest(unittest.TestCase):
+    TABLETS = {"aaa": ["0123456789abcdef0123456789abcdef"],
+               "bbb": ["fedcba9876543210fedcba9876543210", "00000000000000000000000000000001"]}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dirs = [os.path.join(self.tmp_dir, "d0"), os.path.join(self.tmp_dir, "d1")]
+        for index, (table_id, tablet_ids) in enumerate(sorted(self.TABLETS.items())):
+            for tablet_id in tablet_ids:
+                tablet_dir = os.path.join(
+                    self.data_dirs[index], "yb-data/tserver/data/rocksdb",
+                    "table-" + table_id, "tablet-" + tablet_id)
+                os.makedirs(os.path.join(tablet_dir + ".snapshots", "snap"))
+                os.makedirs(os.path.join(tablet_dir, "intents"))
+        self.ybb = yb_backup_diff.YBBackup.create(
+            ["--masters", "127.0.0.1:7100", "--backup_location", self.tmp_dir, "--no_ssh",
+             "restore"])
+        self.ybb.data_dir_cache = yb_backup_diff.DataDirCache(None, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_all_tables_at_once(self):
+        tablets = {"127.0.0.1": {"0123456789abcdef0123456789abcdef",
+                                 "fedcba9876543210fedcba9876543210",
+                                 "00000000000000000000000000000002"}}
+        with yb_backup_diff.ThreadPool(2) as pool:
+            self.ybb.pool = pool
+            (snapshot_dirs, deleted_tablets) = self.ybb.generate_snapshot_dirs(
+                {"127.0.0.1": self.data_dirs}, "snap", tablets, ["aaa", "bbb"])
+        self.assertEqual(snapshot_dirs["127.0.0.1"]["fedcba9876543210fedcba9876543210"],
+                         {os.path.join(self.data_dirs[1], "yb-data/tserver/data/rocksdb",
+                                       "table-bbb", "tablet-fedcba9876543210fedcba9876543210"
+                                       ".snapshots", "snap")})
+        self.assertEqual(sorted(snapshot_dirs["127.0.0.1"]),
+                         ["0123456789abcdef0123456789abcdef", "fedcba9876543210fedcba9876543210"])
+        self.assertEqual(deleted_tablets, {"127.0.0.1": {"00000000000000000000000000000002"}})
+
+    def test_other_tables_ignored(self):
+        tablets = {"127.0.0.1": {"fedcba9876543210fedcba9876543210"}}
+        with yb_backup_diff.ThreadPool(2) as pool:
+            self.ybb.pool = pool
+            (_, deleted_tablets) = self.ybb.generate_snapshot_dirs(
+                {"127.0.0.1": self.data_dirs}, "snap", tablets, ["aaa"])
+        self.assertEqual(deleted_tablets, {"127.0.0.1": {"fedcba9876543210fedcba9876543210"}})
+
+
+class FakeYbAdminMixin:
+    """
+    Creates a YBBackup that runs a fake yb-admin script in a temporary directory. Every call is
+    logged to the "calls" file in that directory, with its start and end times, once the script
+    has run.
+    """
+    YB_ADMIN_WRAPPER = """#!/bin/bash
+start=$(date +%s.%N)
+"$(dirname "$0")/yb-admin.sh" "$@"
+status=$?
+echo "$start $(date +%s.%N) $*" >> "$(dirname "$0")/calls"
+exit $status
+"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super().tearDown()
+
+    def create_ybb(self, fake_yb_admin, args):
+        """
+        :param fake_yb_admin: the bash script run for every yb-admin call
+        :param args: the arguments after --masters, --backup_location and the yb-admin binary
+        """
+        for (name, script) in [("yb-admin", self.YB_ADMIN_WRAPPER),
+                               ("yb-admin.sh", "#!/bin/bash\n" + fake_yb_admin)]:
+            with open(os.path.join(self.tmp_dir, name), "w") as fp:
+                fp.write(script)
+            os.chmod(os.path.join(self.tmp_dir, name), 0o755)
+        return yb_backup_diff.YBBackup.create(
+            ["--masters", "127.0.0.1:7100", "--backup_location", self.tmp_dir,
+             "--local_yb_admin_binary", os.path.join(self.tmp_dir, "yb-admin")] + args)
+
+    def yb_admin_calls(self):
+        """
+        :return: the (start time, end time, arguments) of every finished yb-admin call
+        """
+        if not os.path.exists(os.path.join(self.tmp_dir, "calls")):
+            return []
+        with open(os.path.join(self.tmp_dir, "calls")) as fp:
+            return [(float(start), float(end), args.split())
+                    for (start, end, args) in (line.rstrip("\n").split(" ", 2) for line in fp)]
+
+    def assert_ran_at_once(self, calls):
+        # Every call started before any of them ended.
+        self.assertLess(max(start for (start, _, _) in calls), min(end for (_, end, _) in calls))
+
+
+class TabletListingTest(FakeYbAdminMixin, unittest.TestCase):
+    # Prints two tablets of the table named by the arguments, or three replicas of a tablet.
+    FAKE_YB_ADMIN = """sleep 0.2
+if [ "$3" = list_tablet_servers ]; then
+  printf 'Server UUID\tRPC Host/Port\tRole\n'
+  for n in 1 2 3; do
+    printf '%032d\t10.0.%s.%s:9100\tFOLLOWER\n' "$n" "${4: -1}" "$n"
+  done
+  exit
+fi
+table="${@: -6:1}"
+printf 'Tablet-UUID\tRange\tLeader-IP\tLeader-UUID\n'
+for n in 1 2; do
+  printf '%032d\tkey_start: ""\t10.0.0.%s:9100\t%032d\n' "${#table}$n" "$n" 0
+done
+"""
+
+    def setUp(self):
+        super().setUp()
+        args = []
+        for table in ["t", "tt", "ttt", "tttt"]:
+            args += ["--keyspace", "ks", "--table", table]
+        self.ybb = self.create_ybb(self.FAKE_YB_ADMIN, args + ["create"])
+
+    def num_calls(self):
+        return len(self.yb_admin_calls())
+
+    def test_parallel_and_cached(self):
+        with yb_backup_diff.ThreadPool(4) as pool:
+            self.ybb.pool = pool
+            start_time = time.time()
+            tablet_leaders = self.ybb.find_tablet_leaders()
+            self.assertLess(time.time() - start_time, 0.6)
+            self.assertEqual(self.ybb.find_tablet_leaders(), tablet_leaders)
+        self.assertEqual(self.num_calls(), 4)
+        self.assertEqual(len(tablet_leaders), 8)
+        # In the order of the tables.
+        self.assertEqual(tablet_leaders[:2], [("{:032d}".format(11), "10.0.0.1"),
+                                              ("{:032d}".format(12), "10.0.0.2")])
+        self.assertEqual(tablet_leaders[-1], ("{:032d}".format(42), "10.0.0.2"))
+
+    def test_find_tablet_replicas(self):
+        snapshot_metadata = {"tablet": dict(
+            ("{:032d}".format(n), "old{}".format(n)) for n in range(1, 5))}
+        with yb_backup_diff.ThreadPool(4) as pool:
+            self.ybb.pool = pool
+            start_time = time.time()
+            tablets_by_tserver = self.ybb.find_tablet_replicas(snapshot_metadata)
+            self.assertLess(time.time() - start_time, 0.6)
+            self.assertEqual(tablets_by_tserver["10.0.3.2"], {"{:032d}".format(3)})
+            self.assertEqual(len(tablets_by_tserver), 12)
+            # Only the given tablets are listed again.
+            self.assertEqual(
+                self.ybb.find_tablet_replicas(snapshot_metadata, {"{:032d}".format(4)}),
+                dict(("10.0.4.{}".format(n), {"{:032d}".format(4)}) for n in range(1, 4)))
+        self.assertEqual(self.num_calls(), 5)
+
+
+class SnapshotPollingTest(FakeYbAdminMixin, unittest.TestCase):
+    SNAPSHOT_ID = "0436035d-c4c5-40c6-b45b-19538849b0d9"
+    # Another snapshot whose id starts with the same characters is listed first.
+    OUTPUT = """Snapshot UUID                         State
+{other}  COMPLETE
+  {{"type":"NAMESPACE","id":"ns0","data":{{"name":"other","database_type":"YQL_DATABASE_CQL"}}}}
+{id}  {state}
+  {{"type":"NAMESPACE","id":"ns1","data":{{"name":"db","database_type":"YQL_DATABASE_PGSQL"}}}}
+  {{"type":"TABLE","id":"t1","data":{{"name":"t","namespace_id":"ns1"}}}}
+c1ad61bf-a42b-4bbb-94f9-28516985c2c5  COMPLETE
+"""
+    # The snapshot is running for the first two polls, which are logged once they finish.
+    FAKE_YB_ADMIN = """state=COMPLETE
+if [ "$(cat "$(dirname "$0")/calls" 2>/dev/null | wc -l)" -lt 2 ]; then
+  state=RUNNING
+fi
+cat "$(dirname "$0")/output.$state"
+"""
+
+    def setUp(self):
+        super().setUp()
+        for state in ["RUNNING", "COMPLETE"]:
+            with open(os.path.join(self.tmp_dir, "output." + state), "w") as fp:
+                fp.write(self.OUTPUT.format(id=self.SNAPSHOT_ID, state=state,
+                                            other=self.SNAPSHOT_ID[:-4] + "ffff"))
+        self.ybb = self.create_ybb(self.FAKE_YB_ADMIN, ["--keyspace", "ysql.db", "create"])
+
+    def test_find_snapshot_block(self):
+        output = self.OUTPUT.format(id=self.SNAPSHOT_ID, state="RUNNING",
+                                    other=self.SNAPSHOT_ID + "0")
+        (state, details) = yb_backup_diff.find_snapshot_block(output, self.SNAPSHOT_ID)
+        self.assertEqual(state, "RUNNING")
+        self.assertEqual([json.loads(line)["id"] for line in details], ["ns1", "t1"])
+        self.assertEqual(yb_backup_diff.find_snapshot_block(output, "c1ad61bf"), (None, []))
+        self.assertEqual(yb_backup_diff.find_snapshot_block(
+            output, "c1ad61bf-a42b-4bbb-94f9-28516985c2c5"), ("COMPLETE", []))
+
+    def test_backoff_delays(self):
+        delays = yb_backup_diff.backoff_delays(1, 5, jitter=0.2)
+        expected = [1, 2, 4, 5, 5]
+        for (delay, base) in zip(delays, expected):
+            self.assertGreaterEqual(delay, base * 0.8)
+            self.assertLessEqual(delay, base * 1.2)
+
+    def test_wait_for_snapshot(self):
+        self.ybb.wait_for_snapshot(self.SNAPSHOT_ID, "creating", 60, True)
+        calls = self.yb_admin_calls()
+        self.assertEqual([args[args.index("--undefok") - 1] if "--undefok" in args else args[-1]
+                          for (_, _, args) in calls], ["list_snapshots"] * 3 + ["SHOW_DETAILS"])
+        # Polled right away, then after about 0.5 and 1 seconds, with a 20% jitter.
+        (first_delay, second_delay) = [calls[index + 1][0] - calls[index][1]
+                                       for index in range(2)]
+        self.assertGreaterEqual(first_delay, 0.4)
+        self.assertGreaterEqual(second_delay, 0.8)
+        self.assertEqual(self.ybb.args.keyspace, ["ysql.db"])
+        self.assertEqual(self.ybb.args.table, ["t"])
+        self.assertEqual(self.ybb.args.table_uuid, ["t1"])
+        self.assertEqual(len(self.ybb.snapshot_waits), 1)
+        self.assertEqual(self.ybb.snapshot_waits[0]["polls"], 3)
+
+    def test_timeout(self):
+        with self.assertRaises(yb_backup_diff.BackupException):
+            self.ybb.wait_for_snapshot(self.SNAPSHOT_ID, "creating", 0.3, False)
+        self.assertEqual(self.ybb.snapshot_waits, [])
+
+
+class FakeMasterHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.num_connections += 1
+
+    def do_GET(self):
+        (status, response) = self.server.responses.get(self.path, (404, {}))
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MasterHttpClientTest(unittest.TestCase):
+    # Recorded from a master web server, with shortened ids.
+    DUMP_ENTITIES = {
+        "keyspaces": [
+            {"keyspace_id": "ks1", "keyspace_name": "db", "keyspace_type": "ysql"},
+            {"keyspace_id": "ks2", "keyspace_name": "db", "keyspace_type": "ycql"}],
+        "tables": [
+            {"table_id": "t1", "keyspace_id": "ks1", "table_name": "t", "state": "RUNNING"},
+            {"table_id": "t0", "keyspace_id": "ks1", "table_name": "t", "state": "DELETED"},
+            {"table_id": "t2", "keyspace_id": "ks2", "table_name": "t", "state": "RUNNING"}],
+        "tablets": [
+            {"table_id": "t1", "tablet_id": "tablet1", "state": "RUNNING", "leader": "ts2",
+             "replicas": [{"type": "VOTER", "server_uuid": "ts{}".format(n),
+                           "addr": "10.0.0.{}:9100".format(n)} for n in range(1, 4)]},
+            {"table_id": "t1", "tablet_id": "tablet2", "state": "RUNNING", "leader": "ts1",
+             "replicas": [{"type": "VOTER", "server_uuid": "ts{}".format(n),
+                           "addr": "10.0.0.{}:9100".format(n)} for n in range(1, 3)]},
+            {"table_id": "t1", "tablet_id": "tablet0", "state": "REPLACED", "replicas": []},
+            {"table_id": "t2", "tablet_id": "tablet3", "state": "RUNNING", "leader": "ts3",
+             "replicas": [{"type": "VOTER", "server_uuid": "ts3", "addr": "10.0.0.3:9100"}]}]}
+    TABLET_SERVERS = {"": dict(("10.0.0.{}:9000".format(n), {
+        "status": "DEAD" if n == 1 else "ALIVE", "time_since_hb": "0.5s"}) for n in range(1, 4))}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.servers = []
+        # A follower, then the leader.
+        for status in [503, 200]:
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeMasterHandler)
+            server.num_connections = 0
+            server.responses = {"/api/v1/is-leader": (status, {})}
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        self.leader = self.servers[1]
+        self.leader.responses["/dump-entities"] = (200, self.DUMP_ENTITIES)
+        self.leader.responses["/api/v1/tablet-servers"] = (200, self.TABLET_SERVERS)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def web_address(self, server):
+        return "127.0.0.1:{}".format(server.server_address[1])
+
+    def create_ybb(self, fake_yb_admin):
+        yb_admin = os.path.join(self.tmp_dir, "yb-admin")
+        with open(yb_admin, "w") as fp:
+            fp.write(fake_yb_admin)
+        os.chmod(yb_admin, 0o755)
+        ybb = yb_backup_diff.YBBackup.create(
+            ["--masters", "127.0.0.1:7100", "--backup_location", self.tmp_dir,
+             "--local_yb_admin_binary", yb_admin, "--keyspace", "ysql.db", "--table", "t",
+             "create"])
+        ybb.master_http = yb_backup_diff.MasterHttpClient([self.web_address(self.leader)])
+        return ybb
+
+    def test_client(self):
+        client = yb_backup_diff.MasterHttpClient(
+            [self.web_address(server) for server in self.servers])
+        self.assertEqual(client.find_leader(), self.web_address(self.leader))
+        entities = client.dump_entities()
+        self.assertEqual(client.list_tservers()[1:], [("10.0.0.2", "9000", "ALIVE"),
+                                                      ("10.0.0.3", "9000", "ALIVE")])
+        client.dump_entities()
+        # All requests to the leader went over one connection.
+        self.assertEqual(self.leader.num_connections, 1)
+        self.assertEqual(client.num_requests, 5)
+        client.close()
+
+        self.assertEqual(yb_backup_diff.MasterHttpClient.find_table_id(entities, "ysql.db", "t"),
+                         "t1")
+        self.assertEqual(yb_backup_diff.MasterHttpClient.find_table_id(entities, "db", "t"), "t2")
+        self.assertEqual(yb_backup_diff.MasterHttpClient.tablet_leaders(entities, "t1"),
+                         [("tablet1", "10.0.0.2"), ("tablet2", "10.0.0.1")])
+        self.assertEqual(
+            yb_backup_diff.MasterHttpClient.tablet_replicas(entities, ["tablet2", "tablet3"]),
+            {"tablet2": ["10.0.0.1", "10.0.0.2"], "tablet3": ["10.0.0.3"]})
+        with self.assertRaises(yb_backup_diff.BackupException):
+            yb_backup_diff.MasterHttpClient.tablet_replicas(entities, ["tablet4"])
+
+    def test_no_leader(self):
+        client = yb_backup_diff.MasterHttpClient([self.web_address(self.servers[0])])
+        with self.assertRaises(yb_backup_diff.BackupException):
+            client.get_json("/dump-entities")
+
+    def test_backup_queries(self):
+        # yb-admin must not be run while the master web server answers.
+        ybb = self.create_ybb("#!/bin/bash\nexit 1\n")
+        self.assertEqual(ybb.get_leader_master_ip(), "127.0.0.1")
+        self.assertEqual(ybb.get_live_tserver_ip(), "10.0.0.2")
+        self.assertEqual(ybb.tserver_ip_to_web_port["10.0.0.3"], "9000")
+        self.assertEqual(ybb.find_tablet_leaders(),
+                         [("tablet1", "10.0.0.2"), ("tablet2", "10.0.0.1")])
+        self.assertEqual(ybb.find_tablet_replicas({"tablet": {"tablet1": "old1"}}),
+                         dict(("10.0.0.{}".format(n), {"tablet1"}) for n in range(1, 4)))
+
+    def test_fallback(self):
+        del self.leader.responses["/dump-entities"]
+        ybb = self.create_ybb(TabletListingTest.FAKE_YB_ADMIN)
+        with yb_backup_diff.ThreadPool(2) as pool:
+            ybb.pool = pool
+            self.assertEqual(len(ybb.find_tablet_leaders()), 2)
+            self.assertEqual(len(ybb.find_tablet_replicas({"tablet": {"tablet1": "old1"}})), 3)
+        with open(os.path.join(self.tmp_dir, "calls")) as fp:
+            self.assertEqual(len(fp.readlines()), 2)
+
+    def test_fallback_on_malformed_json(self):
+        self.leader.responses["/dump-entities"] = (200, {"tables": []})
+        self.leader.responses["/api/v1/tablet-servers"] = (200, {"": ["10.0.0.1:9000"]})
+        ybb = self.create_ybb(TabletListingTest.FAKE_YB_ADMIN.replace("sleep 0.2\n", """\
+if [[ " $* " == *" list_all_tablet_servers "* ]]; then
+  printf 'Tablet Server UUID\tRPC Host/Port\tHeartbeat delay\tStatus\n'
+  printf '%032d 10.0.9.1:9100 0.5s ALIVE\n' 1
+  exit
+fi
+"""))
+        with yb_backup_diff.ThreadPool(2) as pool:
+            ybb.pool = pool
+            self.assertEqual(ybb.get_live_tserver_ip(), "10.0.9.1")
+            self.assertEqual(len(ybb.find_tablet_leaders()), 2)
+            self.assertEqual(len(ybb.find_tablet_replicas({"tablet": {"tablet1": "old1"}})), 3)
+        with open(os.path.join(self.tmp_dir, "calls")) as fp:
+            self.assertEqual(len(fp.readlines()), 3)
+
+
+class S3TransferTest(unittest.TestCase):
+    PART_SIZE = yb_s3_transfer.MIN_PART_SIZE
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = yb_backup_diff_bench.LocalS3Server()
+        self.client = yb_s3_transfer.S3Client(self.server.config(), part_size=self.PART_SIZE,
+                                              concurrency=4, sse=True)
+        self.retry_delay_sec = yb_s3_transfer.RETRY_DELAY_SEC
+        yb_s3_transfer.RETRY_DELAY_SEC = 0
+
+    def tearDown(self):
+        yb_s3_transfer.RETRY_DELAY_SEC = self.retry_delay_sec
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, name, size):
+        path = os.path.join(self.tmp_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(os.urandom(size))
+        return path
+
+    def read_file(self, path):
+        with open(path, "rb") as fp:
+            return fp.read()
+
+    def test_multipart(self):
+        path = self.write_file("large.sst", 2 * self.PART_SIZE + 123)
+        self.client.put_file(path, "bucket", "backup/large.sst")
+        self.assertEqual(self.server.objects["bucket"]["backup/large.sst"], self.read_file(path))
+        self.assertEqual(sum(1 for (method, _, query) in self.server.requests
+                             if method == "PUT" and "partNumber" in query), 3)
+        self.assertIn("backup/large.sst", self.server.sse_keys)
+
+        self.client.get_file("bucket", "backup/large.sst", path + ".out")
+        self.assertEqual(self.read_file(path + ".out"), self.read_file(path))
+        # A HEAD, then three ranges.
+        self.assertEqual(len(self.server.requests), 5 + 4)
+        # All requests of one thread reuse its connection.
+        self.assertLessEqual(self.server.num_connections, 4)
+
+    def test_small_and_empty(self):
+        for size in [0, 1000]:
+            path = self.write_file("file{}".format(size), size)
+            self.client.put_file(path, "bucket", "f")
+            self.client.get_file("bucket", "f", path + ".out")
+            self.assertEqual(self.read_file(path + ".out"), self.read_file(path))
+        self.assertEqual(self.server.num_connections, 1)
+
+    def test_concurrency_bounds_files_and_parts(self):
+        client = yb_s3_transfer.S3Client(self.server.config(), part_size=self.PART_SIZE,
+                                         concurrency=2)
+        self.server.request_delay_sec = 0.05
+        paths = [self.write_file("{}.sst".format(index), 2 * self.PART_SIZE) for index in range(3)]
+        client.run_all(client.put_file, [(path, "bucket", os.path.basename(path))
+                                         for path in paths])
+        client.close()
+        self.assertEqual(len(self.server.objects["bucket"]), 3)
+        self.assertLessEqual(self.server.num_connections, 2)
+
+    def test_retry(self):
+        path = self.write_file("large.sst", self.PART_SIZE + 1)
+        self.server.failures = 2
+        self.client.put_file(path, "bucket", "retried")
+        self.assertEqual(self.server.objects["bucket"]["retried"], self.read_file(path))
+
+        self.server.failures = yb_s3_transfer.MAX_ATTEMPTS
+        with self.assertRaises(yb_s3_transfer.S3Error):
+            self.client.get_file("bucket", "retried", path + ".out")
+        self.assertFalse(os.path.exists(path + ".out"))
+
+    def test_region_redirects(self):
+        self.server.redirects = 1
+        self.assertIsNone(self.client.head("bucket", "missing"))
+        self.assertEqual(self.client.region, "region-0")
+
+        self.server.redirects = yb_s3_transfer.MAX_ATTEMPTS
+        with self.assertRaisesRegex(yb_s3_transfer.S3Error, "redirected to region"):
+            self.client.head("bucket", "missing")
+
+    def native_storage(self):
+        cfg_path = os.path.join(self.tmp_dir, "cloud_cfg")
+        config = self.server.config()
+        yb_backup_diff.write_s3_config_file(
+            cfg_path, access_key="key", secret_key="secret", host_base=config["host_base"],
+            host_bucket=config["host_bucket"], use_https="False")
+        args = yb_backup_diff.YBBackup.create(
+            ["--masters", "127.0.0.1:7100", "--backup_location", "s3://bucket/backup",
+             "--storage_engine", "native", "--s3_part_size_mb", "5", "--sse", "create"]).args
+        options = yb_backup_diff.BackupOptions(args)
+        options.cloud_cfg_file_path = cfg_path
+        storage = yb_backup_diff.NATIVE_BACKUP_STORAGE_ENGINES["s3"](options)
+        self.assertEqual(storage.install_files(self.tmp_dir),
+                         [os.path.join(self.tmp_dir, "yb_s3_transfer.py")])
+        return storage
+
+    def run_cmd(self, cmd):
+        return subprocess.check_output(cmd).decode("utf-8")
+
+    def test_storage_commands(self):
+        storage = self.native_storage()
+        run = self.run_cmd
+        snapshot_dir = os.path.join(self.tmp_dir, "snapshot")
+        sst = self.write_file("snapshot/000010.sst", self.PART_SIZE + 1)
+        self.write_file("snapshot/intents/000011.sst", 10)
+        run(storage.upload_file_cmd(sst, "s3://bucket/backup/tablet-1/"))
+        run(storage.upload_dir_cmd(snapshot_dir, "s3://bucket/backup/tablet-2/"))
+        run(storage.move_obj_cmd("s3://bucket/backup/tablet-1/000010.sst",
+                                 "s3://bucket/backup/tablet-3/"))
+        self.assertEqual(sorted(self.server.objects["bucket"]), [
+            "backup/tablet-2/000010.sst", "backup/tablet-2/intents/000011.sst",
+            "backup/tablet-3/000010.sst"])
+        self.assertIn("backup/tablet-1/000010.sst", self.server.sse_keys)
+
+        version = storage.parse_obj_version(
+            run(storage.stat_obj_cmd("s3://bucket/backup/tablet-3/000010.sst")))
+        self.assertIn("File size={}".format(self.PART_SIZE + 1), version)
+        with self.assertRaises(subprocess.CalledProcessError):
+            run(storage.stat_obj_cmd("s3://bucket/backup/tablet-1/000010.sst"))
+
+        restore_dir = os.path.join(self.tmp_dir, "restore") + "/"
+        os.mkdir(restore_dir)
+        run(storage.download_dir_cmd("s3://bucket/backup/tablet-2/", restore_dir))
+        self.assertEqual(self.read_file(os.path.join(restore_dir, "000010.sst")),
+                         self.read_file(sst))
+        self.assertTrue(os.path.exists(os.path.join(restore_dir, "intents", "000011.sst")))
+
+        self.server.page_size = 1
+        run(storage.delete_obj_cmd("s3://bucket/backup/tablet-2"))
+        self.assertEqual(sorted(self.server.objects["bucket"]), ["backup/tablet-3/000010.sst"])
+
+    def test_batch_commands(self):
+        storage = self.native_storage()
+        snapshot_dir = os.path.join(self.tmp_dir, "snapshot")
+        names = ["0000{}.sst".format(index) for index in range(10, 14)]
+        for name in names:
+            self.write_file(os.path.join("snapshot", name), 1000)
+        self.run_cmd(storage.upload_files_cmd(snapshot_dir, names[:3],
+                                              "s3://bucket/backup/tablet-1"))
+        self.run_cmd(storage.move_objs_cmd("s3://bucket/backup/tablet-1", names[1:3],
+                                           "s3://bucket/backup/tablet-2"))
+        self.assertEqual(sorted(self.server.objects["bucket"]), [
+            "backup/tablet-1/000010.sst", "backup/tablet-2/000011.sst",
+            "backup/tablet-2/000012.sst"])
+
+        restore_dir = os.path.join(self.tmp_dir, "restore")
+        os.mkdir(restore_dir)
+        self.run_cmd(storage.download_files_cmd("s3://bucket/backup/tablet-2", names[1:3],
+                                                restore_dir))
+        self.assertEqual(sorted(os.listdir(restore_dir)), names[1:3])
+        self.assertEqual(self.read_file(os.path.join(restore_dir, names[1])),
+                         self.read_file(os.path.join(snapshot_dir, names[1])))
+
+
+class StorageBatchTest(unittest.TestCase):
+    class Commands:
+        def __init__(self):
+            self.added = []
+
+        def add_parallel_args(self, *args_tuple, weight=0):
+            self.added.append((args_tuple[0], weight))
+
+    def test_batch_transfers(self):
+        transfers = [("/snap/a.sst", "s3://b/t/", "a.sst", 10),
+                     ("/snap/b.sst", "s3://b/t/", "b.sst", 10),
+                     ("s3://b/old/c.sst", "s3://b/t/", "c.sst", 0),
+                     ("/snap/d.sst", "s3://b/t/", "d.sst", 10),
+                     ("/snap/e.sst", "s3://b/t/", "e.sst", 100),
+                     ("s3://b/store/key1", "s3://b/t/", "f.sst", 1)]
+        batches = yb_backup_diff.batch_transfers(transfers, 10, 50)
+        self.assertEqual([[t[2] for t in batch] for batch in batches],
+                         [["a.sst", "b.sst", "d.sst"], ["c.sst"], ["e.sst"], ["f.sst"]])
+        batches = yb_backup_diff.batch_transfers(transfers, 2, 50)
+        self.assertEqual([[t[2] for t in batch] for batch in batches],
+                         [["a.sst", "b.sst"], ["c.sst"], ["d.sst"], ["e.sst"], ["f.sst"]])
+
+    def test_add_storage_transfers(self):
+        ybb = yb_backup_diff.YBBackup.create(
+            ["--masters", "127.0.0.1:7100", "--backup_location", "/nfs/backup",
+             "--max_files_per_storage_cmd", "3", "create"])
+        ybb.storage = yb_backup_diff.NfsBackupStorage(yb_backup_diff.BackupOptions(ybb.args))
+        commands = self.Commands()
+        transfers = [("/nfs/backup/b1/tablet-1/{}.sst".format(index), "/snap.tmp/",
+                      "{}.sst".format(index), index) for index in range(4)]
+        transfers.append(("/nfs/backup/store/key1", "/snap.tmp/", "4.sst", 7))
+        ybb.add_storage_transfers(
+            commands, "127.0.0.1", transfers,
+            lambda src, dest_dir, file: ybb.storage.download_file_cmd(
+                src, os.path.join(dest_dir, file)),
+            ybb.storage.download_files_cmd)
+        self.assertEqual([weight for (_, weight) in commands.added], [3, 3, 7])
+        self.assertEqual(commands.added[0][0], (
+            "printf '%s\\n' 0.sst 1.sst 2.sst | rsync -avhW --no-compress --files-from=- "
+            "/nfs/backup/b1/tablet-1/ /snap.tmp/",))
+        # A single file and a renamed one use the single-file command.
+        self.assertEqual(commands.added[1][0][-2:], ("/nfs/backup/b1/tablet-1/3.sst",
+                                                     "/snap.tmp/3.sst"))
+        self.assertEqual(commands.added[2][0][-2:], ("/nfs/backup/store/key1",
+                                                     "/snap.tmp/4.sst"))
+
+    def test_single_command_per_file(self):
+        ybb = yb_backup_diff.YBBackup.create(
+            ["--masters", "127.0.0.1:7100", "--backup_location", "/nfs/backup",
+             "--max_files_per_storage_cmd", "1", "create"])
+        ybb.storage = yb_backup_diff.NfsBackupStorage(yb_backup_diff.BackupOptions(ybb.args))
+        commands = self.Commands()
+        transfers = [("/snap/{}.sst".format(index), "/nfs/backup/tablet-1/",
+                      "{}.sst".format(index), 1) for index in range(3)]
+        ybb.add_storage_transfers(
+            commands, "127.0.0.1", transfers,
+            lambda src, dest_dir, file: ybb.storage.upload_file_cmd(src, dest_dir),
+            ybb.storage.upload_files_cmd)
+        self.assertEqual(len(commands.added), 3)
+
+
+class BackupChainCatalogTest(unittest.TestCase):
+    def make_catalog(self, num_backups):
+        catalog = yb_backup_diff.BackupChainCatalog()
+        for savepoint in range(num_backups):
+            manifest = yb_backup_diff.Manifest("manifest_{}".format(savepoint))
+            manifest.manifest_location = "s3://bucket/backup_{}".format(savepoint)
+            manifest.manifest_savepoint_number = savepoint
+            catalog.add(manifest, {"files": savepoint})
+        return catalog
+
+    def test_ancestors(self):
+        catalog = self.make_catalog(5)
+        self.assertEqual([entry["savepoint"] for entry
+                          in catalog.ancestors("s3://bucket/backup_3/", 3)], [3, 2, 1])
+        self.assertEqual([entry["savepoint"] for entry
+                          in catalog.ancestors("s3://bucket/backup_1", 3)], [1, 0])
+        self.assertIsNone(catalog.ancestors("s3://bucket/backup_9", 3))
+
+    def test_json_round_trip(self):
+        catalog = self.make_catalog(2)
+        loaded = yb_backup_diff.BackupChainCatalog.from_json_dict(
+            json.loads(json.dumps(catalog.to_json_dict())))
+        self.assertEqual(loaded.entries, catalog.entries)
+        with self.assertRaises(yb_backup_diff.BackupException):
+            yb_backup_diff.BackupChainCatalog.from_json_dict({"chain_catalog": 99})
+
+    def test_restore_point_updates_keep_previous_manifest(self):
+        ybb = yb_backup_diff.YBBackup.create(
+            ["--masters", "127.0.0.1:7100", "--backup_location", "s3://bucket/backup_1",
+             "--prev_manifest_source", "s3://bucket/backup_0", "create_diff"])
+        ybb.prev_manifest_class.storage_tablet_ids = {
+            "tablet1": {"1.sst": {"generation": 0, "src_location": "s3://bucket/backup_0/1.sst"}}}
+        manifests = ybb.get_restore_point_manifests("/tmp/MANIFEST", None)
+        # Later batches diff against the previous manifest after earlier ones moved files.
+        manifests[0].update_file("tablet1", "1.sst", src_location="s3://bucket/backup_1/1.sst")
+        self.assertEqual(ybb.prev_manifest_class.lookup_file("tablet1", "1.sst")["src_location"],
+                         "s3://bucket/backup_0/1.sst")
+
+
+class DedupIndexTest(unittest.TestCase):
+    KEYS = [hashlib.sha256(str(i).encode("utf-8")).hexdigest() for i in range(5)]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_empty(self):
+        index = yb_backup_diff.DedupIndex(os.path.join(self.tmp_dir, "missing"))
+        self.assertNotIn(self.KEYS[0], index)
+        index.add(self.KEYS[0])
+        self.assertIn(self.KEYS[0], index)
+
+    def test_write_and_merge(self):
+        path = os.path.join(self.tmp_dir, "INDEX")
+        index = yb_backup_diff.DedupIndex()
+        for key in self.KEYS[:3]:
+            index.add(key)
+        index.write(path)
+        other = yb_backup_diff.DedupIndex()
+        other.add(self.KEYS[2])
+        other.add(self.KEYS[3])
+        other.write(path + ".other")
+
+        loaded = yb_backup_diff.DedupIndex(path)
+        self.assertEqual(loaded.num_digests, 3)
+        self.assertIn(self.KEYS[1], loaded)
+        self.assertNotIn(self.KEYS[3], loaded)
+        loaded.write(path + ".merged", yb_backup_diff.DedupIndex(path + ".other"))
+        merged = yb_backup_diff.DedupIndex(path + ".merged")
+        self.assertEqual(merged.num_digests, 4)
+        for key in self.KEYS[:4]:
+            self.assertIn(key, merged)
+        self.assertNotIn(self.KEYS[4], merged)
+
+
+class SshConnectionPoolTest(unittest.TestCase):
+    # Logs its arguments and fails to connect to hosts named "down".
+    FAKE_SSH = "#!/bin/sh\necho \"$@\" >> {}\ncase \"$*\" in *down) exit 255;; esac\n"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmp_dir, "ssh.log")
+        ssh_path = os.path.join(self.tmp_dir, "ssh")
+        with open(ssh_path, "w") as fp:
+            fp.write(self.FAKE_SSH.format(self.log_path))
+        os.chmod(ssh_path, 0o755)
+        self.pool = yb_backup_diff.SshConnectionPool(["-l", "yugabyte"], ssh_program=ssh_path)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def logged_commands(self):
+        with open(self.log_path) as fp:
+            return fp.read().splitlines()
+
+    def test_reuses_master(self):
+        for _ in range(3):
+            options = self.pool.control_options("10.0.0.1")
+        self.assertEqual(options, ["-o", "ControlMaster=no",
+                                   "-o", "ControlPath=" + self.pool.control_path])
+        self.assertEqual(len(self.logged_commands()), 1)
+        self.assertTrue(self.logged_commands()[0].startswith("-M -N -f"))
+        stats = self.pool.stats()
+        self.assertEqual((stats["handshakes"], stats["reused"], stats["failed"]), (1, 3, 0))
+        self.pool.close()
+        self.assertTrue(self.logged_commands()[1].startswith("-O exit"))
+        self.assertFalse(os.path.exists(self.pool.control_dir))
+
+    def test_falls_back_without_master(self):
+        self.assertEqual(self.pool.control_options("down"), [])
+        self.assertEqual(self.pool.control_options("down"), [])
+        stats = self.pool.stats()
+        self.assertEqual((stats["handshakes"], stats["reused"], stats["failed"]), (1, 0, 1))
+
+
+class AsyncCmdEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = yb_backup_diff.AsyncCmdEngine(num_threads=2, max_in_flight=100)
+
+    def tearDown(self):
+        self.engine.__exit__(None, None, None)
+
+    def test_map(self):
+        async def square(value):
+            await asyncio.sleep(0.01)
+            return value * value
+
+        self.assertEqual(self.engine.map(square, [3, 1, 2]), [9, 1, 4])
+        self.assertEqual(self.engine.map(lambda value: -value, [3, 1, 2]), [-3, -1, -2])
+        self.assertEqual(self.engine.num_tasks, 6)
+        self.assertEqual(self.engine.num_failed_tasks, 0)
+
+    def test_concurrent_maps_log_their_own_tasks(self):
+        def wait(value):
+            time.sleep(0.1)
+            return value
+
+        with self.assertLogs(level="INFO") as logs:
+            threads = [threading.Thread(target=self.engine.map, args=(wait, range(count)))
+                       for count in (2, 5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(sorted(line.split("Ran ")[1].split(" tasks")[0]
+                                for line in logs.output), ["2", "5"])
+        self.assertEqual(self.engine.num_tasks, 7)
+
+    def test_many_in_flight(self):
+        async def wait(value):
+            await asyncio.sleep(0.2)
+            return value
+
+        start_time = time.time()
+        self.assertEqual(self.engine.map(wait, range(100)), list(range(100)))
+        # All at once, not two at a time like the worker threads.
+        self.assertLess(time.time() - start_time, 2)
+
+    def test_sequences(self):
+        calls = []
+
+        async def run_cmd(cmd, server_ip):
+            calls.append((cmd, server_ip))
+            return "{}@{}".format(cmd, server_ip)
+
+        parallel_cmds = yb_backup_diff.SequencedParallelCmd(run_cmd)
+        for server_ip in ("10.0.0.1", "10.0.0.2"):
+            parallel_cmds.start_command()
+            parallel_cmds.add_args("checksum", server_ip)
+            parallel_cmds.add_args_and_save_result("upload", server_ip)
+        results = parallel_cmds.run(self.engine)
+        self.assertEqual(sorted(results.values()), ["upload@10.0.0.1", "upload@10.0.0.2"])
+        self.assertLess(calls.index(("checksum", "10.0.0.1")), calls.index(("upload", "10.0.0.1")))
+
+    def test_cancel_on_failure(self):
+        finished = []
+
+        async def run_cmd(value):
+            if value == 0:
+                raise yb_backup_diff.BackupException("failed")
+            await asyncio.sleep(5)
+            finished.append(value)
+
+        start_time = time.time()
+        with self.assertRaises(yb_backup_diff.BackupException):
+            self.engine.map(run_cmd, range(10))
+        self.assertLess(time.time() - start_time, 2)
+        self.assertEqual(finished, [])
+        self.assertEqual(self.engine.num_failed_tasks, 10)
+
+
+class SequenceSchedulerTest(unittest.TestCase):
+    def sequences(self, hosts_and_disks, weights=None):
+        sequences = []
+        for index, (host, disk) in enumerate(hosts_and_disks):
+            sequence = yb_backup_diff.SequencedCmdArgs([], None, host=host, disk=(host, disk))
+            sequence.add((index,), weights[index] if weights else 0, parallel=False)
+            sequences.append(sequence)
+        return sequences
+
+    def test_spreads_over_hosts(self):
+        sequences = self.sequences([("a", "d0")] * 4 + [("b", "d0")] * 2)
+        scheduler = yb_backup_diff.SequenceScheduler(
+            sequences, yb_backup_diff.CmdLimits(3, 0, 0))
+        started = [scheduler.next_call() for _ in range(4)]
+        self.assertEqual([sequence.host for (sequence, _) in started[:3]], ["a", "b", "a"])
+        # The global limit.
+        self.assertIsNone(started[3])
+        self.assertTrue(scheduler.finish(*started[1]))
+        self.assertEqual(scheduler.next_call()[0].host, "b")
+
+    def test_host_and_disk_limits(self):
+        sequences = self.sequences([("a", "d0"), ("a", "d0"), ("a", "d1"), ("a", "d1")])
+        scheduler = yb_backup_diff.SequenceScheduler(
+            sequences, yb_backup_diff.CmdLimits(0, 3, 1))
+        started = [scheduler.next_call() for _ in range(3)]
+        self.assertEqual([sequence.disk for (sequence, _) in started[:2]],
+                         [("a", "d0"), ("a", "d1")])
+        self.assertIsNone(started[2])
+        scheduler.finish(*started[0])
+        self.assertEqual(scheduler.next_call()[0].disk, ("a", "d0"))
+        self.assertTrue(scheduler.has_queued())
+        self.assertEqual(scheduler.host_stats["a"]["peak"], 2)
+
+    def test_largest_first(self):
+        sequences = self.sequences([("a", "d0"), ("a", "d0"), ("b", "d0")], [1, 10, 5])
+        scheduler = yb_backup_diff.SequenceScheduler(
+            sequences, yb_backup_diff.CmdLimits(1, 0, 0))
+        order = []
+        while scheduler.has_queued():
+            order.append(scheduler.next_call())
+            scheduler.finish(*order[-1])
+        self.assertEqual([sequence.weights[index] for (sequence, index) in order], [10, 5, 1])
+
+    def test_stages(self):
+        sequence = yb_backup_diff.SequencedCmdArgs([], None, host="a", disk=("a", "d0"))
+        sequence.add(("mkdir",), 0, parallel=False)
+        sequence.add(("small",), 1, parallel=True)
+        sequence.add(("large",), 10, parallel=True)
+        sequence.add(("mv",), 0, parallel=False)
+        self.assertEqual(sequence.stages, [0, 1, 1, 2])
+        scheduler = yb_backup_diff.SequenceScheduler(
+            [sequence], yb_backup_diff.CmdLimits(0, 0, 0))
+        self.assertEqual(scheduler.next_call(), (sequence, 0))
+        # The downloads wait for the mkdir.
+        self.assertIsNone(scheduler.next_call())
+        self.assertFalse(scheduler.finish(sequence, 0))
+        # Both downloads run at once, the larger one first.
+        self.assertEqual([scheduler.next_call(), scheduler.next_call()],
+                         [(sequence, 2), (sequence, 1)])
+        self.assertIsNone(scheduler.next_call())
+        self.assertFalse(scheduler.finish(sequence, 2))
+        self.assertIsNone(scheduler.next_call())
+        self.assertFalse(scheduler.finish(sequence, 1))
+        self.assertEqual(scheduler.next_call(), (sequence, 3))
+        self.assertTrue(scheduler.finish(sequence, 3))
+        self.assertTrue(scheduler.is_done())
+
+    def test_predict_makespan(self):
+        sequences = self.sequences([("a", "d0")] * 5 + [("b", "d0")], [3, 3, 2, 2, 2, 1])
+        # LPT on two slots of a: 3+2+2 and 3+2.
+        self.assertEqual(yb_backup_diff.SequenceScheduler.predict_makespan(
+            sequences, yb_backup_diff.CmdLimits(0, 2, 0)), 7)
+        self.assertEqual(yb_backup_diff.SequenceScheduler.predict_makespan(
+            sequences, yb_backup_diff.CmdLimits(0, 0, 0)), 3)
+        # The files of one tablet are transferred at once.
+        tablet = yb_backup_diff.SequencedCmdArgs([], None, host="a", disk=("a", "d0"))
+        for weight in [3, 3, 2]:
+            tablet.add((weight,), weight, parallel=True)
+        tablet.add(("mv",), 1, parallel=False)
+        self.assertEqual(yb_backup_diff.SequenceScheduler.predict_makespan(
+            [tablet], yb_backup_diff.CmdLimits(0, 2, 0)), 6)
+
+    def run_limited(self, pool, run_cmd, calls):
+        parallel_cmds = yb_backup_diff.SequencedParallelCmd(run_cmd)
+        for index in range(12):
+            host = "10.0.0.{}".format(index % 3)
+            parallel_cmds.start_command(host=host, disk=(host, "d0"))
+            parallel_cmds.add_args(index, "mkdir")
+            parallel_cmds.add_parallel_args(index, "download", weight=2)
+            parallel_cmds.add_parallel_args(index, "download", weight=1)
+            parallel_cmds.add_args_and_save_result(index, "mv")
+        results = parallel_cmds.run(pool, yb_backup_diff.CmdLimits(6, 2, 0))
+        self.assertEqual(sorted(results.values()), list(range(12)))
+        self.assertEqual(parallel_cmds.scheduler.predicted_makespan, 6)
+        for stats in parallel_cmds.scheduler.host_stats.values():
+            self.assertEqual(stats["sequences"], 4)
+            self.assertEqual(stats["calls"], 16)
+            self.assertLessEqual(stats["peak"], 2)
+        for index in range(12):
+            self.assertEqual([step for (call_index, step) in calls if call_index == index],
+                             ["mkdir", "download", "download", "mv"])
+
+    def test_run_on_threads(self):
+        calls = []
+
+        def run_cmd(index, step):
+            calls.append((index, step))
+            time.sleep(0.01)
+            return index
+
+        with yb_backup_diff.ThreadPool(8) as pool:
+            self.run_limited(pool, run_cmd, calls)
+
+    def test_run_on_asyncio(self):
+        calls = []
+
+        async def run_cmd(index, step):
+            calls.append((index, step))
+            await asyncio.sleep(0.01)
+            return index
+
+        with yb_backup_diff.AsyncCmdEngine(2, 100) as engine:
+            self.run_limited(engine, run_cmd, calls)
+
+    def run_fed(self, pool, run_cmd, calls):
+        feed = yb_backup_diff.SequenceFeed()
+        parallel_cmds = yb_backup_diff.SequencedParallelCmd(run_cmd)
+        num_calls_before_close = []
+
+        def produce():
+            for index in range(6):
+                # Like the files of a tablet server, found one after another.
+                time.sleep(0.02)
+                batch = yb_backup_diff.SequencedParallelCmd(None)
+                batch.start_command(host="10.0.0.{}".format(index % 2))
+                batch.add_args(index, "mkdir")
+                batch.add_args_and_save_result(index, "mv")
+                feed.add(batch.parallel_args)
+            num_calls_before_close.append(len(calls))
+            feed.close()
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        results = parallel_cmds.run(pool, yb_backup_diff.CmdLimits(4, 0, 0), feed)
+        producer.join()
+        self.assertEqual(sorted(results.values()), list(range(6)))
+        self.assertEqual(len(calls), 12)
+        # The first sequences ran while the last ones were not added yet.
+        self.assertGreater(num_calls_before_close[0], 0)
+        # Fed sequences are not all ready at the start, so the run is not predicted.
+        self.assertIsNone(parallel_cmds.scheduler.predicted_makespan)
+
+    def test_feed_on_threads(self):
+        calls = []
+
+        def run_cmd(index, step):
+            calls.append((index, step))
+            return index
+
+        with yb_backup_diff.ThreadPool(4) as pool:
+            self.run_fed(pool, run_cmd, calls)
+
+    def test_feed_on_asyncio(self):
+        calls = []
+
+        async def run_cmd(index, step):
+            calls.append((index, step))
+            return index
+
+        with yb_backup_diff.AsyncCmdEngine(2, 100) as engine:
+            self.run_fed(engine, run_cmd, calls)
+
+    def test_cancelled_feed(self):
+        feed = yb_backup_diff.SequenceFeed()
+        parallel_cmds = yb_backup_diff.SequencedParallelCmd(lambda index: index)
+        parallel_cmds.start_command(host="a")
+        parallel_cmds.add_args(0)
+        feed.cancel()
+        with yb_backup_diff.ThreadPool(2) as pool:
+            self.assertEqual(parallel_cmds.run(pool, yb_backup_diff.CmdLimits(2, 0, 0), feed), {})
+
+
+class LoopbackChannel:
+    """
+    Channel of LoopbackTransport, running its command in a local shell.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.proc = None
+
+    def set_combine_stderr(self, combine):
+        self.stderr = subprocess.STDOUT if combine else subprocess.DEVNULL
+
+    def exec_command(self, cmd):
+        self.transport.commands.append(cmd)
+        self.proc = subprocess.Popen(["bash", "-c", cmd], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=self.stderr)
+
+    def sendall(self, data):
+        self.proc.stdin.write(data)
+
+    def shutdown_write(self):
+        self.proc.stdin.close()
+
+    def recv(self, size):
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+        return self.proc.stdout.read1(size)
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        self.proc.stdout.close()
+        with self.transport.lock:
+            self.transport.num_open -= 1
+
+
+class LoopbackTransport:
+    """
+    Stand-in for paramiko.Transport that runs the commands of its channels locally.
+    """
+    def __init__(self):
+        self.commands = []
+        self.active = True
+        self.lock = threading.Lock()
+        self.num_open = 0
+        self.max_open = 0
+
+    def open_session(self):
+        with self.lock:
+            self.num_open += 1
+            self.max_open = max(self.max_open, self.num_open)
+        return LoopbackChannel(self)
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+
+
+class NativeSshExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.transports = []
+        self.executor = yb_backup_diff.NativeSshExecutor(self.connect, max_channels=2)
+
+    def connect(self, server_ip):
+        self.transports.append(LoopbackTransport())
+        return self.transports[-1]
+
+    def test_run(self):
+        self.assertEqual(self.executor.run("10.0.0.1", "echo out; echo err >&2"),
+                         b"out\nerr\n")
+        self.assertEqual(self.executor.run("10.0.0.1", "cat", stdin_data=b"cfg"), b"cfg")
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            self.executor.run("10.0.0.1", "echo failed; exit 3")
+        self.assertEqual((context.exception.returncode, context.exception.output),
+                         (3, b"failed\n"))
+        # One transport for all the commands.
+        self.assertEqual(len(self.transports), 1)
+        self.assertEqual(len(self.transports[0].commands), 3)
+
+    def test_reconnect_and_close(self):
+        self.executor.run("10.0.0.1", "true")
+        self.transports[0].active = False
+        self.executor.run("10.0.0.1", "true")
+        self.executor.run("10.0.0.2", "true")
+        self.assertEqual(self.executor.num_connects, 3)
+        self.executor.close()
+        self.assertFalse(any(transport.is_active() for transport in self.transports))
+
+    def test_concurrent_channels(self):
+        threads = [threading.Thread(target=self.executor.run, args=("10.0.0.1", "sleep 0.1"))
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.transports), 1)
+        self.assertEqual(self.transports[0].max_open, 2)
+
+
+class DiffEngineTest(unittest.TestCase):
+    SNAPSHOT_DIR = "/mnt/d0/yb-data/tserver/data/rocksdb/table-t/tablet-{}.snapshots/snap"
+
+    def snapshot_file(self, tablet_id, filename):
+        return os.path.join(self.SNAPSHOT_DIR.format(tablet_id), filename)
+
+    def find_result(self, tablet_id, filename, inode):
+        return yb_backup_diff.SnapshotFile(
+            self.snapshot_file(tablet_id, filename), 2049, inode, 1024, 1700000000.0)
+
+    def setUp(self):
+        files = {("/mnt/d0", "snap", "10.0.0.1"): [
+                     self.find_result("tablet1", "000010.sst", 100),
+                     self.find_result("tablet1", "000011.sst", 101),
+                     self.find_result("tablet1", "MANIFEST-000012", 102),
+                     self.find_result("tablet4", "000010.sst", 103)],
+                 ("/mnt/d0", "snap", "10.0.0.2"): [self.find_result("tablet2", "000013.sst", 100)]}
+        tablet_leaders = [("tablet1", "10.0.0.1"), ("tablet2", "10.0.0.2"),
+                          ("tablet3", "10.0.0.2")]
+        self.tablets = yb_backup_diff.YBBackup.create_manifest(files, tablet_leaders)
+        self.prev_manifest = yb_backup_diff.Manifest("prev")
+        self.prev_manifest.storage_tablet_ids = {
+            "tablet1": {"000010.sst": {"filename": "000010.sst", "generation": 1,
+                                       "src_location": "s3://bucket/b1/tablet-tablet1/000010.sst"}},
+            "tablet2": {"000013.sst": {"filename": "000013.sst", "generation": 2,
+                                       "src_location": "s3://bucket/b0/tablet-tablet2/000013.sst"}}}
+
+    def test_create_manifest(self):
+        self.assertEqual(sorted(self.tablets), ["tablet1", "tablet2", "tablet3"])
+        self.assertEqual(sorted(self.tablets["tablet1"].files),
+                         ["000010.sst", "000011.sst", "MANIFEST-000012"])
+        self.assertEqual(self.tablets["tablet3"].files, {})
+        entry = self.tablets["tablet2"].files["000013.sst"]
+        self.assertEqual(entry.src_location, self.snapshot_file("tablet2", "000013.sst"))
+        self.assertEqual(entry.generation, 1)
+
+    def test_diff(self):
+        (num_new, num_unchanged, moved) = yb_backup_diff.diff_tablet_entries(
+            self.tablets, self.prev_manifest, 2)
+        self.assertEqual((num_new, num_unchanged), (1, 2))
+        self.assertEqual([(entry.tablet_id, entry.filename) for entry in moved],
+                         [("tablet2", "000013.sst")])
+        storage_tablet_ids = yb_backup_diff.tablet_entries_to_storage_tablet_ids(self.tablets)
+        self.assertEqual(storage_tablet_ids["tablet1"]["000010.sst"],
+                         {"filename": "000010.sst", "generation": 2, "action": "NOOP",
+                          "src_location": "s3://bucket/b1/tablet-tablet1/000010.sst",
+                          "size": 1024})
+        self.assertEqual(storage_tablet_ids["tablet1"]["000011.sst"]["action"], "COPY")
+        self.assertEqual(storage_tablet_ids["tablet1"]["MANIFEST-000012"]["action"], "COPY")
+        self.assertEqual(storage_tablet_ids["tablet2"]["000013.sst"],
+                         {"filename": "000013.sst", "generation": 1, "action": "MOVE",
+                          "src_location": "s3://bucket/b0/tablet-tablet2/000013.sst",
+                          "size": 1024})
+        self.assertEqual(storage_tablet_ids["tablet3"], {})
+
+    def test_diff_keeps_dedup_store_files(self):
+        self.prev_manifest.storage_tablet_ids["tablet2"]["000013.sst"]["content_key"] = "ab12"
+        (_, _, moved) = yb_backup_diff.diff_tablet_entries(self.tablets, self.prev_manifest, 2)
+        self.assertEqual(moved, [])
+        entry = self.tablets["tablet2"].files["000013.sst"]
+        self.assertEqual((entry.action, entry.generation, entry.content_key),
+                         (yb_backup_diff.ACTION_CODE_NOOP, 3, "ab12"))
+
+    def test_share_physical_files(self):
+        # The children of a split tablet hard link the SST files of their parent.
+        files = {("/mnt/d0", "snap", "10.0.0.1"): [
+                     self.find_result("child1", "000010.sst", 100),
+                     self.find_result("child1", "MANIFEST-000012", 101),
+                     self.find_result("child2", "000010.sst", 100),
+                     self.find_result("child2", "MANIFEST-000012", 102)],
+                 ("/mnt/d0", "snap", "10.0.0.2"): [self.find_result("child3", "000010.sst", 100)]}
+        tablets = yb_backup_diff.YBBackup.create_manifest(
+            files, [("child1", "10.0.0.1"), ("child2", "10.0.0.1"), ("child3", "10.0.0.2")])
+        for tablet in tablets.values():
+            tablet.directory = True
+            for entry in tablet.files.values():
+                entry.action = yb_backup_diff.ACTION_CODE_COPY
+        self.assertEqual(yb_backup_diff.share_physical_files(tablets), 1)
+        first_entry = tablets["child1"].files["000010.sst"]
+        shared_entry = tablets["child2"].files["000010.sst"]
+        self.assertIs(shared_entry.shared_with, first_entry)
+        self.assertEqual(shared_entry.action, yb_backup_diff.ACTION_CODE_NOOP)
+        self.assertEqual([tablets[t].directory for t in ("child1", "child2", "child3")],
+                         [True, False, True])
+        # Same inode on another tserver is another file.
+        self.assertEqual(tablets["child3"].files["000010.sst"].action,
+                         yb_backup_diff.ACTION_CODE_COPY)
+        self.assertEqual(tablets["child2"].files["MANIFEST-000012"].action,
+                         yb_backup_diff.ACTION_CODE_COPY)
+
+    def test_share_moved_files(self):
+        self.prev_manifest.storage_tablet_ids["tablet1"]["000010.sst"] = dict(
+            self.prev_manifest.storage_tablet_ids["tablet2"]["000013.sst"])
+        (_, _, moved) = yb_backup_diff.diff_tablet_entries(self.tablets, self.prev_manifest, 2)
+        self.assertEqual(len(moved), 2)
+        self.assertEqual(yb_backup_diff.share_physical_files(self.tablets), 1)
+        self.assertIs(self.tablets["tablet2"].files["000013.sst"].shared_with,
+                      self.tablets["tablet1"].files["000010.sst"])
+
+    def test_share_moved_files_in_batches(self):
+        self.prev_manifest.storage_tablet_ids["tablet1"]["000010.sst"] = dict(
+            self.prev_manifest.storage_tablet_ids["tablet2"]["000013.sst"])
+        yb_backup_diff.diff_tablet_entries(self.tablets, self.prev_manifest, 2)
+        # The tablets of each tserver are planned as soon as they are found.
+        first_entries = {}
+        batch1 = {"tablet2": self.tablets["tablet2"]}
+        batch2 = {"tablet1": self.tablets["tablet1"]}
+        self.assertEqual(yb_backup_diff.share_physical_files(batch1, first_entries), 0)
+        self.assertEqual(yb_backup_diff.share_physical_files(batch2, first_entries), 1)
+        self.assertIs(self.tablets["tablet1"].files["000010.sst"].shared_with,
+                      self.tablets["tablet2"].files["000013.sst"])
+
+    def test_parse_snapshot_discovery(self):
+        snapshot_dir = self.SNAPSHOT_DIR.format("tablet1")
+        output = ("d\t/mnt/d0\t0\t0\t0\t0\t{}\n"
+                  "f\t/mnt/d0\t2049\t100\t1024\t1700000000.5000000000\t{}\n"
+                  "find: '/mnt/d1/lost+found': Permission denied\n").format(
+                      snapshot_dir, self.snapshot_file("tablet1", "000010.sst"))
+        discovery = yb_backup_diff.parse_snapshot_discovery(["/mnt/d0", "/mnt/d1"], output)
+        self.assertEqual(discovery.snapshot_dirs, {"/mnt/d0": [snapshot_dir], "/mnt/d1": []})
+        self.assertEqual(discovery.files["/mnt/d0"], [
+            yb_backup_diff.SnapshotFile(self.snapshot_file("tablet1", "000010.sst"),
+                                        2049, 100, 1024, 1700000000.5)])
+        self.assertEqual(discovery.files["/mnt/d1"], [])
+
+    def test_file_entry_round_trip(self):
+        entry = {"filename": "000010.sst", "generation": 3, "action": "NOOP",
+                 "src_location": "s3://bucket/b1/tablet-tablet1/000010.sst"}
+        self.assertEqual(yb_backup_diff.FileEntry.from_dict("tablet1", entry).to_dict(), entry)
+
+
 class BackupRunner:
     def __init__(self, args):
         self.args = args
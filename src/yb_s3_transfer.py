@@ -0,0 +1,639 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 YugaByte, Inc. and Contributors
+
+# Licensed under the Polyform Free Trial License 1.0.0 (the "License"); you
+# may not use this file except in compliance with the License. You
+# may obtain a copy of the License at
+#
+# https://github.com/YugaByte/yugabyte-db/blob/master/licenses/POLYFORM-FREE-TRIAL-LICENSE-1.0.0.txt
+
+"""
+Native S3 transfer engine of yb_backup_diff.py, used with --storage_engine native.
+
+It takes the subset of the s3cmd command line that yb_backup_diff.py uses, and reads the same
+config file, so that the S3 storage commands only change their program. It needs nothing but the
+standard library, which lets it be copied to the tablet servers next to the config file.
+
+Files larger than a part are uploaded with multipart uploads and downloaded with ranged GETs,
+both with several parts in flight. All requests of a command share kept-alive connections.
+Example:
+    python3 yb_s3_transfer.py --config=cloud_cfg --part_size_mb=64 --concurrency=8 \\
+        put /mnt/d0/yb-data/.../000010.sst.sblock.0 s3://bucket/backup/tablet-xyz/
+"""
+
+import argparse
+import base64
+import collections
+import concurrent.futures
+import configparser
+import hashlib
+import hmac
+import http.client
+import math
+import os
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+DEFAULT_HOST_BASE = 's3.amazonaws.com'
+DEFAULT_HOST_BUCKET = '%(bucket)s.s3.amazonaws.com'
+DEFAULT_REGION = 'us-east-1'
+DEFAULT_PART_SIZE_MB = 64
+DEFAULT_CONCURRENCY = 8
+# S3 limits of multipart uploads and of single-request copies.
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+DELETE_BATCH_SIZE = 1000
+IO_CHUNK_SIZE = 1024 * 1024
+MAX_ATTEMPTS = 5
+RETRY_DELAY_SEC = 0.5
+TIMEOUT_SEC = 60
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+SSE_ALGORITHM = 'AES256'
+
+S3Location = collections.namedtuple('S3Location', ['bucket', 'key'])
+
+
+class S3Error(Exception):
+    """A failed S3 request or transfer."""
+    def __init__(self, message, status=None):
+        super(S3Error, self).__init__(message)
+        self.status = status
+
+
+def parse_s3_url(url):
+    """
+    :param url: s3://bucket/key
+    :return: an S3Location
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme != 's3' or not parsed.netloc:
+        raise S3Error("Not an S3 URL: {}".format(url))
+    return S3Location(parsed.netloc, parsed.path.lstrip('/'))
+
+
+def xml_texts(body, name):
+    """
+    :return: the texts of all elements of the given name in an S3 XML response, in any namespace
+    """
+    root = ElementTree.fromstring(body)
+    return [element.text or '' for element in root.iter()
+            if element.tag == name or element.tag.endswith('}' + name)]
+
+
+def canonical_query(query):
+    """
+    :return: the query string in the canonical form of the signature, which is also sent
+    """
+    return '&'.join('{}={}'.format(urllib.parse.quote(name, safe='-_.~'),
+                                   urllib.parse.quote(value, safe='-_.~'))
+                    for name, value in sorted(query.items()))
+
+
+def read_config(path):
+    """
+    Reads an s3cmd config file, with the environment of the AWS tools as the fallback.
+    :return: a dict of the settings used by S3Client
+    """
+    config = {'access_key': os.getenv('AWS_ACCESS_KEY_ID', ''),
+              'secret_key': os.getenv('AWS_SECRET_ACCESS_KEY', ''),
+              'access_token': os.getenv('AWS_SESSION_TOKEN', ''),
+              'host_base': os.getenv('AWS_HOST_BASE', DEFAULT_HOST_BASE),
+              'host_bucket': None,
+              'bucket_location': os.getenv('AWS_REGION', ''),
+              'use_https': 'True'}
+    if path:
+        parser = configparser.RawConfigParser()
+        parser.read(path)
+        if parser.has_section('default'):
+            for key, value in parser.items('default'):
+                if key in config and value.strip():
+                    config[key] = value.strip()
+    if config['host_bucket'] is None:
+        config['host_bucket'] = (DEFAULT_HOST_BUCKET if config['host_base'] == DEFAULT_HOST_BASE
+                                 else config['host_base'])
+    return config
+
+
+class FileSlice:
+    """
+    A request body reading a range of a local file in chunks, so that a part is not held in
+    memory.
+    """
+    def __init__(self, path, offset, length):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def __iter__(self):
+        with open(self.path, 'rb') as fp:
+            fp.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = fp.read(min(IO_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise S3Error("{} is shorter than expected".format(self.path))
+                remaining -= len(chunk)
+                yield chunk
+
+
+class S3Client:
+    """
+    Signs requests with AWS Signature Version 4 and sends them over a pool of kept-alive
+    connections, shared by all threads. Failed requests are retried with growing delays.
+    """
+    def __init__(self, config, part_size=DEFAULT_PART_SIZE_MB * 1024 * 1024,
+                 concurrency=DEFAULT_CONCURRENCY, sse=False, check_certificate=True):
+        self.access_key = config['access_key']
+        self.secret_key = config['secret_key']
+        self.access_token = config['access_token']
+        self.host_base = config['host_base']
+        self.host_bucket = config['host_bucket']
+        self.region = config['bucket_location'] or DEFAULT_REGION
+        self.use_https = config['use_https'].lower() in ('true', 'yes', 'on', '1')
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        self.concurrency = max(1, concurrency)
+        self.sse = sse
+        self.ssl_context = None
+        if self.use_https:
+            self.ssl_context = (ssl.create_default_context() if check_certificate
+                                else ssl._create_unverified_context())
+        self.lock = threading.Lock()
+        # Bounds the requests in flight, and so the connections, of all parts and files
+        # transferred at once by the nested thread pools of a command.
+        self.request_slots = threading.BoundedSemaphore(self.concurrency)
+        # Host to the connections not used by any thread.
+        self.idle_connections = {}
+        self.num_connections = 0
+        self.num_requests = 0
+        self.num_bytes = 0
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle_connections.values():
+                for connection in connections:
+                    connection.close()
+            self.idle_connections = {}
+
+    def host_and_path(self, bucket, key):
+        """
+        :return: the host and the path addressing the object, virtual-hosted style when the
+                 config names the bucket in host_bucket, path style otherwise
+        """
+        if '%(bucket)s' in self.host_bucket and '.' not in bucket:
+            return self.host_bucket % {'bucket': bucket}, '/' + key
+        return self.host_base, '/{}/{}'.format(bucket, key)
+
+    def sign(self, method, host, path, query, headers):
+        """
+        Adds the date, the payload hash and the Authorization header to the given headers.
+        """
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        headers['host'] = host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = UNSIGNED_PAYLOAD
+        if self.access_token:
+            headers['x-amz-security-token'] = self.access_token
+        if not self.access_key:
+            return
+
+        signed_headers = ';'.join(sorted(headers))
+        canonical_headers = ''.join('{}:{}\n'.format(name, str(headers[name]).strip())
+                                    for name in sorted(headers))
+        canonical_request = '\n'.join([
+            method, urllib.parse.quote(path, safe='/-_.~'), canonical_query(query),
+            canonical_headers,
+            signed_headers, UNSIGNED_PAYLOAD])
+        scope = '{}/{}/s3/aws4_request'.format(amz_date[:8], self.region)
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+        key = ('AWS4' + self.secret_key).encode('utf-8')
+        for item in [amz_date[:8], self.region, 's3', 'aws4_request']:
+            key = hmac.new(key, item.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        headers['authorization'] = (
+            'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+                self.access_key, scope, signed_headers, signature))
+
+    def new_connection(self, host):
+        with self.lock:
+            self.num_connections += 1
+        if self.use_https:
+            return http.client.HTTPSConnection(host, timeout=TIMEOUT_SEC,
+                                               context=self.ssl_context)
+        return http.client.HTTPConnection(host, timeout=TIMEOUT_SEC)
+
+    def request(self, method, bucket, key, query=None, headers=None, body=None, sink=None,
+                expected=(200,)):
+        """
+        Sends a request, retrying it on connection errors and on server errors.
+        :param body: bytes, or a function returning a fresh iterable body for every attempt
+        :param sink: a function given the chunks of the response body, which is then not
+                     returned
+        :param expected: the statuses that are not errors
+        :return: the status, the headers and the body of the response
+        """
+        with self.request_slots:
+            return self._request(method, bucket, key, query, headers, body, sink, expected)
+
+    def _request(self, method, bucket, key, query, headers, body, sink, expected):
+        query = query or {}
+        error = None
+        for attempt in range(MAX_ATTEMPTS):
+            request_headers = dict((name.lower(), value)
+                                   for name, value in (headers or {}).items())
+            (host, path) = self.host_and_path(bucket, key)
+            self.sign(method, host, path, query, request_headers)
+            url = urllib.parse.quote(path, safe='/-_.~')
+            if query:
+                url += '?' + canonical_query(query)
+            with self.lock:
+                self.num_requests += 1
+                idle = self.idle_connections.get(host)
+                connection = idle.pop() if idle else None
+            if connection is None:
+                connection = self.new_connection(host)
+            try:
+                connection.request(method, url, body=body() if callable(body) else body,
+                                   headers=request_headers)
+                response = connection.getresponse()
+                if sink is not None and response.status in expected:
+                    response_body = b''
+                    while True:
+                        chunk = response.read(IO_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        sink(chunk)
+                else:
+                    response_body = response.read()
+            except (OSError, http.client.HTTPException) as ex:
+                connection.close()
+                error = S3Error("{} {} failed: {!r}".format(method, url, ex))
+                if sink is not None:
+                    # The sink got part of the body already.
+                    raise error
+            else:
+                if response.will_close:
+                    connection.close()
+                else:
+                    with self.lock:
+                        self.idle_connections.setdefault(host, []).append(connection)
+                if response.status in expected:
+                    return response.status, response.headers, response_body
+                region = response.headers.get('x-amz-bucket-region')
+                if region and region != self.region and response.status in (301, 400):
+                    # The bucket is in another region than the signature was made for.
+                    self.region = region
+                    error = S3Error("{} {} was redirected to region {}".format(
+                        method, url, region), response.status)
+                    continue
+                error = S3Error("{} {} returned HTTP {}: {}".format(
+                    method, url, response.status, response_body[:1024].decode('utf-8', 'replace')),
+                    response.status)
+                if response.status < 500 and response.status != 429:
+                    raise error
+            time.sleep(RETRY_DELAY_SEC * 2 ** attempt)
+        raise error
+
+    def sse_headers(self):
+        return {'x-amz-server-side-encryption': SSE_ALGORITHM} if self.sse else {}
+
+    def head(self, bucket, key):
+        """
+        :return: the headers of the object, or None if it does not exist
+        """
+        (status, headers, _) = self.request('HEAD', bucket, key, expected=(200, 404))
+        return headers if status == 200 else None
+
+    def object_size(self, bucket, key):
+        headers = self.head(bucket, key)
+        if headers is None:
+            raise S3Error("s3://{}/{} does not exist".format(bucket, key), 404)
+        return int(headers['Content-Length'])
+
+    def list_objects(self, bucket, prefix):
+        """
+        :return: a list of (key, size) tuples of all objects under the prefix
+        """
+        objects = []
+        query = {'list-type': '2', 'prefix': prefix}
+        while True:
+            (_, _, body) = self.request('GET', bucket, '', query=dict(query))
+            root = ElementTree.fromstring(body)
+            for element in root:
+                if element.tag.endswith('Contents'):
+                    fields = dict((child.tag.rsplit('}', 1)[-1], child.text) for child in element)
+                    objects.append((fields['Key'], int(fields['Size'])))
+            token = xml_texts(body, 'NextContinuationToken')
+            if not token or not token[0]:
+                return objects
+            query['continuation-token'] = token[0]
+
+    def part_ranges(self, size):
+        """
+        :return: the (offset, length) of every part of an object of the given size
+        """
+        part_size = max(self.part_size, int(math.ceil(size / float(MAX_PARTS))))
+        return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+    def run_parts(self, fn, ranges):
+        """
+        Runs fn(part number, offset, length) for every part, up to the concurrency at once.
+        :return: the results in the order of the parts
+        """
+        if len(ranges) == 1:
+            return [fn(1, *ranges[0])]
+        with concurrent.futures.ThreadPoolExecutor(min(self.concurrency, len(ranges))) as pool:
+            futures = [pool.submit(fn, number, offset, length)
+                       for number, (offset, length) in enumerate(ranges, 1)]
+            return [future.result() for future in futures]
+
+    def multipart(self, bucket, key, upload_part):
+        """
+        Creates a multipart upload, runs upload_part(upload id) to get the (part number, ETag)
+        of all parts and completes the upload. The upload is aborted if a part fails.
+        """
+        (_, _, body) = self.request('POST', bucket, key, query={'uploads': ''},
+                                    headers=self.sse_headers())
+        upload_id = xml_texts(body, 'UploadId')[0]
+        try:
+            parts = upload_part(upload_id)
+            complete = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(''.join(
+                '<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(number, etag)
+                for number, etag in parts)).encode('utf-8')
+            (_, _, body) = self.request('POST', bucket, key, query={'uploadId': upload_id},
+                                        body=complete)
+            # Completing can fail after the 200 status is sent.
+            if xml_texts(body, 'Code'):
+                raise S3Error("Completing the upload of s3://{}/{} failed: {}".format(
+                    bucket, key, body.decode('utf-8', 'replace')))
+        except Exception:
+            try:
+                self.request('DELETE', bucket, key, query={'uploadId': upload_id},
+                             expected=(204, 200, 404))
+            except S3Error:
+                pass
+            raise
+
+    def put_file(self, path, bucket, key):
+        """
+        Uploads a local file in one request, or in parallel parts when it is larger than a part.
+        """
+        size = os.path.getsize(path)
+        ranges = self.part_ranges(size)
+        if len(ranges) <= 1:
+            headers = self.sse_headers()
+            headers['Content-Length'] = str(size)
+            self.request('PUT', bucket, key, headers=headers,
+                         body=lambda: FileSlice(path, 0, size))
+        else:
+            def upload_part(upload_id):
+                def put_part(number, offset, length):
+                    (_, headers, _) = self.request(
+                        'PUT', bucket, key,
+                        query={'partNumber': str(number), 'uploadId': upload_id},
+                        headers={'Content-Length': str(length)},
+                        body=lambda: FileSlice(path, offset, length))
+                    return number, headers['ETag']
+                return self.run_parts(put_part, ranges)
+            self.multipart(bucket, key, upload_part)
+        with self.lock:
+            self.num_bytes += size
+
+    def get_file(self, bucket, key, path):
+        """
+        Downloads an object in one request, or in parallel ranges when it is larger than a part.
+        A partly written file is removed.
+        """
+        size = self.object_size(bucket, key)
+        ranges = self.part_ranges(size)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            def get_part(number, offset, length):
+                position = [offset]
+
+                def write(chunk):
+                    os.pwrite(fd, chunk, position[0])
+                    position[0] += len(chunk)
+                headers = {}
+                if len(ranges) > 1:
+                    headers['Range'] = 'bytes={}-{}'.format(offset, offset + length - 1)
+                # A part is only retried as a whole, from its first byte.
+                for attempt in range(MAX_ATTEMPTS):
+                    position[0] = offset
+                    try:
+                        self.request('GET', bucket, key, headers=headers, sink=write,
+                                     expected=(200, 206))
+                        break
+                    except S3Error as ex:
+                        if ex.status is not None or attempt + 1 == MAX_ATTEMPTS:
+                            raise
+                        time.sleep(RETRY_DELAY_SEC * 2 ** attempt)
+                if position[0] != offset + length:
+                    raise S3Error("Got {} bytes of s3://{}/{} at {} instead of {}".format(
+                        position[0] - offset, bucket, key, offset, length))
+            self.run_parts(get_part, ranges or [(0, 0)])
+        except Exception:
+            os.close(fd)
+            os.remove(path)
+            raise
+        os.close(fd)
+        with self.lock:
+            self.num_bytes += size
+
+    def copy_object(self, bucket, src_key, dest_bucket, dest_key, size):
+        """
+        Copies an object within the storage, in parallel part copies when it is too large for
+        one request.
+        """
+        source = urllib.parse.quote('/{}/{}'.format(bucket, src_key), safe='/-_.~')
+        if size <= MAX_COPY_SIZE:
+            headers = self.sse_headers()
+            headers['x-amz-copy-source'] = source
+            (_, _, body) = self.request('PUT', dest_bucket, dest_key, headers=headers)
+            if xml_texts(body, 'Code'):
+                raise S3Error("Copying s3://{}/{} failed: {}".format(
+                    bucket, src_key, body.decode('utf-8', 'replace')))
+            return
+
+        def upload_part(upload_id):
+            def copy_part(number, offset, length):
+                (_, _, body) = self.request(
+                    'PUT', dest_bucket, dest_key,
+                    query={'partNumber': str(number), 'uploadId': upload_id},
+                    headers={'x-amz-copy-source': source,
+                             'x-amz-copy-source-range': 'bytes={}-{}'.format(
+                                 offset, offset + length - 1)})
+                return number, xml_texts(body, 'ETag')[0]
+            return self.run_parts(copy_part, self.part_ranges(size))
+        self.multipart(dest_bucket, dest_key, upload_part)
+
+    def delete_objects(self, bucket, keys):
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            body = '<Delete><Quiet>true</Quiet>{}</Delete>'.format(''.join(
+                '<Object><Key>{}</Key></Object>'.format(
+                    key.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'))
+                for key in keys[start:start + DELETE_BATCH_SIZE])).encode('utf-8')
+            md5 = base64.b64encode(hashlib.md5(body).digest()).decode('ascii')
+            (_, _, response) = self.request('POST', bucket, '', query={'delete': ''},
+                                            headers={'Content-MD5': md5}, body=body)
+            errors = xml_texts(response, 'Key')
+            if errors:
+                raise S3Error("Could not delete {} objects of s3://{}, e.g. {}".format(
+                    len(errors), bucket, errors[0]))
+
+    def run_all(self, fn, items):
+        """
+        Runs fn on every item, up to the concurrency at once.
+        """
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            for future in [pool.submit(fn, *item) for item in items]:
+                future.result()
+
+
+def object_key(dest, src):
+    """
+    :return: the key of dest, or of the basename of src under dest when dest ends with '/'
+    """
+    return dest + os.path.basename(src.rstrip('/')) if dest.endswith('/') or not dest else dest
+
+
+def put(client, src, dest):
+    location = parse_s3_url(dest)
+    client.put_file(src, location.bucket, object_key(location.key, src))
+
+
+def get(client, src, dest):
+    location = parse_s3_url(src)
+    if os.path.isdir(dest) or dest.endswith('/'):
+        dest = os.path.join(dest, os.path.basename(location.key))
+    client.get_file(location.bucket, location.key, dest)
+
+
+def sync(client, src, dest):
+    """
+    Copies the contents of a local directory under an S3 prefix, or the objects under an S3
+    prefix into a local directory.
+    """
+    if dest.startswith('s3://'):
+        location = parse_s3_url(dest)
+        prefix = location.key.rstrip('/') + '/' if location.key else ''
+        files = []
+        for dir_path, _, filenames in os.walk(src):
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                files.append((path, location.bucket,
+                              prefix + os.path.relpath(path, src).replace(os.sep, '/')))
+        client.run_all(client.put_file, files)
+    else:
+        location = parse_s3_url(src)
+        prefix = location.key.rstrip('/') + '/' if location.key else ''
+        objects = []
+        for key, _ in client.list_objects(location.bucket, prefix):
+            path = os.path.join(dest, *key[len(prefix):].split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            objects.append((location.bucket, key, path))
+        client.run_all(client.get_file, objects)
+
+
+def mv(client, src, dest):
+    src_location = parse_s3_url(src)
+    dest_location = parse_s3_url(dest)
+    size = client.object_size(src_location.bucket, src_location.key)
+    client.copy_object(src_location.bucket, src_location.key, dest_location.bucket,
+                       object_key(dest_location.key, src_location.key), size)
+    client.request('DELETE', src_location.bucket, src_location.key, expected=(204, 200))
+
+
+def delete(client, dest):
+    """
+    Deletes the object and every object under it as a prefix.
+    """
+    location = parse_s3_url(dest)
+    if not location.key.strip('/'):
+        raise S3Error("Refusing to delete the whole bucket {}".format(dest))
+    keys = [key for key, _ in client.list_objects(
+        location.bucket, location.key.rstrip('/') + '/')]
+    if client.head(location.bucket, location.key) is not None:
+        keys.append(location.key)
+    client.delete_objects(location.bucket, keys)
+
+
+def info(client, src):
+    location = parse_s3_url(src)
+    headers = client.head(location.bucket, location.key)
+    if headers is None:
+        raise S3Error("{} does not exist".format(src), 404)
+    print('{} (object):'.format(src))
+    print('   File size: {}'.format(headers['Content-Length']))
+    print('   Last mod:  {}'.format(headers.get('Last-Modified', '')))
+    print('   ETag:      {}'.format(headers.get('ETag', '').strip('"')))
+
+
+COMMANDS = {'put': (put, 2), 'get': (get, 2), 'sync': (sync, 2), 'mv': (mv, 2),
+            'del': (delete, 1), 'info': (info, 1)}
+# Commands that, like s3cmd, take several sources when the destination ends with '/'.
+MULTI_SOURCE_COMMANDS = ('put', 'get', 'mv')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Native S3 transfers for yb_backup_diff.py')
+    parser.add_argument('command', choices=sorted(COMMANDS.keys()))
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--config', help='s3cmd config file with the credentials and endpoint.')
+    parser.add_argument('--part_size_mb', type=int, default=DEFAULT_PART_SIZE_MB,
+                        help='Size of the parts of multipart uploads and ranged downloads.')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Requests in flight at once, over all parts and files of the command.')
+    parser.add_argument('--no_check_certificate', action='store_true', default=False)
+    # Options of the s3cmd commands this engine replaces.
+    parser.add_argument('--server-side-encryption', dest='sse', action='store_true',
+                        default=False)
+    parser.add_argument('-r', '--recursive', action='store_true', default=False,
+                        help='Deletes are always recursive.')
+    parser.add_argument('--no-check-md5', action='store_true', default=False,
+                        help='Syncs never compare checksums.')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Downloads always overwrite.')
+    args = parser.parse_args(argv)
+
+    (fn, num_paths) = COMMANDS[args.command]
+    if args.command in MULTI_SOURCE_COMMANDS and len(args.paths) > num_paths:
+        if not args.paths[-1].endswith('/'):
+            parser.error('{} of several sources takes a destination ending with /'.format(
+                args.command))
+    elif len(args.paths) != num_paths:
+        parser.error('{} takes {} paths'.format(args.command, num_paths))
+    client = S3Client(read_config(args.config), part_size=args.part_size_mb * 1024 * 1024,
+                      concurrency=args.concurrency, sse=args.sse,
+                      check_certificate=not args.no_check_certificate)
+    start_time = time.time()
+    try:
+        if len(args.paths) > num_paths:
+            dest = args.paths[-1]
+            client.run_all(lambda src: fn(client, src, dest),
+                           [(src,) for src in args.paths[:-1]])
+        else:
+            fn(client, *args.paths)
+    except S3Error as ex:
+        sys.stderr.write('ERROR: {}\n'.format(ex))
+        return 1
+    finally:
+        client.close()
+    if args.command != 'info':
+        elapsed = time.time() - start_time
+        print('{} {}: {} bytes in {:.3f} sec ({:.1f} MB/s), {} requests on {} connections'.format(
+            args.command, ' '.join(args.paths), client.num_bytes, elapsed,
+            client.num_bytes / 1024.0 / 1024.0 / max(elapsed, 1e-6), client.num_requests,
+            client.num_connections))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())